@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Regression benchmark of hot paths on synthetic 101x101 data
+
+Each benchmark runs at a fixed seed in its own forked process, so TensorFlow graphs and flags of
+entry points do not leak between them. Timings are compared with the baseline of this machine,
+and the exit status is 1 if any of them is slower than (1 + tolerance) times the baseline.
+Flags of measurement and baseline (warmup, repeats, configs, batch_sizes, tolerance, ...)
+are shared with benchmark_model.py.
+"""
+
+import os
+import sys
+import json
+import socket
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from absl import app, flags
+
+from constant import *
+from util import RLenc
+from scoring import mean_score_per_image, mean_score_batch
+from benchmark_model import CONFIGS, TIMING_SUFFIX, new_session, measure_latency, compare_baseline, save_results, \
+    load_baseline, _timeit
+
+flags.DEFINE_list('benchmarks', None, """benchmarks to run (default: all)""")
+flags.DEFINE_integer('num_samples', 256, """number of synthetic samples""")
+flags.DEFINE_string('machine', socket.gethostname(), """name of this machine, baselines are stored per machine""")
+flags.DEFINE_string('baseline_dir', '../benchmark_baselines',
+                    """directory of baselines <machine>.json, used unless --baseline is given""")
+
+FLAGS = flags.FLAGS
+
+RESULT_FILENAME = "benchmark"
+SEED = 17
+TF_BATCH_SIZE = 32
+NUM_ENSEMBLE_MODELS = 3
+AUGMENT_DICT = dict(horizontal_flip=True, vertical_flip=True, rotation_range=0, zoom_range=0.2,
+                    width_shift_range=0.2, height_shift_range=0.2, brightness_range=0.0, gradation_range=0.0,
+                    random_erase='constant', mixup=None, fill_mode='reflect')
+
+
+def synthetic_masks(num, seed=SEED):
+    """Blocky masks (N, 101, 101) of 0 or 1, every 4th mask is empty"""
+    rng = np.random.RandomState(seed)
+    cells = rng.uniform(size=(num, 11, 11)) > 0.6
+    masks = np.repeat(np.repeat(cells, 10, axis=1), 10, axis=2)[:, :ORIG_HEIGHT, :ORIG_WIDTH].astype(np.uint8)
+    masks[::4] = 0
+    return masks
+
+
+def synthetic_preds(masks, seed=SEED):
+    """Confidence maps close to `masks`"""
+    rng = np.random.RandomState(seed + 1)
+    return np.clip(masks * 0.7 + rng.uniform(0.0, 0.5, size=masks.shape), 0.0, 1.0).astype(np.float32)
+
+
+def write_dataset(path_input, masks, seed=SEED):
+    """Write images and masks as png in the layout of the input directory"""
+    rng = np.random.RandomState(seed + 2)
+    os.makedirs(os.path.join(path_input, 'images'))
+    os.makedirs(os.path.join(path_input, 'masks'))
+    for i, mask in enumerate(masks):
+        name = "{:06d}.png".format(i)
+        image = rng.randint(0, 256, size=(ORIG_HEIGHT, ORIG_WIDTH), dtype=np.uint8)
+        cv2.imwrite(os.path.join(path_input, 'images', name), image)
+        cv2.imwrite(os.path.join(path_input, 'masks', name), mask * 255)
+
+
+def _throughput(seconds, num):
+    return OrderedDict([('total' + TIMING_SUFFIX, seconds * 1000), ('per_item' + TIMING_SUFFIX, seconds * 1000 / num),
+                        ('items_per_sec', num / seconds)])
+
+
+def bench_rlenc(num, warmup, repeats):
+    masks = synthetic_masks(num)
+    return _throughput(_timeit(lambda: [RLenc(m) for m in masks], warmup, repeats), num)
+
+
+def bench_mean_score_per_image(num, warmup, repeats):
+    masks = synthetic_masks(num)
+    preds = synthetic_preds(masks)
+    fn = lambda: [mean_score_per_image(t, p, threshold=0.5) for t, p in zip(masks, preds)]
+    return _throughput(_timeit(fn, warmup, repeats), num)
+
+
+def bench_mean_score_batch(num, warmup, repeats):
+    masks = synthetic_masks(num)
+    preds = synthetic_preds(masks)
+    return _throughput(_timeit(lambda: mean_score_batch(masks, preds, threshold=0.5), warmup, repeats), num)
+
+
+def _bench_graph(build_fn, warmup, repeats):
+    sess = new_session(FLAGS.threads)
+    masks = synthetic_masks(TF_BATCH_SIZE)
+    preds = synthetic_preds(masks)
+    with tf.device('/cpu:0'):
+        op = build_fn(tf.constant(masks.astype(np.float32)), tf.constant(preds))
+    return _throughput(_timeit(lambda: sess.run(op), warmup, repeats), TF_BATCH_SIZE)
+
+
+def bench_tf_mean_score(num, warmup, repeats):
+    from metrics import _mean_score
+    return _bench_graph(lambda y_true, y_pred: _mean_score(y_true[..., np.newaxis], y_pred[..., np.newaxis], 0.5),
+                        warmup, repeats)
+
+
+def bench_tf_lovasz_hinge(num, warmup, repeats):
+    # config defines lovasz_pattern used by lovasz_hinge
+    import config
+    from metrics import lovasz_hinge
+    # confidence in [0, 1] is mapped to logits in [-4, 4]
+    return _bench_graph(lambda y_true, y_pred: lovasz_hinge(y_pred * 8.0 - 4.0, y_true), warmup, repeats)
+
+
+def _bench_gen_train_valid(num, warmup, repeats, augment_dict):
+    from dataset import Dataset
+    path_tmp = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        write_dataset(path_tmp, synthetic_masks(num))
+        sess = new_session(FLAGS.threads)
+        dataset = Dataset(path_tmp)
+        iter_train, _ = dataset.gen_train_valid(N_SPLITS, 0, adjust='symmetric', batch_size=TF_BATCH_SIZE,
+                                                filter_vert_hori=False, augment_dict=augment_dict)
+        sample = iter_train.get_next()
+        return _throughput(_timeit(lambda: sess.run(sample), warmup, repeats), TF_BATCH_SIZE)
+    finally:
+        shutil.rmtree(path_tmp)
+
+
+def bench_gen_train_valid(num, warmup, repeats):
+    return _bench_gen_train_valid(num, warmup, repeats, None)
+
+
+def bench_gen_train_valid_augment(num, warmup, repeats):
+    return _bench_gen_train_valid(num, warmup, repeats, AUGMENT_DICT)
+
+
+def bench_save_npz(num, warmup, repeats):
+    from predict import save_npz
+    pad_top, pad_left = (IM_HEIGHT - ORIG_HEIGHT) // 2, (IM_WIDTH - ORIG_WIDTH) // 2
+    preds = np.zeros((num, IM_HEIGHT, IM_WIDTH, 1), dtype=np.float32)
+    preds[:, pad_top:pad_top + ORIG_HEIGHT, pad_left:pad_left + ORIG_WIDTH, 0] = synthetic_preds(synthetic_masks(num))
+    ids = np.array(["{:06d}.png".format(i) for i in range(num)])
+    path_tmp = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        return _throughput(_timeit(lambda: save_npz(preds, ids, path_tmp, adjust='symmetric'), warmup, repeats), num)
+    finally:
+        shutil.rmtree(path_tmp)
+
+
+def bench_ensemble_pred(num, warmup, repeats):
+    from ensemble import ensemble_pred
+    path_tmp = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        masks = synthetic_masks(num)
+        path_preds = []
+        for i in range(NUM_ENSEMBLE_MODELS):
+            path_pred = os.path.join(path_tmp, "model{}".format(i))
+            os.makedirs(path_pred)
+            for j, pred in enumerate(synthetic_preds(masks, seed=SEED + i)):
+                np.savez(os.path.join(path_pred, "{:06d}.npz".format(j)), pred)
+            path_preds.append(path_pred)
+        path_output = os.path.join(path_tmp, "submission", "submission_mean.csv")
+        return _throughput(_timeit(lambda: ensemble_pred(path_preds, path_output, np.mean), warmup, repeats), num)
+    finally:
+        shutil.rmtree(path_tmp)
+
+
+def bench_model(name, warmup, repeats):
+    new_session(FLAGS.threads)
+    with tf.device('/cpu:0'):
+        model = CONFIGS[name](IM_HEIGHT, IM_WIDTH, IM_CHAN)
+    result = OrderedDict([('params', int(model.count_params()))])
+    for batch_size in [int(b) for b in FLAGS.batch_sizes]:
+        latency = measure_latency(model, batch_size, warmup, repeats)
+        result['latency_bs{}{}'.format(batch_size, TIMING_SUFFIX)] = latency * 1000
+    return result
+
+
+BENCHMARKS = OrderedDict([
+    ('rlenc', bench_rlenc),
+    ('mean_score_per_image', bench_mean_score_per_image),
+    ('mean_score_batch', bench_mean_score_batch),
+    ('tf_mean_score', bench_tf_mean_score),
+    ('tf_lovasz_hinge', bench_tf_lovasz_hinge),
+    ('gen_train_valid', bench_gen_train_valid),
+    ('gen_train_valid_augment', bench_gen_train_valid_augment),
+    ('save_npz', bench_save_npz),
+    ('ensemble_pred', bench_ensemble_pred),
+])
+
+
+def _run_child(fn, args, conn):
+    np.random.seed(SEED)
+    try:
+        conn.send(('ok', fn(*args)))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+def run_isolated(fn, *args):
+    """Return fn(*args) called in a forked process"""
+    ctx = multiprocessing.get_context('fork')
+    conn_parent, conn_child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_child, args=(fn, args, conn_child))
+    proc.start()
+    conn_child.close()
+    try:
+        status, value = conn_parent.recv()
+    except EOFError:
+        status, value = 'error', "process exited with code {}".format(proc.exitcode)
+    proc.join()
+    if status != 'ok':
+        raise RuntimeError(value)
+    return value
+
+
+def main(argv):
+    names = FLAGS.benchmarks if FLAGS.benchmarks is not None else list(BENCHMARKS.keys()) + ['model']
+    configs = FLAGS.configs if FLAGS.configs is not None else list(CONFIGS.keys())
+    jobs = []
+    for name in names:
+        if name == 'model':
+            jobs += [('model-' + config, IM_HEIGHT, bench_model, (config, FLAGS.warmup, FLAGS.repeats))
+                     for config in configs]
+        elif name in BENCHMARKS:
+            jobs.append((name, ORIG_HEIGHT, BENCHMARKS[name], (FLAGS.num_samples, FLAGS.warmup, FLAGS.repeats)))
+        else:
+            raise ValueError("benchmark {} is not supported".format(name))
+
+    results = []
+    for name, size, fn, args in jobs:
+        print("Benchmarking {}".format(name))
+        result = OrderedDict([('config', name), ('height', size), ('width', size)])
+        result.update(run_isolated(fn, *args))
+        results.append(result)
+
+    save_results(results, FLAGS.output, name=RESULT_FILENAME)
+    print(pd.DataFrame(results).set_index('config').to_string())
+
+    path_baseline = FLAGS.baseline if FLAGS.baseline is not None else \
+        os.path.join(FLAGS.baseline_dir, FLAGS.machine + ".json")
+    if FLAGS.update_baseline or not os.path.exists(path_baseline):
+        os.makedirs(os.path.dirname(os.path.abspath(path_baseline)), exist_ok=True)
+        with open(path_baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Baseline is saved to {}".format(path_baseline))
+        return
+
+    regressions = compare_baseline(results, load_baseline(path_baseline), FLAGS.tolerance)
+    if len(regressions) > 0:
+        print("Regressions against {}:".format(path_baseline))
+        for r in regressions:
+            print("  " + r)
+        sys.exit(1)
+    print("No regression against {}".format(path_baseline))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of COCO / Berkeley VOC mask conversion for encoder pretraining
+
+Generates a small synthetic corpus in a temporary directory, then reports images/sec of
+mask conversion, of a second pass over up-to-date masks and of segmentation stats,
+for each number of processes.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.io
+from absl import app, flags
+from pycocotools.coco import COCO
+
+from keras_contrib.datasets import coco as data_coco
+from keras_contrib.datasets import pascal_voc as data_pascal_voc
+
+flags.DEFINE_integer('num_images', 200, """number of synthetic images""")
+flags.DEFINE_integer('height', 240, """height of synthetic images""")
+flags.DEFINE_integer('width', 320, """width of synthetic images""")
+flags.DEFINE_integer('anns_per_image', 5, """number of polygon annotations per image""")
+flags.DEFINE_list('processes', ['1', '4'], """numbers of processes to benchmark (1: serial)""")
+flags.DEFINE_integer('chunk_size', 16, """number of images per task of a process""")
+flags.DEFINE_integer('seed', 0, """random seed of synthetic corpus""")
+
+FLAGS = flags.FLAGS
+
+
+def synthetic_coco(num_images, height, width, anns_per_image, seed=0):
+    """Return COCO format dict of images with random polygons of random categories"""
+    rng = np.random.RandomState(seed)
+    category_ids = data_coco.ids()[1:]
+    images, annotations = [], []
+    for img_id in range(1, num_images + 1):
+        images.append({'id': img_id, 'file_name': "{:012d}.jpg".format(img_id), 'height': height, 'width': width})
+        for _ in range(anns_per_image):
+            cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+            radius = rng.uniform(5, min(height, width) / 3)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 8))
+            xs = np.clip(cx + radius * np.cos(angles), 0, width - 1)
+            ys = np.clip(cy + radius * np.sin(angles), 0, height - 1)
+            annotations.append({'id': len(annotations) + 1, 'image_id': img_id, 'iscrowd': 0,
+                                'category_id': int(rng.choice(category_ids)),
+                                'segmentation': [np.stack([xs, ys], axis=1).ravel().tolist()],
+                                'area': float(np.pi * radius ** 2), 'bbox': [0, 0, 0, 0]})
+    categories = [{'id': cid, 'name': str(cid), 'supercategory': 'synthetic'} for cid in category_ids]
+    return {'images': images, 'annotations': annotations, 'categories': categories}
+
+
+def synthetic_berkeley(path_root, num_images, height, width, seed=0):
+    """Write random class segmentations as Berkeley augmented VOC .mat files under `path_root`"""
+    rng = np.random.RandomState(seed)
+    path_mat = os.path.join(path_root, 'dataset', 'cls')
+    os.makedirs(path_mat)
+    for i in range(num_images):
+        segmentation = np.zeros((height, width), dtype=np.uint8)
+        top, left = rng.randint(0, height // 2), rng.randint(0, width // 2)
+        segmentation[top:top + height // 2, left:left + width // 2] = rng.randint(1, 21)
+        scipy.io.savemat(os.path.join(path_mat, "{:06d}.mat".format(i)),
+                         {'GTcls': {'Segmentation': segmentation}})
+
+
+def _rate(num, seconds):
+    return num / max(seconds, 1e-6)
+
+
+def benchmark_coco(path_tmp, coco, annFile, processes, chunk_size):
+    seg_mask_path = os.path.join(path_tmp, "coco_seg_mask_{}".format(processes))
+    os.makedirs(seg_mask_path)
+    img_ids = coco.getImgIds()
+    source_mtime = os.path.getmtime(annFile)
+    results = {}
+
+    start = time.perf_counter()
+    data_coco.convert_annotations(coco, seg_mask_path, source_mtime, img_ids, 'png', processes, chunk_size)
+    data_coco.convert_annotations(coco, seg_mask_path, source_mtime, img_ids, 'npy', processes, chunk_size)
+    results['convert'] = _rate(len(img_ids), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    converted = data_coco.convert_annotations(coco, seg_mask_path, source_mtime, img_ids, 'png', processes, chunk_size)
+    converted += data_coco.convert_annotations(coco, seg_mask_path, source_mtime, img_ids, 'npy', processes,
+                                               chunk_size)
+    results['up_to_date'] = _rate(len(img_ids), time.perf_counter() - start)
+    if converted != 0:
+        raise RuntimeError("{} up-to-date masks were converted again".format(converted))
+
+    start = time.perf_counter()
+    bin_count, total_pixels = data_coco.segmentation_histogram(coco, img_ids, processes, chunk_size)
+    results['stats'] = _rate(len(img_ids), time.perf_counter() - start)
+    return results, bin_count
+
+
+def benchmark_voc(path_root, num_images, processes, chunk_size):
+    path_png = os.path.join(path_root, 'dataset', 'cls_png')
+    if os.path.exists(path_png):
+        shutil.rmtree(path_png)
+    start = time.perf_counter()
+    data_pascal_voc.convert_pascal_berkeley_augmented_mat_annotations_to_png(path_root, processes, chunk_size)
+    return {'convert': _rate(num_images, time.perf_counter() - start)}
+
+
+def main(argv):
+    path_tmp = tempfile.mkdtemp(prefix="benchmark_datasets-")
+    try:
+        dataset = synthetic_coco(FLAGS.num_images, FLAGS.height, FLAGS.width, FLAGS.anns_per_image, FLAGS.seed)
+        annFile = os.path.join(path_tmp, "instances_synthetic.json")
+        with open(annFile, 'w') as f:
+            json.dump(dataset, f)
+        coco = COCO(annFile)
+        path_berkeley = os.path.join(path_tmp, "benchmark_RELEASE")
+        synthetic_berkeley(path_berkeley, FLAGS.num_images, FLAGS.height, FLAGS.width, FLAGS.seed)
+
+        bin_count_serial = None
+        for processes in [int(p) for p in FLAGS.processes]:
+            results, bin_count = benchmark_coco(path_tmp, coco, annFile, processes, FLAGS.chunk_size)
+            if bin_count_serial is None:
+                bin_count_serial = bin_count
+            elif not np.array_equal(bin_count, bin_count_serial):
+                raise RuntimeError("stats with {} processes differ from {} processes".format(
+                    processes, FLAGS.processes[0]))
+            for stage, rate in sorted(results.items()):
+                print("coco {:>10s} processes:{:<3d} {:8.1f} images/sec".format(stage, processes, rate))
+            results = benchmark_voc(path_berkeley, FLAGS.num_images, processes, FLAGS.chunk_size)
+            print("voc  {:>10s} processes:{:<3d} {:8.1f} images/sec".format('convert', processes, results['convert']))
+    finally:
+        shutil.rmtree(path_tmp)
+
+
+if __name__ == '__main__':
+    app.run(main)
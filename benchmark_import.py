@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of import time of each entry point
+
+Each entry point is imported in a fresh interpreter with `python -X importtime`.
+Reports the total import time and the slowest top-level imports, and exits with
+status 1 if an entry point exceeds its budget or a NumPy tool imports a forbidden module.
+"""
+
+import os
+import re
+import sys
+import subprocess
+from collections import OrderedDict
+
+from absl import app, flags
+
+flags.DEFINE_list('entry_points', None, """entry points to benchmark (default: all)""")
+flags.DEFINE_integer('repeats', 3, """number of imports of each entry point, the fastest one is reported""")
+flags.DEFINE_integer('top', 5, """number of slowest top-level imports to report""")
+flags.DEFINE_float('budget_scale', 1.0, """factor of budgets, for slower machines""")
+
+FLAGS = flags.FLAGS
+
+# budget of import time [ms] and modules which must not be imported
+NUMPY_BUDGET_MS = 1500
+TF_BUDGET_MS = 15000
+NUMPY_FORBIDDEN = ['tensorflow', 'sklearn', 'skimage', 'pandas', 'LovaszSoftmax']
+
+ENTRY_POINTS = OrderedDict([
+    ('score_per_image', (NUMPY_BUDGET_MS, [m for m in NUMPY_FORBIDDEN if m != 'pandas'])),
+    ('ensemble', (NUMPY_BUDGET_MS, NUMPY_FORBIDDEN)),
+    ('blend', (NUMPY_BUDGET_MS, NUMPY_FORBIDDEN)),
+    ('visualize', (NUMPY_BUDGET_MS, NUMPY_FORBIDDEN)),
+    ('filter_rect', (NUMPY_BUDGET_MS, NUMPY_FORBIDDEN)),
+    ('dataset_service', (NUMPY_BUDGET_MS, NUMPY_FORBIDDEN)),
+    ('inference', (TF_BUDGET_MS, [])),
+    ('predict', (TF_BUDGET_MS, [])),
+    ('eval', (TF_BUDGET_MS, [])),
+    ('train', (TF_BUDGET_MS, [])),
+])
+
+# import time: self [us] | cumulative | imported package
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def parse_importtime(stderr):
+    """Return total seconds, {module: cumulative seconds} of top-level imports and the set of imported modules"""
+    total = 0
+    top_level = {}
+    modules = set()
+    for line in stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        total += int(self_us)
+        modules.add(module)
+        if len(indent) == 0:
+            top_level[module] = int(cumulative_us) / 1e6
+    return total / 1e6, top_level, modules
+
+
+def measure_import(name, repeats=3):
+    """Import `name` `repeats` times in fresh interpreters, return the parsed result of the fastest"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(name)],
+                              cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError("failed to import {}:\n{}".format(name, proc.stderr[-2000:]))
+        result = parse_importtime(proc.stderr)
+        if best is None or result[0] < best[0]:
+            best = result
+    return best
+
+
+def check(name, total, modules, budget_ms, forbidden):
+    """Return list of violations of budget and forbidden imports"""
+    errors = []
+    if total * 1000 > budget_ms:
+        errors.append("{}: import takes {:.0f} ms, budget is {:.0f} ms".format(name, total * 1000, budget_ms))
+    for module in forbidden:
+        if module in modules:
+            errors.append("{}: imports {}".format(name, module))
+    return errors
+
+
+def main(argv):
+    names = FLAGS.entry_points if FLAGS.entry_points is not None else list(ENTRY_POINTS.keys())
+    errors = []
+    for name in names:
+        budget_ms, forbidden = ENTRY_POINTS[name]
+        budget_ms *= FLAGS.budget_scale
+        total, top_level, modules = measure_import(name, FLAGS.repeats)
+        print("{:<16s} {:8.0f} ms (budget {:.0f} ms)".format(name, total * 1000, budget_ms))
+        for module, seconds in sorted(top_level.items(), key=lambda x: -x[1])[:FLAGS.top]:
+            print("    {:<30s} {:8.0f} ms".format(module, seconds * 1000))
+        errors += check(name, total, modules, budget_ms, forbidden)
+
+    for error in errors:
+        print(error)
+    if len(errors) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of cost of each model configuration
+
+Reports parameters, FLOPs and activation memory estimated from layer shapes,
+and CPU inference latency/throughput and training step time measured on random inputs.
+"""
+
+import os
+import sys
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import tensorflow.keras.backend as K
+from tensorflow.keras.layers import Conv2D, Conv2DTranspose, Dense
+from absl import app, flags
+
+from constant import *
+from model import build_model, build_model_ref, build_model_ref2, build_model_contrib, build_model_pretrained, \
+    build_model_pretrained_deep_supervised, compile_model, get_stride_multiple, get_minimal_size
+
+flags.DEFINE_list('configs', None, """configurations to benchmark (default: all)""")
+flags.DEFINE_list('batch_sizes', ['1', '8', '32'], """batch sizes to measure inference latency""")
+flags.DEFINE_integer('train_batch_size', 8, """batch size to measure training step time""")
+flags.DEFINE_integer('height', IM_HEIGHT, """height of input image""")
+flags.DEFINE_integer('width', IM_WIDTH, """width of input image""")
+flags.DEFINE_integer('warmup', 2, """number of runs discarded before measurement""")
+flags.DEFINE_integer('repeats', 10, """number of measured runs""")
+flags.DEFINE_integer('threads', 0, """number of CPU threads of TensorFlow (0: system default)""")
+flags.DEFINE_string('output', '../output/benchmark', """path to output directory""")
+flags.DEFINE_string('baseline', None, """path to baseline json to detect regressions""")
+flags.DEFINE_bool('update_baseline', False, """whether to overwrite baseline with the results""")
+flags.DEFINE_float('tolerance', 0.2, """relative slowdown of timings allowed against baseline""")
+flags.DEFINE_bool('compare_padding', False,
+                  """whether to also benchmark each config at its minimal padded size and compare latency""")
+
+FLAGS = flags.FLAGS
+
+RESULT_FILENAME = "benchmark_model"
+
+CONFIGS = OrderedDict([
+    ('unet', lambda h, w, c: build_model(h, w, c, batch_norm=True)),
+    ('ref', lambda h, w, c: build_model_ref(h, w, c)),
+    ('ref2', lambda h, w, c: build_model_ref2(h, w, c, preprocess=True)),
+    ('contrib-resnet34', lambda h, w, c: build_model_contrib(h, w, c, encoder='resnet34', preprocess=True)),
+    ('contrib-resnet50', lambda h, w, c: build_model_contrib(h, w, c, encoder='resnet50', preprocess=True)),
+    ('pretrained-resnet50', lambda h, w, c: build_model_pretrained(h, w, c, encoder='resnet50', preprocess=True)),
+    ('pretrained-resnet50-shallow',
+     lambda h, w, c: build_model_pretrained(h, w, c, encoder='resnet50-shallow', preprocess=True)),
+    ('pretrained-densenet121', lambda h, w, c: build_model_pretrained(h, w, c, encoder='densenet121', preprocess=True)),
+    ('deep-supervised-resnet50',
+     lambda h, w, c: build_model_pretrained_deep_supervised(h, w, c, encoder='resnet50', preprocess=True)),
+])
+
+STRIDE_MULTIPLES = {
+    'unet': get_stride_multiple(),
+    'ref': get_stride_multiple(use_ref=True),
+    'ref2': get_stride_multiple(use_ref2=True),
+    'contrib-resnet34': get_stride_multiple(contrib='resnet34'),
+    'contrib-resnet50': get_stride_multiple(contrib='resnet50'),
+    'pretrained-resnet50': get_stride_multiple(pretrained='resnet50'),
+    'pretrained-resnet50-shallow': get_stride_multiple(pretrained='resnet50-shallow'),
+    'pretrained-densenet121': get_stride_multiple(pretrained='densenet121'),
+    'deep-supervised-resnet50': get_stride_multiple(pretrained='resnet50'),
+}
+
+# metrics compared exactly / with tolerance against baseline
+STATIC_METRICS = ['params', 'flops']
+TIMING_SUFFIX = '_ms'
+
+
+def count_flops(model):
+    """FLOPs (2 * multiply-adds) of convolution and dense layers per sample"""
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, Conv2DTranspose):
+            positions = np.prod(layer.input_shape[1:3])
+        elif isinstance(layer, Conv2D):
+            positions = np.prod(layer.output_shape[1:3])
+        elif isinstance(layer, Dense):
+            positions = 1
+        else:
+            continue
+        flops += 2 * int(positions) * int(np.prod(K.int_shape(layer.kernel)))
+    return flops
+
+
+def _output_sizes(layer):
+    shapes = layer.output_shape if isinstance(layer.output_shape, list) else [layer.output_shape]
+    return [int(np.prod(shape[1:])) for shape in shapes]
+
+
+def activation_memory(model, bytes_per_elem=4):
+    """Activation memory per sample in MB
+
+    total: outputs of all layers, kept for back-propagation in training
+    peak: largest input + output of a single layer, lower bound of inference
+    """
+    total = 0
+    peak = 0
+    for layer in model.layers:
+        size_out = sum(_output_sizes(layer))
+        total += size_out
+        inbound = [l for node in layer._inbound_nodes for l in node.inbound_layers]
+        size_in = sum(sum(_output_sizes(l)) for l in inbound)
+        peak = max(peak, size_in + size_out)
+    return total * bytes_per_elem / 2**20, peak * bytes_per_elem / 2**20
+
+
+def _timeit(fn, warmup, repeats):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def measure_latency(model, batch_size, warmup=2, repeats=10):
+    """Median seconds of `predict_on_batch`"""
+    xs = np.random.uniform(size=[batch_size] + list(model.input_shape[1:])).astype(np.float32)
+    return _timeit(lambda: model.predict_on_batch(xs), warmup, repeats)
+
+
+def random_targets(model, batch_size):
+    height, width = model.input_shape[1:3]
+    mask = np.round(np.random.uniform(size=(batch_size, height, width, 1)))
+    mask_and_weight = np.concatenate([mask, np.ones_like(mask)], axis=3).astype(np.float32)
+    if len(model.outputs) == 1:
+        return mask_and_weight
+    image_label = np.round(np.random.uniform(size=(batch_size, 1))).astype(np.float32)
+    return {'output_final': mask_and_weight, 'output_pixel': mask_and_weight, 'output_image': image_label}
+
+
+def measure_train_step(model, batch_size, warmup=2, repeats=10):
+    """Median seconds of `train_on_batch`"""
+    deep_supervised = len(model.outputs) > 1
+    model = compile_model(model, optimizer='adam', loss='bce-dice', deep_supervised=deep_supervised)
+    xs = np.random.uniform(size=[batch_size] + list(model.input_shape[1:])).astype(np.float32)
+    ys = random_targets(model, batch_size)
+    return _timeit(lambda: model.train_on_batch(xs, ys), warmup, repeats)
+
+
+def new_session(threads=0):
+    K.clear_session()
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    sess = tf.Session(config=config)
+    K.set_session(sess)
+    np.random.seed(0)
+    tf.set_random_seed(0)
+    return sess
+
+
+def benchmark(name, height, width, batch_sizes, train_batch_size, warmup=2, repeats=10, threads=0):
+    new_session(threads)
+    with tf.device('/cpu:0'):
+        model = CONFIGS[name](height, width, IM_CHAN)
+
+    result = OrderedDict([('config', name), ('height', height), ('width', width)])
+    result['params'] = int(model.count_params())
+    result['flops'] = count_flops(model)
+    result['activation_mb'], result['peak_activation_mb'] = activation_memory(model)
+
+    for batch_size in batch_sizes:
+        latency = measure_latency(model, batch_size, warmup, repeats)
+        result['latency_bs{}{}'.format(batch_size, TIMING_SUFFIX)] = latency * 1000
+        result['throughput_bs{}'.format(batch_size)] = batch_size / latency
+
+    step = measure_train_step(model, train_batch_size, warmup, repeats)
+    result['train_step_bs{}{}'.format(train_batch_size, TIMING_SUFFIX)] = step * 1000
+    return result
+
+
+def compare_baseline(results, baseline, tolerance):
+    """Return messages of regressions of `results` against `baseline`
+
+    Static metrics must be equal, timings must not be slower than (1 + tolerance) times baseline.
+    """
+    baseline = {(r['config'], r['height'], r['width']): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get((result['config'], result['height'], result['width']))
+        if base is None:
+            continue
+        for key, value in result.items():
+            if key not in base:
+                continue
+            if key in STATIC_METRICS and value != base[key]:
+                regressions.append("{} {}: {} -> {}".format(result['config'], key, base[key], value))
+            elif key.endswith(TIMING_SUFFIX) and value > base[key] * (1 + tolerance):
+                regressions.append("{} {}: {:.3f} -> {:.3f} (+{:.1%})".format(
+                    result['config'], key, base[key], value, value / base[key] - 1))
+    return regressions
+
+
+def compare_padding(results):
+    """Ratio of cost at minimal padded size to cost at the default size for each config"""
+    rows = []
+    by_config = {}
+    for result in results:
+        by_config.setdefault(result['config'], []).append(result)
+    for name, (default, minimal) in by_config.items():
+        row = OrderedDict([('config', name), ('default_size', default['height']), ('minimal_size', minimal['height'])])
+        for key, value in minimal.items():
+            if key == 'flops' or key.endswith(TIMING_SUFFIX):
+                row[key + '_ratio'] = value / default[key]
+        rows.append(row)
+    return rows
+
+
+def save_results(results, path_out, name=RESULT_FILENAME):
+    os.makedirs(path_out, exist_ok=True)
+    with open(os.path.join(path_out, name + ".json"), 'w') as f:
+        json.dump(results, f, indent=4)
+    pd.DataFrame(results).to_csv(os.path.join(path_out, name + ".csv"), index=False)
+
+
+def load_baseline(path_baseline):
+    with open(path_baseline) as f:
+        return json.load(f)
+
+
+def main(argv):
+    names = FLAGS.configs if FLAGS.configs is not None else list(CONFIGS.keys())
+    for name in names:
+        if name not in CONFIGS:
+            raise ValueError("config {} is not supported".format(name))
+    batch_sizes = [int(b) for b in FLAGS.batch_sizes]
+
+    results = []
+    for name in names:
+        sizes = [(FLAGS.height, FLAGS.width)]
+        if FLAGS.compare_padding:
+            multiple = STRIDE_MULTIPLES[name]
+            sizes.append((get_minimal_size(ORIG_HEIGHT, multiple), get_minimal_size(ORIG_WIDTH, multiple)))
+        for height, width in sizes:
+            print("Benchmarking {} ({}x{})".format(name, height, width))
+            result = benchmark(name, height, width, batch_sizes, FLAGS.train_batch_size,
+                               warmup=FLAGS.warmup, repeats=FLAGS.repeats, threads=FLAGS.threads)
+            results.append(result)
+
+    save_results(results, FLAGS.output)
+    print(pd.DataFrame(results).set_index('config').transpose().to_string())
+
+    if FLAGS.compare_padding:
+        comparison = compare_padding(results)
+        save_results(comparison, FLAGS.output, name=RESULT_FILENAME + "_padding")
+        print(pd.DataFrame(comparison).set_index('config').transpose().to_string())
+
+    if FLAGS.baseline is None:
+        return
+    if FLAGS.update_baseline or not os.path.exists(FLAGS.baseline):
+        with open(FLAGS.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Baseline is saved to {}".format(FLAGS.baseline))
+        return
+
+    regressions = compare_baseline(results, load_baseline(FLAGS.baseline), FLAGS.tolerance)
+    if len(regressions) > 0:
+        print("Regressions against {}:".format(FLAGS.baseline))
+        for r in regressions:
+            print("  " + r)
+        sys.exit(1)
+    print("No regression against {}".format(FLAGS.baseline))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check and benchmark of the pretrained weight store on small synthetic weights
+
+Saves weights of a small model with top layers, imports them into a temporary store with --force,
+verifies them, loads them into a copy of the model without top layers and compares the weights.
+A modified file must fail verification, and a model with other layer names must fail to load.
+Reports load time of weight_store.load_weights and Model.load_weights(by_name=True).
+"""
+
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+from absl import app, flags
+from tensorflow.keras.layers import Input, Conv2D, BatchNormalization, Activation, GlobalAveragePooling2D, Dense
+from tensorflow.keras.models import Model
+
+import weight_store
+
+flags.DEFINE_integer('blocks', 8, """number of conv blocks of the synthetic model""")
+flags.DEFINE_integer('filters', 32, """number of filters of conv layers""")
+flags.DEFINE_integer('repeats', 5, """number of loads to time, the fastest one is reported""")
+
+FLAGS = flags.FLAGS
+
+NAME = 'synthetic'
+
+
+def synthetic_model(include_top=True, blocks=8, filters=32, prefix=""):
+    inputs = Input(shape=(32, 32, 3))
+    x = inputs
+    for i in range(blocks):
+        x = Conv2D(filters, 3, padding='same', name="{}conv{}".format(prefix, i))(x)
+        x = BatchNormalization(name="{}bn{}".format(prefix, i))(x)
+        x = Activation('relu')(x)
+    x = GlobalAveragePooling2D()(x)
+    if include_top:
+        x = Dense(10, name="{}fc".format(prefix))(x)
+    return Model(inputs, x)
+
+
+def _fastest(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _expect_error(fn, message):
+    try:
+        fn()
+    except ValueError as e:
+        print("OK  {}: {}".format(message, e))
+        return
+    raise RuntimeError("{} is not detected".format(message))
+
+
+def main(argv):
+    path_tmp = tempfile.mkdtemp(prefix="benchmark_weight_store-")
+    try:
+        sess = tf.Session()
+        tf.keras.backend.set_session(sess)
+
+        model_top = synthetic_model(True, FLAGS.blocks, FLAGS.filters)
+        path_h5 = os.path.join(path_tmp, "synthetic.h5")
+        model_top.save_weights(path_h5)
+
+        store = weight_store.WeightStore(os.path.join(path_tmp, "store"))
+        _expect_error(lambda: store.add(NAME, path_h5), "import of unknown weights without force")
+        sha256 = store.add(NAME, path_h5, force=True)
+        path = weight_store.get_weights_path(NAME, include_top=False, store=store.path)
+        print("OK  imported and verified {} (sha256 {})".format(path, sha256))
+
+        model_notop = synthetic_model(False, FLAGS.blocks, FLAGS.filters)
+        num_layers = weight_store.load_weights(model_notop, path)
+        # variables of the second model are renamed by tensorflow, so layers are compared by name
+        for layer in [l for l in model_notop.layers if len(l.weights) > 0]:
+            for v_top, v in zip(model_top.get_layer(layer.name).get_weights(), layer.get_weights()):
+                if not np.array_equal(v_top, v):
+                    raise RuntimeError("weights of {} differ from the saved weights".format(layer.name))
+        print("OK  loaded {} layers into the model without top layers".format(num_layers))
+
+        _expect_error(lambda: weight_store.load_weights(synthetic_model(False, 1, FLAGS.filters, prefix="other_"), path),
+                      "load into a model of other layers")
+
+        time_store = _fastest(lambda: weight_store.load_weights(model_notop, path), FLAGS.repeats)
+        time_keras = _fastest(lambda: model_notop.load_weights(path, by_name=True), FLAGS.repeats)
+        print("load_weights {:.1f} ms, Model.load_weights(by_name=True) {:.1f} ms".format(
+            time_store * 1000, time_keras * 1000))
+
+        with open(path, 'r+b') as f:
+            f.seek(os.path.getsize(path) // 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xff]))
+        _expect_error(lambda: store.verify(NAME), "modified weights")
+    finally:
+        shutil.rmtree(path_tmp)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Blend submissions by pixel-wise vote on their run-length encodings
+
+Runs of all submissions for an image are accumulated into one reusable difference buffer,
+so no probability map needs to be predicted again.
+"""
+
+import os
+import csv
+import gzip
+import multiprocessing
+
+import numpy as np
+from absl import app, flags
+from tqdm import tqdm
+
+from util import RLenc
+from constant import *
+
+flags.DEFINE_list('submissions', None, """paths to submission files to blend""")
+flags.DEFINE_string('output', '../output/submission_blend.csv', """path to blended submission file""")
+flags.DEFINE_enum(
+    'method', 'majority', enum_values=['majority', 'union', 'intersection'],
+    help="""majority: foreground in more than half of submissions, union: in any, intersection: in all""")
+flags.DEFINE_integer('min_votes', None, """number of submissions to be foreground, overrides method""")
+flags.DEFINE_integer('workers', 4, """number of processes to blend rows""")
+flags.DEFINE_integer('chunk_size', 500, """number of rows blended at once by a process""")
+
+FLAGS = flags.FLAGS
+
+
+def open_csv(path, mode='r'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', newline='')
+    return open(path, mode, newline='')
+
+
+def read_submission(path):
+    """Return ids in order and {id: rle_mask}"""
+    with open_csv(path) as f:
+        reader = csv.reader(f)
+        next(reader)
+        rows = [(row[0], row[1] if len(row) > 1 else '') for row in reader]
+    return [id for id, _ in rows], dict(rows)
+
+
+def get_min_votes(method, num_submissions):
+    if method == 'majority':
+        return num_submissions // 2 + 1
+    elif method == 'union':
+        return 1
+    elif method == 'intersection':
+        return num_submissions
+    raise ValueError("method {} is not supported".format(method))
+
+
+def add_runs(diff, rle):
+    """Add runs of `rle` to difference buffer `diff`, +1 at the start and -1 at the end of each run"""
+    if rle == '':
+        return
+    values = np.array(rle.split(), dtype=np.int64)
+    starts = values[0::2] - 1
+    diff[starts] += 1
+    diff[starts + values[1::2]] -= 1
+
+
+def blend_chunk(args):
+    """Blend rows of (id, [rle_mask of each submission]), return rows of blended submission"""
+    rows, min_votes = args
+    size = ORIG_HEIGHT * ORIG_WIDTH
+    diff = np.zeros(size + 1, dtype=np.int32)
+    blended = []
+    for id, rles in rows:
+        diff[:] = 0
+        for rle in rles:
+            add_runs(diff, rle)
+        mask = np.cumsum(diff[:size]) >= min_votes
+        # pixels are in the order of run-length encoding
+        blended.append((id, RLenc(mask.reshape((ORIG_HEIGHT, ORIG_WIDTH), order='F'))))
+    return blended
+
+
+def main(argv=None):
+    if FLAGS.submissions is None or len(FLAGS.submissions) < 2:
+        raise ValueError("--submissions requires at least 2 submission files")
+
+    ids, rles = read_submission(FLAGS.submissions[0])
+    submissions = [rles]
+    for path in FLAGS.submissions[1:]:
+        _, rles = read_submission(path)
+        if set(rles.keys()) != set(ids):
+            raise ValueError("ids of {} differ from {}".format(path, FLAGS.submissions[0]))
+        submissions.append(rles)
+
+    min_votes = FLAGS.min_votes if FLAGS.min_votes is not None else get_min_votes(FLAGS.method, len(submissions))
+    print("Blending {} submissions of {} images, foreground in {} or more".format(
+        len(submissions), len(ids), min_votes))
+
+    rows = [(id, [s[id] for s in submissions]) for id in ids]
+    chunks = [(rows[i:i + FLAGS.chunk_size], min_votes) for i in range(0, len(rows), FLAGS.chunk_size)]
+
+    dirname = os.path.dirname(FLAGS.output)
+    if dirname != "":
+        os.makedirs(dirname, exist_ok=True)
+    with open_csv(FLAGS.output, 'w') as f, multiprocessing.Pool(FLAGS.workers) as pool:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id', 'rle_mask'])
+        for blended in tqdm(pool.imap(blend_chunk, chunks), total=len(chunks)):
+            writer.writerows(blended)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import queue
+import threading
+import warnings
+
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+from tensorflow.python.keras.callbacks import TensorBoard
+import tensorflow.keras.backend as K
+
+CHECKPOINT_DIRNAME = "checkpoints"
+CHECKPOINT_INDEX = "checkpoints.json"
+
+# files shared with the evaluator process of asynchronous validation
+ASYNC_DIRNAME = "async_valid"
+ASYNC_MODEL = "model.h5"
+ASYNC_DONE = "done"
+ASYNC_BEST = "best.json"
+
+
+class TopKCheckpoint(Callback):
+    """Keep the top-k weights by monitored score
+
+    Weights are snapshotted in memory at the end of an epoch and written by a background thread,
+    so the training loop only pays for `model.get_weights()`.
+
+    weights_format:
+        'npz': weight list saved by `np.savez`, restored by `model.set_weights`
+        'h5': keras weight file, restored by `model.load_weights` (also usable with --restore_weight)
+    """
+    def __init__(self, dirname, monitor, mode='max', top_k=3, weights_format='npz', path_export=None, verbose=1):
+        super(TopKCheckpoint, self).__init__()
+        if mode not in ['max', 'min']:
+            raise ValueError("mode {} is not supported".format(mode))
+        if weights_format not in ['npz', 'h5']:
+            raise ValueError("weights format {} is not supported".format(weights_format))
+        self.dirname = dirname
+        self.monitor = monitor
+        self.mode = mode
+        self.top_k = top_k
+        self.weights_format = weights_format
+        self.path_export = path_export
+        self.verbose = verbose
+        self.checkpoints = []
+        self.queue = None
+        self.thread = None
+        # exception of the writer thread, raised in the training loop
+        self.error = None
+
+    def _is_better(self, a, b):
+        return a > b if self.mode == 'max' else a < b
+
+    def _sort(self, checkpoints):
+        return sorted(checkpoints, key=lambda c: c['score'], reverse=(self.mode == 'max'))
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.dirname, exist_ok=True)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._raise_error()
+        logs = logs or {}
+        score = logs.get(self.monitor)
+        if score is None or np.isnan(score):
+            warnings.warn("Can save best model only with {} available, skipping.".format(self.monitor), RuntimeWarning)
+            return
+
+        if len(self.checkpoints) >= self.top_k and not self._is_better(score, self.checkpoints[-1]['score']):
+            if self.verbose > 0:
+                print("\nEpoch {:05d}: {} ({:.5f}) is not in top-{}".format(epoch + 1, self.monitor, score, self.top_k))
+            return
+
+        filename = "weights-{:04d}-{:.5f}.{}".format(epoch + 1, score, self.weights_format)
+        checkpoints = self._sort(self.checkpoints + [{'epoch': epoch + 1, 'score': float(score), 'filename': filename}])
+        evicted = checkpoints[self.top_k:]
+        self.checkpoints = checkpoints[:self.top_k]
+
+        if self.verbose > 0:
+            print("\nEpoch {:05d}: {} ({:.5f}) is in top-{}, saving weights to {}".format(
+                epoch + 1, self.monitor, score, self.top_k, filename))
+        snapshot = self._snapshot()
+        self.queue.put((filename, snapshot, list(self.checkpoints), [c['filename'] for c in evicted]))
+
+    def on_train_end(self, logs=None):
+        self.flush()
+        if self.path_export is not None and len(self.checkpoints) > 0:
+            path_best = os.path.join(self.dirname, self.checkpoints[0]['filename'])
+            if self.verbose > 0:
+                print("Exporting best weights {} to {}".format(path_best, self.path_export))
+            restore_checkpoint(self.model, path_best)
+            self.model.save(self.path_export)
+
+    def flush(self):
+        """Wait until all pending checkpoints are written"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("failed to write checkpoint to {}".format(self.dirname)) from self.error
+
+    def _snapshot(self):
+        weights = self.model.get_weights()
+        if self.weights_format == 'npz':
+            return weights
+        layers = []
+        idx = 0
+        for layer in self.model.layers:
+            names = [w.name for w in layer.weights]
+            layers.append((layer.name, names, weights[idx:idx + len(names)]))
+            idx += len(names)
+        return layers
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                # stop writing, the next on_epoch_end or flush raises it
+                self.error = e
+                break
+
+    def _write(self, filename, snapshot, checkpoints, evicted):
+        path = os.path.join(self.dirname, filename)
+        path_tmp = path + ".tmp"
+        if self.weights_format == 'npz':
+            with open(path_tmp, 'wb') as f:
+                np.savez(f, *snapshot)
+        else:
+            _save_h5_weights(path_tmp, snapshot)
+        os.replace(path_tmp, path)
+
+        self._write_index(checkpoints)
+        for f in evicted:
+            path_evicted = os.path.join(self.dirname, f)
+            if os.path.exists(path_evicted):
+                os.remove(path_evicted)
+
+    def _write_index(self, checkpoints):
+        index = {'monitor': self.monitor, 'mode': self.mode, 'format': self.weights_format, 'checkpoints': checkpoints}
+        path = os.path.join(self.dirname, CHECKPOINT_INDEX)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(index, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+
+class PeriodicCheckpoint(Callback):
+    """Save weights every `period` epochs for the evaluator process, without validation in training
+
+    The model is saved once at the beginning so that the evaluator can load its architecture,
+    and a done marker is written at the end of training.
+    """
+    def __init__(self, dirname, period=1, verbose=1):
+        super(PeriodicCheckpoint, self).__init__()
+        self.dirname = dirname
+        self.period = period
+        self.verbose = verbose
+        self.epoch = 0
+        self.epoch_saved = 0
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.dirname, exist_ok=True)
+        path = os.path.join(self.dirname, ASYNC_MODEL)
+        self.model.save(path + ".tmp.h5")
+        os.replace(path + ".tmp.h5", path)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        if self.epoch % self.period == 0:
+            self._save(self.epoch)
+
+    def on_train_end(self, logs=None):
+        # weights of the last epoch are always validated
+        if self.epoch > self.epoch_saved:
+            self._save(self.epoch)
+        with open(os.path.join(self.dirname, ASYNC_DONE), 'w') as f:
+            f.write("")
+
+    def _save(self, epoch):
+        path = os.path.join(self.dirname, "weights-{:04d}.npz".format(epoch))
+        if self.verbose > 0:
+            print("\nEpoch {:05d}: saving weights to {} for validation".format(epoch, path))
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, *self.model.get_weights())
+        os.replace(path + ".tmp", path)
+        self.epoch_saved = epoch
+
+
+class MyTensorBoard(TensorBoard):
+    def __init__(self, log_dir, model):
+        super().__init__(log_dir=log_dir)
+        self.model = model
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs.update({'lr': K.eval(self.model.optimizer.lr)})
+        super().on_epoch_end(epoch, logs)
+
+
+def load_best_pointer(dirname):
+    """Return the best result written by the evaluator, None if no checkpoint is evaluated"""
+    path = os.path.join(dirname, ASYNC_BEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_h5_weights(path, layers):
+    """Write weights with the same layout as `Model.save_weights`"""
+    import h5py
+    from tensorflow.python.keras import __version__ as keras_version
+
+    with h5py.File(path, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+        f.attrs['backend'] = 'tensorflow'.encode('utf8')
+        f.attrs['keras_version'] = str(keras_version).encode('utf8')
+        for layer_name, weight_names, weight_values in layers:
+            g = f.create_group(layer_name)
+            g.attrs['weight_names'] = [name.encode('utf8') for name in weight_names]
+            for name, val in zip(weight_names, weight_values):
+                dset = g.create_dataset(name, val.shape, dtype=val.dtype)
+                if not val.shape:
+                    dset[()] = val
+                else:
+                    dset[:] = val
+
+
+def list_checkpoints(dirname, top_k=None):
+    """Return paths of checkpoints in `dirname`, best first"""
+    with open(os.path.join(dirname, CHECKPOINT_INDEX)) as f:
+        index = json.load(f)
+    checkpoints = index['checkpoints'][:top_k]
+    return [os.path.join(dirname, c['filename']) for c in checkpoints]
+
+
+def load_npz_weights(path):
+    with np.load(path) as npzfile:
+        return [npzfile['arr_{}'.format(i)] for i in range(len(npzfile.files))]
+
+
+def restore_checkpoint(model, path):
+    if path.endswith('.npz'):
+        model.set_weights(load_npz_weights(path))
+    else:
+        model.load_weights(path)
+
+
+def restore_averaged_checkpoint(model, paths):
+    """Restore mean of weights of several checkpoints"""
+    if len(paths) == 1:
+        restore_checkpoint(model, paths[0])
+        return
+    sum_weights = None
+    for path in paths:
+        restore_checkpoint(model, path)
+        weights = model.get_weights()
+        if sum_weights is None:
+            sum_weights = [w.astype(np.float64) for w in weights]
+        else:
+            sum_weights = [s + w for s, w in zip(sum_weights, weights)]
+    model.set_weights([(s / len(paths)).astype(w.dtype) for s, w in zip(sum_weights, weights)])
@@ -27,3 +27,17 @@ tf.flags.DEFINE_bool('deep_supervised', False, """whether to use deep-supervised
 
 tf.flags.DEFINE_bool('with_depth', False, """whether to use depth information""")
 
+
+tf.flags.DEFINE_enum(
+    'backend', 'file', enum_values=['file', 'memmap'],
+    help="""how to read input data, 'memmap' shares arrays decoded once among concurrent processes""")
+
+tf.flags.DEFINE_string('decoded', None, """path to decoded arrays of memmap backend (default: <input>/decoded)""")
+
+tf.flags.DEFINE_bool(
+    'exclude_vert_hori', False,
+    """whether to exclude samples of vertical/horizontal masks by the manifest of filter_rect.py""")
+
+tf.flags.DEFINE_string(
+    'weight_store', None,
+    """path to local store of pretrained weights made by weight_store.py (default: $WEIGHT_STORE, or download)""")
@@ -27,6 +27,10 @@ tf.flags.DEFINE_list(
 tf.flags.DEFINE_bool(
     'debug', False, "Run as debug mode")
 
+tf.flags.DEFINE_integer('seed', None, """random seed of graph and numpy""")
+
+tf.flags.DEFINE_integer('num_threads', 0, """number of CPU threads of TensorFlow (0: system default)""")
+
 """Optimize"""
 
 tf.flags.DEFINE_enum(
@@ -73,6 +77,22 @@ tf.flags.DEFINE_bool(
 tf.flags.DEFINE_bool(
     'save_best_only', True, help="""whether to save best score model or save latest model""")
 
+tf.flags.DEFINE_integer(
+    'top_k', 0, help="""number of best weights to keep with asynchronous checkpointing (0: save model synchronously)""")
+
+tf.flags.DEFINE_enum(
+    'checkpoint_format', 'npz', enum_values=['npz', 'h5'], help="""format of weights saved when top_k > 0""")
+
+tf.flags.DEFINE_bool(
+    'async_valid', False,
+    help="""whether to validate checkpoints in a separate evaluator process instead of in training""")
+
+tf.flags.DEFINE_integer(
+    'valid_freq', 1, help="""[async valid] save weights for validation every this number of epochs""")
+
+tf.flags.DEFINE_string(
+    'valid_gpu', None, help="""[async valid] CUDA_VISIBLE_DEVICES of evaluator process ('' to run on CPU)""")
+
 """Dataset"""
 
 tf.flags.DEFINE_bool(
@@ -90,6 +110,10 @@ tf.flags.DEFINE_bool('renorm', None, help="""whether to use batch-renormalizatio
 
 tf.flags.DEFINE_bool('retrain', True, """whether to retrain layers in pretrained model""")
 
+tf.flags.DEFINE_string(
+    'feature_cache', None,
+    """path to cache of frozen encoder features to train only the decoder (requires --pretrained and --noretrain)""")
+
 tf.flags.DEFINE_enum(
     'contrib', None, enum_values=['resnet34', 'resnet50'],
     help="""contribution model of keras-contrib""")
@@ -117,6 +141,10 @@ tf.flags.DEFINE_integer('last_kernel', 1, """kernel size of last convolution lay
 
 tf.flags.DEFINE_bool('last_1x1', False, """whether to add 1x1 conv as last layer""")
 
+tf.flags.DEFINE_bool(
+    'minimal_padding', False,
+    """whether to adjust images to the smallest size valid for the model instead of IM_HEIGHT x IM_WIDTH""")
+
 """Augmentations"""
 tf.flags.DEFINE_bool(
     'augment', True, """whether to apply augment""")
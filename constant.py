@@ -6,6 +6,10 @@ IM_HEIGHT = 128
 IM_WIDTH = 128
 IM_CHAN = 3
 NAME_MODEL = 'model-tgs-salt-1.h5'
+NAME_HISTORY = 'history.csv'
+# per-epoch history of evaluator.py with --async_valid
+NAME_VALID_HISTORY = 'valid_history.csv'
+VALID_MONITOR = 'val_mean_score'
 N_SPLITS = 5
 BATCH_SIZE = 8
 INPUT_WORKERS = 4
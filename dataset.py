@@ -1,15 +1,13 @@
 import os
 import sys
+import csv
 
-import cv2
 import numpy as np
-from sklearn.model_selection import KFold
-from tqdm import tqdm_notebook
-from tensorflow.keras.preprocessing.image import img_to_array, ImageDataGenerator
 import tensorflow as tf
 
 from constant import *
 from random_erase import RandomErasing
+from dataset_index import DatasetIndex
 
 
 def load_img(filename, channels=3, with_depth=False):
@@ -25,7 +23,9 @@ def _load_img(filename, channels=3):
     return image
 
 def _load_img_with_depth(filename):
-    image = tf.cast(_load_img(filename, channels=1), tf.float32)
+    return _add_depth(_load_img(filename, channels=1))
+
+def _add_depth(image):
     depth = tf.tile(tf.reshape(tf.lin_space(0.0, 255.0, ORIG_HEIGHT), shape=(ORIG_HEIGHT, 1, 1)), (1, ORIG_WIDTH, 1))
     near_right = tf.reshape(tf.lin_space(0.0, 1.0, ORIG_WIDTH), shape=(1, ORIG_WIDTH, 1))
     near_left = tf.reshape(tf.lin_space(1.0, 0.0, ORIG_WIDTH), shape=(1, ORIG_WIDTH, 1))
@@ -64,39 +64,24 @@ def rotate(image, angle, interpolation='NEARESET'):
     return image
 
 
-class Dataset(object):
-    def __init__(self, path_input):
-        self.path_input = path_input
-        id_samples = next(os.walk(os.path.join(self.path_input, "images")))[2]
-        id_samples = sorted(id_samples)
-        self.id_samples = id_samples
-
-    def __len__(self):
-        return len(self.id_samples)
-
-    def _get_fg_sum(self, id_samples):
-        paths_y = [os.path.join(self.path_input, 'masks', idx) for idx in self.id_samples]
-        return {idx:np.sum(cv2.imread(os.path.join(self.path_input, 'masks', idx), cv2.IMREAD_GRAYSCALE)) for idx in id_samples}
-
-    def kfold_split(self, n_splits, idx_kfold):
-        assert n_splits > idx_kfold
-        id_samples = np.array(self.id_samples)
-        fg_sum = self._get_fg_sum(id_samples)
-        id_samples = np.array(sorted(id_samples, key=lambda idx: (fg_sum[idx], idx)))
-        num_samples = len(self)
-        valid_index = range(idx_kfold, num_samples, n_splits)
-        train_index = list(set(range(num_samples)) - set(valid_index))
-        id_train = id_samples[train_index]
-        id_valid = id_samples[valid_index]
-        return id_train, id_valid
-
-    def len_train_valid(self, n_splits, idx_kfold):
-        num_samples = len(self)
-        valid_index = np.arange(idx_kfold, num_samples, n_splits)
-        train_index = list(set(np.arange(num_samples)) - set(valid_index))
-        return len(train_index), len(valid_index)
-
-    def gen_test(self, adjust='resize', batch_size=32, repeat=1, with_path=True, with_depth=False):
+class Dataset(DatasetIndex):
+    def load_img(self, filename, channels=3, with_depth=False):
+        if self.store is None:
+            return load_img(filename, channels=channels, with_depth=with_depth)
+
+        image = tf.py_func(lambda f: self.store.read(f.decode('utf-8')), [filename], tf.uint8, stateful=False)
+        image.set_shape((ORIG_HEIGHT, ORIG_WIDTH, None))
+        if with_depth:
+            return _add_depth(image[:, :, :1])
+        stored_channels = tf.shape(image)[2]
+        image = tf.cond(tf.equal(stored_channels, channels),
+                        lambda: image,
+                        lambda: tf.tile(image[:, :, :1], (1, 1, channels)))
+        image.set_shape((ORIG_HEIGHT, ORIG_WIDTH, channels))
+        return image
+
+    def gen_test(self, adjust='resize', batch_size=32, repeat=1, with_path=True, with_depth=False,
+                 target_shape=(IM_HEIGHT, IM_WIDTH)):
 
         paths_test_x = [os.path.join(self.path_input, 'images', idx) for idx in self.id_samples]
 
@@ -104,27 +89,27 @@ class Dataset(object):
 
         if with_path:
             def _load_normalize(path_image):
-                image = load_img(path_image, channels=IM_CHAN, with_depth=with_depth)
+                image = self.load_img(path_image, channels=IM_CHAN, with_depth=with_depth)
                 return normalize(image), path_image
 
             def _adjust(image, path_image):
                 if adjust == 'resize':
-                    image = resize(image, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.BILINEAR)
+                    image = resize(image, target_shape=target_shape, method=tf.image.ResizeMethod.BILINEAR)
                 elif adjust in ['reflect', 'constant', 'symmetric']:
-                    image = pad(image, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
+                    image = pad(image, target_shape=target_shape, mode=adjust)
                 else:
                     raise ValueError("adjust-mode {} is not supported".format(adjust))
                 return image, path_image
         else:
             def _load_normalize(path_image):
-                image = load_img(path_image, channels=IM_CHAN)
+                image = self.load_img(path_image, channels=IM_CHAN)
                 return normalize(image)
 
             def _adjust(image):
                 if adjust == 'resize':
-                    image = resize(image, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.BILINEAR)
+                    image = resize(image, target_shape=target_shape, method=tf.image.ResizeMethod.BILINEAR)
                 elif adjust in ['reflect', 'constant', 'symmetric']:
-                    image = pad(image, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
+                    image = pad(image, target_shape=target_shape, mode=adjust)
                 return image
 
         dataset_test = dataset_test.map(_load_normalize, num_parallel_calls=8)
@@ -135,7 +120,8 @@ class Dataset(object):
         iter_test = dataset_test.make_one_shot_iterator()
         return iter_test
 
-    def gen_valid(self, n_splits, idx_kfold, adjust='resize', batch_size=32, repeat=1, with_path=True, with_depth=False):
+    def gen_valid(self, n_splits, idx_kfold, adjust='resize', batch_size=32, repeat=1, with_path=True, with_depth=False,
+                  target_shape=(IM_HEIGHT, IM_WIDTH)):
         id_train, id_valid = self.kfold_split(n_splits, idx_kfold)
 
         paths_valid_x = [os.path.join(self.path_input, 'images', idx) for idx in id_valid]
@@ -147,37 +133,37 @@ class Dataset(object):
 
         if with_path:
             def _load_normalize(path_image, path_mask):
-                image = load_img(path_image, channels=IM_CHAN, with_depth=with_depth)
-                mask = load_img(path_mask, channels=1)
+                image = self.load_img(path_image, channels=IM_CHAN, with_depth=with_depth)
+                mask = self.load_img(path_mask, channels=1)
                 return normalize(image), normalize(mask), path_image
 
             def _adjust(image, mask, path_image):
                 if adjust == 'never':
                     return image, mask, path_image
                 elif adjust == 'resize':
-                    image = resize(image, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.BILINEAR)
-                    mask = resize(mask, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.BILINEAR)
+                    image = resize(image, target_shape=target_shape, method=tf.image.ResizeMethod.BILINEAR)
+                    mask = resize(mask, target_shape=target_shape, method=tf.image.ResizeMethod.BILINEAR)
                 elif adjust in ['reflect', 'constant', 'symmetric']:
-                    image = pad(image, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
-                    mask = pad(mask, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
+                    image = pad(image, target_shape=target_shape, mode=adjust)
+                    mask = pad(mask, target_shape=target_shape, mode=adjust)
                 else:
                     raise ValueError("adjust-mode {} is not supported".format(adjust))
                 return image, mask, path_image
         else:
             def _load_normalize(path_image, path_mask):
-                image = load_img(path_image, channels=IM_CHAN)
-                mask = load_img(path_mask, channels=IM_CHAN)
+                image = self.load_img(path_image, channels=IM_CHAN)
+                mask = self.load_img(path_mask, channels=IM_CHAN)
                 return normalize(image), normalize(mask)
 
             def _adjust(image, mask):
                 if adjust == 'never':
                     return image, mask
                 elif adjust == 'resize':
-                    image = resize(image, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.BILINEAR)
-                    mask = resize(mask, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.BILINEAR)
+                    image = resize(image, target_shape=target_shape, method=tf.image.ResizeMethod.BILINEAR)
+                    mask = resize(mask, target_shape=target_shape, method=tf.image.ResizeMethod.BILINEAR)
                 elif adjust in ['reflect', 'constant', 'symmetric']:
-                    image = pad(image, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
-                    mask = pad(mask, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
+                    image = pad(image, target_shape=target_shape, mode=adjust)
+                    mask = pad(mask, target_shape=target_shape, mode=adjust)
                 else:
                     raise ValueError("adjust-mode {} is not supported".format(adjust))
                 return image, mask
@@ -193,61 +179,56 @@ class Dataset(object):
     def gen_train_valid(self, n_splits, idx_kfold,
                         adjust='resize', weight_fg=1.0, weight_bg=1.0, weight_adaptive=None,
                         batch_size=32, filter_vert_hori=True, ignore_tiny=0.0, deep_supervised=False, augment_dict=None,
-                        repeat=None, mask_padding=True, with_depth=False):
+                        repeat=None, mask_padding=True, with_depth=False, target_shape=(IM_HEIGHT, IM_WIDTH)):
         id_train, id_valid = self.kfold_split(n_splits, idx_kfold)
+        if filter_vert_hori:
+            id_train, id_valid = self.filter_vert_hori(id_train), self.filter_vert_hori(id_valid)
+        target_height, target_width = target_shape
 
         paths_train_x = [os.path.join(self.path_input, 'images', idx) for idx in id_train]
         paths_train_y = [os.path.join(self.path_input, 'masks', idx) for idx in id_train]
         paths_valid_x = [os.path.join(self.path_input, 'images', idx) for idx in id_valid]
         paths_valid_y = [os.path.join(self.path_input, 'masks', idx) for idx in id_valid]
 
+        # weight of foreground/background per sample, weight map is created from them in _create_weight
+        use_weight = not (weight_fg == 1.0 and weight_bg == 1.0 and weight_adaptive is None)
+        weight_params_train = self.weight_params(id_train, weight_fg, weight_bg, weight_adaptive)
+        weight_params_valid = self.weight_params(id_valid, weight_fg, weight_bg, weight_adaptive)
+
         dataset_train_x = tf.data.Dataset.from_tensor_slices(paths_train_x)
         dataset_train_y = tf.data.Dataset.from_tensor_slices(paths_train_y)
+        dataset_train_w = tf.data.Dataset.from_tensor_slices(weight_params_train)
         dataset_valid_x = tf.data.Dataset.from_tensor_slices(paths_valid_x)
         dataset_valid_y = tf.data.Dataset.from_tensor_slices(paths_valid_y)
-        dataset_train  = tf.data.Dataset.zip((dataset_train_x, dataset_train_y))
-        dataset_valid  = tf.data.Dataset.zip((dataset_valid_x, dataset_valid_y))
-
-        def _load_normalize(path_image, path_mask):
-            image = load_img(path_image, channels=IM_CHAN, with_depth=with_depth)
-            mask = load_img(path_mask, channels=1)
-            return normalize(image), normalize(mask)
-
-        def _filter_vert_hori(image, mask):
-            is_filled = tf.reduce_all(tf.equal(mask, 1.0))
-            is_empty = tf.reduce_all(tf.equal(mask, 0.0))
-            is_uniform = tf.logical_or(is_filled, is_empty)
-            vert_mean = tf.reduce_mean(mask, axis=0)
-            hori_mean = tf.reduce_mean(mask, axis=1)
-            is_vertical = tf.reduce_all(tf.logical_xor(tf.equal(vert_mean, 0.0), tf.equal(vert_mean, 1.0)))
-            is_horizontal = tf.reduce_all(tf.logical_xor(tf.equal(hori_mean, 0.0), tf.equal(hori_mean, 1.0)))
-            is_vert_or_hori = tf.logical_or(is_vertical, is_horizontal)
-            return tf.logical_or(is_uniform, tf.logical_not(is_vert_or_hori))
-
-        def _create_weight(image, mask):
-            weight = tf.ones_like(mask, dtype=tf.float32)
-            if weight_fg == 1.0 and weight_bg == 1.0 and weight_adaptive is None:
-                pass
-            elif weight_adaptive is None:
-                fg = tf.ones_like(mask) * weight_fg
-                bg = tf.ones_like(mask) * weight_bg
-                weight = tf.where(mask > 0.5, fg, bg)
-            elif weight_adaptive is not None:
-                raise NotImplementedError()
+        dataset_valid_w = tf.data.Dataset.from_tensor_slices(weight_params_valid)
+        dataset_train  = tf.data.Dataset.zip((dataset_train_x, dataset_train_y, dataset_train_w))
+        dataset_valid  = tf.data.Dataset.zip((dataset_valid_x, dataset_valid_y, dataset_valid_w))
+
+        def _load_normalize(path_image, path_mask, weight_param):
+            image = self.load_img(path_image, channels=IM_CHAN, with_depth=with_depth)
+            mask = self.load_img(path_mask, channels=1)
+            return normalize(image), normalize(mask), weight_param
+
+        def _create_weight(image, mask, weight_param):
+            if not use_weight:
+                weight = tf.ones_like(mask, dtype=tf.float32)
+            else:
+                fg, bg = weight_param[0], weight_param[1]
+                weight = bg + (fg - bg) * tf.cast(mask > 0.5, tf.float32)
             return image, mask, weight
 
         def _adjust(image, mask, weight):
             if adjust == 'resize':
-                image = resize(image, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.BILINEAR)
-                mask = resize(mask, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
-                weight = resize(weight, target_shape=(IM_HEIGHT, IM_WIDTH), method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+                image = resize(image, target_shape=target_shape, method=tf.image.ResizeMethod.BILINEAR)
+                mask = resize(mask, target_shape=target_shape, method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+                weight = resize(weight, target_shape=target_shape, method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
             elif adjust in ['reflect', 'constant', 'symmetric']:
-                image = pad(image, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
-                mask = pad(mask, target_shape=(IM_HEIGHT, IM_WIDTH), mode=adjust)
+                image = pad(image, target_shape=target_shape, mode=adjust)
+                mask = pad(mask, target_shape=target_shape, mode=adjust)
                 if mask_padding:
-                    weight = pad(weight, target_shape=(IM_HEIGHT, IM_WIDTH), mode='CONSTANT')
+                    weight = pad(weight, target_shape=target_shape, mode='CONSTANT')
                 else:
-                    weight = pad(weight, target_shape=(IM_HEIGHT, IM_WIDTH), mode='CONSTANT', constant_values=1.0)
+                    weight = pad(weight, target_shape=target_shape, mode='CONSTANT', constant_values=1.0)
             else:
                 raise ValueError("adjust-mode {} is not supported".format(adjust))
             return image, mask, weight
@@ -261,10 +242,10 @@ class Dataset(object):
             top_scale = tf.random_uniform((), minval=1.0-max_delta, maxval=1.0+max_delta, dtype=tf.float32)
             bottom_scale = tf.random_uniform((), minval=1.0-max_delta, maxval=1.0+max_delta, dtype=tf.float32)
 
-            horizontal_gradation = tf.reshape(tf.lin_space(left_scale, right_scale, num=IM_WIDTH), shape=(1, IM_WIDTH, 1))
-            vertical_gradation = tf.reshape(tf.lin_space(top_scale, bottom_scale, num=IM_HEIGHT), shape=(IM_HEIGHT, 1, 1))
-            horizontal_gradation = tf.tile(horizontal_gradation, (IM_HEIGHT, 1, 1))
-            vertical_gradation = tf.tile(vertical_gradation, (1, IM_WIDTH, 1))
+            horizontal_gradation = tf.reshape(tf.lin_space(left_scale, right_scale, num=target_width), shape=(1, target_width, 1))
+            vertical_gradation = tf.reshape(tf.lin_space(top_scale, bottom_scale, num=target_height), shape=(target_height, 1, 1))
+            horizontal_gradation = tf.tile(horizontal_gradation, (target_height, 1, 1))
+            vertical_gradation = tf.tile(vertical_gradation, (1, target_width, 1))
             image = image * (horizontal_gradation * vertical_gradation)
             # image = tf.tile((horizontal_gradation * vertical_gradation),(1,1,3))
             return image
@@ -273,11 +254,11 @@ class Dataset(object):
             orig_height, orig_width, orig_channels = image.get_shape().as_list()
             height_shift_range = height_shift_range if height_shift_range is not None else 0.0
             width_shift_range = width_shift_range if width_shift_range is not None else 0.0
-            target_height = tf.cast(IM_HEIGHT * (1+height_shift_range), dtype=tf.int32)
-            target_width = tf.cast(IM_WIDTH * (1+width_shift_range), dtype=tf.int32)
-            image = pad(image, target_shape=(target_height, target_width), mode=mode, set_shape=False)
-            mask = pad(mask, target_shape=(target_height, target_width), mode='CONSTANT', set_shape=False)
-            weight = pad(weight, target_shape=(target_height, target_width), mode='CONSTANT', set_shape=False)
+            shift_height = tf.cast(target_height * (1+height_shift_range), dtype=tf.int32)
+            shift_width = tf.cast(target_width * (1+width_shift_range), dtype=tf.int32)
+            image = pad(image, target_shape=(shift_height, shift_width), mode=mode, set_shape=False)
+            mask = pad(mask, target_shape=(shift_height, shift_width), mode='CONSTANT', set_shape=False)
+            weight = pad(weight, target_shape=(shift_height, shift_width), mode='CONSTANT', set_shape=False)
             image, mask, weight = _rand_crop(image, mask, weight, orig_height, orig_width)
             return image, mask, weight
 
@@ -334,14 +315,15 @@ class Dataset(object):
             randomized = tf.where(randomize_mask, values, image)
             return randomized
 
-        def _mixup(images, masks):
+        def _mixup(images, masks, weight_params):
             alpha = augment_dict['mixup']
             dist_beta = tf.distributions.Beta(alpha, alpha)
             lam = dist_beta.sample((1,1,1,1))
             mixup_factor = tf.concat([lam, 1-lam], axis=0)
             image = tf.reduce_sum(images * mixup_factor, axis=0, keepdims=False)
             mask = tf.reduce_sum(masks * mixup_factor, axis=0, keepdims=False)
-            return image, mask
+            weight_param = tf.reduce_sum(weight_params * tf.reshape(mixup_factor, (2, 1)), axis=0, keepdims=False)
+            return image, mask, weight_param
 
         def _rand_crop(image, mask, weight, target_height, target_width):
             orig_shape = tf.shape(image)
@@ -389,14 +371,14 @@ class Dataset(object):
             if augment_dict['zoom_range'] is not None and augment_dict['zoom_range'] != 0.0:
                 zoom_range = augment_dict['zoom_range']
                 zoom = tf.random_uniform((), (1-zoom_range), (1+zoom_range), dtype=tf.float32)
-                target_height = tf.cast(IM_HEIGHT * zoom, dtype=tf.int32)
-                target_width = tf.cast(IM_WIDTH * zoom, dtype=tf.int32)
-                image = tf.image.resize_images(image, size=(target_height, target_width))
-                mask = tf.image.resize_images(mask, size=(target_height, target_width))
-                weight = tf.image.resize_images(weight, size=(target_height, target_width))
+                zoom_height = tf.cast(target_height * zoom, dtype=tf.int32)
+                zoom_width = tf.cast(target_width * zoom, dtype=tf.int32)
+                image = tf.image.resize_images(image, size=(zoom_height, zoom_width))
+                mask = tf.image.resize_images(mask, size=(zoom_height, zoom_width))
+                weight = tf.image.resize_images(weight, size=(zoom_height, zoom_width))
                 image, mask, weight = tf.cond(zoom>1.0,
-                                              true_fn=lambda:_rand_crop(image, mask, weight, IM_HEIGHT, IM_WIDTH),
-                                              false_fn=lambda:_pad(image, mask, weight, IM_HEIGHT, IM_WIDTH, mode=mode), strict=True)
+                                              true_fn=lambda:_rand_crop(image, mask, weight, target_height, target_width),
+                                              false_fn=lambda:_pad(image, mask, weight, target_height, target_width, mode=mode), strict=True)
             if augment_dict['rotation_range'] is not None:
                 rot = augment_dict['rotation_range'] * np.math.pi / 180
                 angle = tf.random_uniform((), -rot, rot, dtype=tf.float32)
@@ -444,9 +426,6 @@ class Dataset(object):
         dataset_train = dataset_train.shuffle(len(id_train))
         dataset_train = dataset_train.map(_load_normalize, num_parallel_calls)
 
-        if filter_vert_hori:
-            dataset_train = dataset_train.filter(_filter_vert_hori)
-
         if augment_dict is not None and augment_dict['mixup'] is not None:
             dataset_train = dataset_train.batch(2)
             dataset_train = dataset_train.map(_mixup, num_parallel_calls)
@@ -470,9 +449,6 @@ class Dataset(object):
         dataset_valid = dataset_valid.shuffle(len(id_valid), seed=17)
         dataset_valid = dataset_valid.map(_load_normalize, num_parallel_calls)
 
-        if filter_vert_hori:
-            dataset_valid = dataset_valid.filter(_filter_vert_hori)
-
         dataset_valid = dataset_valid.map(_create_weight, num_parallel_calls)
         dataset_valid = dataset_valid.map(_adjust, num_parallel_calls)
 
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ids, folds and mask statistics of a dataset, without TensorFlow
+
+Tools which only need the samples of a fold, such as scoring and visualization,
+use DatasetIndex instead of `dataset.Dataset` to keep their startup fast.
+"""
+
+import os
+
+import numpy as np
+
+from constant import *
+from dataset_service import DecodedStore
+import mask_stats
+
+
+def coverage_weight_params(coverage, weight_fg=1.0, weight_bg=1.0, weight_adaptive=None, num=None):
+    """Return (N, 2) array of foreground and background weight of each sample from coverage of its mask
+
+    weight_adaptive=[coverage_min, coverage_max] balances foreground and background of masks
+    whose coverage is not larger than coverage_max. `coverage` may be None without weight_adaptive.
+    """
+    params = np.empty((len(coverage) if coverage is not None else num, 2), dtype=np.float32)
+    if weight_adaptive is None:
+        params[:] = (weight_fg, weight_bg)
+        return params
+
+    # below coverage_min, the weights are the same 0.5/coverage and 0.5/(1-coverage)
+    _, tmax = weight_adaptive
+    adaptive = (coverage > 0.0) & (coverage < 1.0) & (coverage <= tmax)
+    params[:] = 1.0
+    params[adaptive, 0] = 0.5 / coverage[adaptive]
+    params[adaptive, 1] = 0.5 / (1.0 - coverage[adaptive])
+    assert np.all(np.isfinite(params))
+    return params
+
+
+class DatasetIndex(object):
+    def __init__(self, path_input, backend='file', path_decoded=None, exclude_vert_hori=False):
+        """
+        backend:
+            'file': decode png files in the pipeline
+            'memmap': read arrays decoded once by `dataset_service`, shared by concurrent processes
+        exclude_vert_hori: exclude samples of vertical/horizontal masks found by the mask manifest
+        """
+        self.path_input = path_input
+        id_samples = next(os.walk(os.path.join(self.path_input, "images")))[2]
+        id_samples = sorted(id_samples)
+        self.id_samples = id_samples
+        self._mask_stats = None
+        if backend == 'file':
+            self.store = None
+        elif backend == 'memmap':
+            self.store = DecodedStore.open(path_input, path_decoded)
+        else:
+            raise ValueError("backend {} is not supported".format(backend))
+        if exclude_vert_hori:
+            self.id_samples = self.filter_vert_hori(self.id_samples)
+
+    def __len__(self):
+        return len(self.id_samples)
+
+    def mask_stats(self):
+        """Statistics and shape classes of each mask, computed once and stored beside the masks (see mask_stats.py)"""
+        if self._mask_stats is not None:
+            return self._mask_stats
+        path_stats = mask_stats.default_path(self.path_input)
+        stats = mask_stats.read(path_stats)
+        if stats is not None and set(self.id_samples) <= set(stats.keys()):
+            self._mask_stats = stats
+            return stats
+
+        masks = None
+        if self.store is not None:
+            masks = self.store.masks[[self.store.rows[idx] for idx in self.id_samples]]
+        stats = mask_stats.compute(self.path_input, self.id_samples, masks=masks)
+        try:
+            mask_stats.write(path_stats, stats)
+        except OSError:
+            print("Failed to write {}, mask statistics are not cached".format(path_stats))
+        self._mask_stats = stats
+        return stats
+
+    def filter_vert_hori(self, id_samples):
+        """Exclude ids of vertical/horizontal masks, which are not uniform"""
+        stats = self.mask_stats()
+        return [idx for idx in id_samples if not mask_stats.is_vert_hori(stats[idx])]
+
+    def _get_fg_sum(self, id_samples):
+        stats = self.mask_stats()
+        return {idx: stats[idx]['fg_sum'] for idx in id_samples}
+
+    def weight_params(self, id_samples, weight_fg=1.0, weight_bg=1.0, weight_adaptive=None):
+        """Return (N, 2) array of foreground and background weight of each sample
+
+        See `coverage_weight_params` for weight_adaptive, coverage is read from the mask stats.
+        """
+        coverage = None
+        if weight_adaptive is not None:
+            stats = self.mask_stats()
+            coverage = np.array([stats[idx]['coverage'] for idx in id_samples], dtype=np.float64)
+        return coverage_weight_params(coverage, weight_fg, weight_bg, weight_adaptive, num=len(id_samples))
+
+    def kfold_split(self, n_splits, idx_kfold):
+        assert n_splits > idx_kfold
+        id_samples = np.array(self.id_samples)
+        fg_sum = self._get_fg_sum(id_samples)
+        id_samples = np.array(sorted(id_samples, key=lambda idx: (fg_sum[idx], idx)))
+        num_samples = len(self)
+        valid_index = range(idx_kfold, num_samples, n_splits)
+        train_index = list(set(range(num_samples)) - set(valid_index))
+        id_train = id_samples[train_index]
+        id_valid = id_samples[valid_index]
+        return id_train, id_valid
+
+    def len_train_valid(self, n_splits, idx_kfold):
+        num_samples = len(self)
+        valid_index = np.arange(idx_kfold, num_samples, n_splits)
+        train_index = list(set(np.arange(num_samples)) - set(valid_index))
+        return len(train_index), len(valid_index)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Decoded images and masks shared by concurrent processes
+
+Images and masks of an input directory are decoded once into .npy files with an id index.
+Processes open them as read-only memmaps, so they share one copy in the page cache
+(use a directory in /dev/shm to keep it in shared memory).
+"""
+
+import os
+import json
+import fcntl
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+from absl import app, flags
+
+from constant import *
+from util import files_digest
+
+INDEX_FILENAME = "index.json"
+LOCK_FILENAME = ".lock"
+DECODED_DIRNAME = "decoded"
+
+
+def default_path(path_input):
+    return os.path.join(path_input, DECODED_DIRNAME)
+
+
+def _signature(path_input, ids):
+    """Identify inputs by ids with size and modification time of each of their files"""
+    kinds = [kind for kind in ['images', 'masks'] if os.path.isdir(os.path.join(path_input, kind))]
+    return {'path_input': os.path.abspath(path_input), 'num_samples': len(ids),
+            'files': files_digest(path_input, ids, kinds)}
+
+
+def _decode(args):
+    path_image, path_mask = args
+    image = cv2.cvtColor(cv2.imread(path_image, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    mask = cv2.imread(path_mask, cv2.IMREAD_GRAYSCALE) if path_mask is not None else None
+    return image, mask
+
+
+def list_ids(path_input):
+    return sorted(next(os.walk(os.path.join(path_input, "images")))[2])
+
+
+def is_valid(path_decoded, path_input):
+    path_index = os.path.join(path_decoded, INDEX_FILENAME)
+    if not os.path.exists(path_index):
+        return False
+    with open(path_index) as f:
+        index = json.load(f)
+    return index['signature'] == _signature(path_input, list_ids(path_input))
+
+
+def build(path_input, path_decoded, processes=None):
+    """Decode images (and masks if exist) of `path_input` into `path_decoded`"""
+    ids = list_ids(path_input)
+    with_mask = os.path.isdir(os.path.join(path_input, 'masks'))
+    os.makedirs(path_decoded, exist_ok=True)
+    path_index = os.path.join(path_decoded, INDEX_FILENAME)
+    if os.path.exists(path_index):
+        os.remove(path_index)
+
+    def _open(name, shape):
+        return np.lib.format.open_memmap(
+            os.path.join(path_decoded, name + '.npy.tmp'), mode='w+', dtype=np.uint8, shape=(len(ids),) + shape)
+
+    images = _open('images', (ORIG_HEIGHT, ORIG_WIDTH, IM_CHAN))
+    masks = _open('masks', (ORIG_HEIGHT, ORIG_WIDTH, 1)) if with_mask else None
+
+    tasks = [(os.path.join(path_input, 'images', idx),
+              os.path.join(path_input, 'masks', idx) if with_mask else None) for idx in ids]
+    with Pool(processes) as pool:
+        for n, (image, mask) in enumerate(pool.imap(_decode, tasks, chunksize=64)):
+            images[n] = image
+            if masks is not None:
+                masks[n, :, :, 0] = mask
+
+    names = ['images', 'masks'] if with_mask else ['images']
+    for name, array in zip(names, [images, masks]):
+        array.flush()
+        os.replace(os.path.join(path_decoded, name + '.npy.tmp'), os.path.join(path_decoded, name + '.npy'))
+    del images, masks
+
+    index = {'ids': ids, 'arrays': names, 'signature': _signature(path_input, ids)}
+    with open(path_index + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path_index + '.tmp', path_index)
+
+
+class DecodedStore(object):
+    """Read-only memmaps of decoded images (N, H, W, IM_CHAN) and masks (N, H, W, 1)"""
+    def __init__(self, path_decoded):
+        self.path_decoded = path_decoded
+        with open(os.path.join(path_decoded, INDEX_FILENAME)) as f:
+            index = json.load(f)
+        self.ids = index['ids']
+        self.rows = {idx: row for row, idx in enumerate(self.ids)}
+        self.arrays = {name: np.load(os.path.join(path_decoded, name + '.npy'), mmap_mode='r')
+                       for name in index['arrays']}
+
+    @property
+    def images(self):
+        return self.arrays['images']
+
+    @property
+    def masks(self):
+        return self.arrays.get('masks')
+
+    def read(self, path):
+        """Decoded array of `path`, an image or mask file of the source directory"""
+        kind = os.path.basename(os.path.dirname(path))
+        return np.array(self.arrays[kind][self.rows[os.path.basename(path)]])
+
+    @classmethod
+    def open(cls, path_input, path_decoded=None, processes=None):
+        """Open decoded arrays of `path_input`, decoding them first if not up to date
+
+        Concurrent processes wait on a lock file so that only one of them decodes.
+        """
+        path_decoded = path_decoded if path_decoded is not None else default_path(path_input)
+        os.makedirs(path_decoded, exist_ok=True)
+        with open(os.path.join(path_decoded, LOCK_FILENAME), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not is_valid(path_decoded, path_input):
+                    print("Decoding {} into {}".format(path_input, path_decoded))
+                    build(path_input, path_decoded, processes=processes)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return cls(path_decoded)
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    store = DecodedStore.open(FLAGS.input, FLAGS.decoded, processes=FLAGS.processes)
+    size = sum(a.nbytes for a in store.arrays.values())
+    print("{} samples ({:.1f} MB) in {}".format(len(store.ids), size / 2**20, store.path_decoded))
+
+
+if __name__ == '__main__':
+    flags.DEFINE_string('input', "../input/train", """path to input data""")
+    flags.DEFINE_string('decoded', None, """path to decoded arrays (default: <input>/decoded)""")
+    flags.DEFINE_integer('processes', None, """number of decoding processes (default: number of CPUs)""")
+    app.run(main)
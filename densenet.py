@@ -44,16 +44,9 @@ from tensorflow.python.keras.layers import MaxPooling2D
 from tensorflow.python.keras.layers import ZeroPadding2D
 from tensorflow.python.keras.models import Model
 from tensorflow.python.keras.utils import layer_utils
-from tensorflow.python.keras.utils.data_utils import get_file
 from tensorflow.python.util.tf_export import tf_export
 
-
-DENSENET121_WEIGHT_PATH = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.8/densenet121_weights_tf_dim_ordering_tf_kernels.h5'
-DENSENET121_WEIGHT_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.8/densenet121_weights_tf_dim_ordering_tf_kernels_notop.h5'
-DENSENET169_WEIGHT_PATH = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.8/densenet169_weights_tf_dim_ordering_tf_kernels.h5'
-DENSENET169_WEIGHT_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.8/densenet169_weights_tf_dim_ordering_tf_kernels_notop.h5'
-DENSENET201_WEIGHT_PATH = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.8/densenet201_weights_tf_dim_ordering_tf_kernels.h5'
-DENSENET201_WEIGHT_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.8/densenet201_weights_tf_dim_ordering_tf_kernels_notop.h5'
+import weight_store
 
 
 def dense_block(x, blocks, name):
@@ -254,45 +247,16 @@ def DenseNet(blocks,
 
   # Load weights.
   if weights == 'imagenet':
-    if include_top:
-      if blocks == [6, 12, 24, 16]:
-        weights_path = get_file(
-            'densenet121_weights_tf_dim_ordering_tf_kernels.h5',
-            DENSENET121_WEIGHT_PATH,
-            cache_subdir='models',
-            file_hash='0962ca643bae20f9b6771cb844dca3b0')
-      elif blocks == [6, 12, 32, 32]:
-        weights_path = get_file(
-            'densenet169_weights_tf_dim_ordering_tf_kernels.h5',
-            DENSENET169_WEIGHT_PATH,
-            cache_subdir='models',
-            file_hash='bcf9965cf5064a5f9eb6d7dc69386f43')
-      elif blocks == [6, 12, 48, 32]:
-        weights_path = get_file(
-            'densenet201_weights_tf_dim_ordering_tf_kernels.h5',
-            DENSENET201_WEIGHT_PATH,
-            cache_subdir='models',
-            file_hash='7bb75edd58cb43163be7e0005fbe95ef')
+    if blocks == [6, 12, 24, 16]:
+      weights_name = 'densenet121'
+    elif blocks == [6, 12, 32, 32]:
+      weights_name = 'densenet169'
+    elif blocks == [6, 12, 48, 32]:
+      weights_name = 'densenet201'
     else:
-      if blocks == [6, 12, 24, 16]:
-        weights_path = get_file(
-            'densenet121_weights_tf_dim_ordering_tf_kernels_notop.h5',
-            DENSENET121_WEIGHT_PATH_NO_TOP,
-            cache_subdir='models',
-            file_hash='4912a53fbd2a69346e7f2c0b5ec8c6d3')
-      elif blocks == [6, 12, 32, 32]:
-        weights_path = get_file(
-            'densenet169_weights_tf_dim_ordering_tf_kernels_notop.h5',
-            DENSENET169_WEIGHT_PATH_NO_TOP,
-            cache_subdir='models',
-            file_hash='50662582284e4cf834ce40ab4dfa58c6')
-      elif blocks == [6, 12, 48, 32]:
-        weights_path = get_file(
-            'densenet201_weights_tf_dim_ordering_tf_kernels_notop.h5',
-            DENSENET201_WEIGHT_PATH_NO_TOP,
-            cache_subdir='models',
-            file_hash='1c2de60ee40562448dbac34a0737e798')
-    model.load_weights(weights_path)
+      raise ValueError('ImageNet weights of blocks {} are not available'.format(blocks))
+    weights_path = weight_store.get_weights_path(weights_name, include_top)
+    weight_store.load_weights(model, weights_path)
   elif weights is not None:
     model.load_weights(weights)
 
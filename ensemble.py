@@ -6,14 +6,13 @@ import subprocess
 import os
 import tempfile
 
-from scipy.misc import imsave
 from tqdm import tqdm
 import numpy as np
-import pandas as pd
 
 from absl import app, flags
 
 from util import RLenc
+from timing import StageTimer
 
 flags.DEFINE_string('input', '../input/test', """path to test data""")
 flags.DEFINE_string('submission', '../output/submission', """prefix of submission file""")
@@ -23,6 +22,9 @@ flags.DEFINE_float('threshold', 0.5, """threshold of confidence to predict foreg
 flags.DEFINE_bool('tta', False, """whether to use TTA (notta + flip-lr + flip-tb + flip-lrtb)""")
 flags.DEFINE_list('ensemble_fn', None, """ensemble_fn""")
 flags.DEFINE_bool('npz', True, """whether to save as npz""")
+flags.DEFINE_integer('top_k', 0, """number of best checkpoints per model to use (0: use saved model)""")
+flags.DEFINE_bool('average_weights', False, """whether to average weights of top_k checkpoints instead of ensembling them""")
+flags.DEFINE_string('timing', None, """path to json of time of each stage, printed as a table (default: not measured)""")
 
 
 FLAGS = flags.FLAGS
@@ -52,6 +54,18 @@ class TemporaryDirectory(tempfile.TemporaryDirectory):
             pass
 
 
+def list_weight_args(model_dir):
+    """List (suffix, predict.py arguments) of weights to predict with for a model directory"""
+    if FLAGS.top_k == 0:
+        return [("", [])]
+    # checkpoint imports TensorFlow, which is needed only to select checkpoints
+    from checkpoint import list_checkpoints, CHECKPOINT_DIRNAME
+    paths = list_checkpoints(os.path.join(model_dir, CHECKPOINT_DIRNAME), FLAGS.top_k)
+    if FLAGS.average_weights:
+        return [("-avg", ["--checkpoint", ",".join(paths)])]
+    return [("-ckpt{}".format(i), ["--checkpoint", path]) for i, path in enumerate(paths)]
+
+
 def load_npz(path_pred):
     npzfile = np.load(path_pred)
     return npzfile['arr_0']
@@ -63,7 +77,10 @@ def save_npz(y_pred, id, path_out):
 
 def main(argv):
 
-    model_dirs = list_model(FLAGS.model)
+    timer = StageTimer(enabled=FLAGS.timing is not None)
+
+    with timer.stage('file listing'):
+        model_dirs = list_model(FLAGS.model)
     pred_arg_template = ["python", "predict.py", "--input", FLAGS.input, '--npz'] + argv[1:]
 
     # Predict with each model
@@ -72,27 +89,31 @@ def main(argv):
         path_preds = []
         for d in model_dirs:
             dirname = os.path.basename(os.path.dirname(d))
-            path_pred = os.path.join(tdir, dirname)
-            pred_arg = pred_arg_template + ["--model", d, "--prediction", path_pred]
-            print("pred args is {}".format(' '.join(pred_arg)))
-            subprocess.run(pred_arg)
-            path_preds.append(path_pred)
-            if FLAGS.tta:
-                pred_arg = pred_arg_template + ["--model", d, "--prediction", path_pred + "-fliplr", "--horizontal_flip"]
-                print("pred args is {}".format(' '.join(pred_arg)))
-                subprocess.run(pred_arg)
-                pred_arg = pred_arg_template + ["--model", d, "--prediction", path_pred + "-fliptb", "--vertical_flip"]
-                print("pred args is {}".format(' '.join(pred_arg)))
-                subprocess.run(pred_arg)
-                pred_arg = pred_arg_template + ["--model", d, "--prediction", path_pred + "-fliplrtb",
-                                                "--horizontal_flip", "--vertical_flip"]
+            for suffix, weight_arg in list_weight_args(d):
+                path_pred = os.path.join(tdir, dirname + suffix)
+                pred_arg = pred_arg_template + weight_arg + ["--model", d, "--prediction", path_pred]
                 print("pred args is {}".format(' '.join(pred_arg)))
-                subprocess.run(pred_arg)
-
-                path_preds.append(path_pred + "-fliplr")
-                path_preds.append(path_pred + "-fliptb")
-                path_preds.append(path_pred + "-fliplrtb")
-
+                with timer.stage('predict'):
+                    subprocess.run(pred_arg)
+                path_preds.append(path_pred)
+                if FLAGS.tta:
+                    pred_arg = pred_arg_template + weight_arg + ["--model", d, "--prediction", path_pred + "-fliplr", "--horizontal_flip"]
+                    print("pred args is {}".format(' '.join(pred_arg)))
+                    with timer.stage('predict'):
+                        subprocess.run(pred_arg)
+                    pred_arg = pred_arg_template + weight_arg + ["--model", d, "--prediction", path_pred + "-fliptb", "--vertical_flip"]
+                    print("pred args is {}".format(' '.join(pred_arg)))
+                    with timer.stage('predict'):
+                        subprocess.run(pred_arg)
+                    pred_arg = pred_arg_template + weight_arg + ["--model", d, "--prediction", path_pred + "-fliplrtb",
+                                                                 "--horizontal_flip", "--vertical_flip"]
+                    print("pred args is {}".format(' '.join(pred_arg)))
+                    with timer.stage('predict'):
+                        subprocess.run(pred_arg)
+
+                    path_preds.append(path_pred + "-fliplr")
+                    path_preds.append(path_pred + "-fliptb")
+                    path_preds.append(path_pred + "-fliplrtb")
 
         fn_dict = {"min": np.min, "max": np.max, "mean": np.mean, "median": np.median}
         if FLAGS.ensemble_fn is not None:
@@ -106,36 +127,50 @@ def main(argv):
                 img_dir = os.path.join(tdir, 'ensemble-{}'.format(suffix))
                 os.makedirs(img_dir, exist_ok=True)
 
-            ensemble_pred(path_preds, output_file, fn, img_dir)
+            ensemble_pred(path_preds, output_file, fn, img_dir, timer)
+
+    timer.report(FLAGS.timing)
 
 
-def ensemble_pred(path_preds, output_file, fn, img_dir=None):
+def ensemble_pred(path_preds, output_file, fn, img_dir=None, timer=None):
+    import pandas as pd
+    from scipy.misc import imsave
+
+    timer = timer if timer is not None else StageTimer(enabled=False)
     pred_dict = {}
-    pred_files = list(filter(lambda x: x.endswith('.npz'), os.listdir(path_preds[0])))
+    with timer.stage('file listing'):
+        pred_files = list(filter(lambda x: x.endswith('.npz'), os.listdir(path_preds[0])))
 
     for pred_file in tqdm(pred_files, ascii=True):
         preds = []
-        for d in path_preds:
-            path_pred = os.path.join(d, pred_file)
-            pred = load_npz(path_pred)
-            preds.append(pred)
-        preds = np.stack(preds, axis=2).astype(np.float)
-        ensembled = fn(preds, axis=2)
-
-        pred_dict.update({pred_file[:-4]: RLenc((ensembled > FLAGS.threshold).astype(np.float))})
+        with timer.stage('npz read', len(path_preds)):
+            for d in path_preds:
+                path_pred = os.path.join(d, pred_file)
+                pred = load_npz(path_pred)
+                preds.append(pred)
+        with timer.stage('ensemble'):
+            preds = np.stack(preds, axis=2).astype(np.float)
+            ensembled = fn(preds, axis=2)
+
+        with timer.stage('rle'):
+            pred_dict.update({pred_file[:-4]: RLenc((ensembled > FLAGS.threshold).astype(np.float))})
+        timer.count(1)
 
         if img_dir is not None:
             y_pred = np.clip(ensembled * 255, 0, 255).astype(np.uint8)
             filename = os.path.join(img_dir, os.path.splitext(pred_file)[0] + '.png')
-            imsave(filename, y_pred)
+            with timer.stage('png write'):
+                imsave(filename, y_pred)
             if FLAGS.npz:
-                save_npz(ensembled, pred_file, img_dir)
+                with timer.stage('npz write'):
+                    save_npz(ensembled, pred_file, img_dir)
 
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    sub = pd.DataFrame.from_dict(pred_dict, orient='index')
-    sub.index.names = ['id']
-    sub.columns = ['rle_mask']
-    sub.to_csv(output_file)
+    with timer.stage('csv write', len(pred_dict)):
+        sub = pd.DataFrame.from_dict(pred_dict, orient='index')
+        sub.index.names = ['id']
+        sub.columns = ['rle_mask']
+        sub.to_csv(output_file)
 
 
 if __name__ == '__main__':
@@ -15,7 +15,7 @@ from metrics import weighted_bce_dice_loss, weighted_binary_crossentropy
 from constant import *
 import config_eval
 from model import compile_model
-from util import get_metrics, get_custom_objects
+from util import get_metrics, get_custom_objects, load_input_size
 
 FLAGS = tf.flags.FLAGS
 
@@ -39,7 +39,8 @@ def eval(dataset):
         iter_train, iter_valid = dataset.gen_train_valid(
             n_splits=N_SPLITS, idx_kfold=FLAGS.cv, batch_size=FLAGS.batch_size, adjust=FLAGS.adjust,
             weight_fg=FLAGS.weight_fg, weight_bg=FLAGS.weight_bg, weight_adaptive=weight_adaptive, repeat=1,
-            filter_vert_hori=False, deep_supervised=FLAGS.deep_supervised, with_depth=FLAGS.with_depth)
+            filter_vert_hori=False, deep_supervised=FLAGS.deep_supervised, with_depth=FLAGS.with_depth,
+            target_shape=load_input_size(FLAGS.model))
 
         num_train, num_valid = dataset.len_train_valid(N_SPLITS, FLAGS.cv)
 
@@ -85,7 +86,8 @@ def search_best_threshod(model, sess, iterator, steps):
 
 
 def main(argv=None):
-    dataset = Dataset(FLAGS.input)
+    dataset = Dataset(FLAGS.input, backend=FLAGS.backend, path_decoded=FLAGS.decoded,
+                      exclude_vert_hori=FLAGS.exclude_vert_hori)
     eval(dataset)
 
 
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous validation of checkpoints saved by train.py --async_valid
+
+Validation data is decoded once and held in memory. Every new checkpoint is scored by a vectorized metric,
+written to TensorBoard, and the best one is kept with a pointer file.
+"""
+
+import os
+import csv
+import json
+import glob
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+from tensorflow.keras.models import load_model
+
+from dataset import Dataset
+from scoring import mean_score_batch
+from constant import *
+from util import sigmoid, load_input_size
+from checkpoint import ASYNC_DIRNAME, ASYNC_MODEL, ASYNC_DONE, ASYNC_BEST, restore_checkpoint, load_best_pointer
+import config
+
+tf.flags.DEFINE_string(
+    'log', '../output/log', """path to log directory""")
+
+tf.flags.DEFINE_float(
+    'threshold', 0.5, """threshold of confidence to predict foreground""")
+
+tf.flags.DEFINE_float(
+    'poll_interval', 10.0, """seconds between checks of new checkpoints""")
+
+tf.flags.DEFINE_integer(
+    'parent_pid', None, """pid of training process, evaluator exits when it is gone""")
+
+tf.flags.DEFINE_bool(
+    'keep_checkpoints', False, """whether to keep checkpoints which are not the best""")
+
+FLAGS = tf.flags.FLAGS
+
+VALID_LOG_DIRNAME = "async_valid"
+
+
+def load_valid(dataset, target_shape):
+    """Decode validation images adjusted to model input and masks of original size once"""
+    with tf.Graph().as_default():
+        iter_image = dataset.gen_valid(
+            N_SPLITS, FLAGS.cv, adjust=FLAGS.adjust, batch_size=FLAGS.batch_size, with_depth=FLAGS.with_depth,
+            target_shape=target_shape)
+        iter_mask = dataset.gen_valid(N_SPLITS, FLAGS.cv, adjust='never', batch_size=FLAGS.batch_size)
+        next_image, next_mask = iter_image.get_next(), iter_mask.get_next()
+        images, masks = [], []
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            while True:
+                try:
+                    (xs, _, _), (_, ys, _) = sess.run([next_image, next_mask])
+                except tf.errors.OutOfRangeError:
+                    break
+                images.append(xs)
+                masks.append(ys[..., 0] > 0.5)
+    return np.concatenate(images), np.concatenate(masks)
+
+
+def to_original(ys_pred, adjust):
+    """Crop or resize confidence [NHW] of model output to original size"""
+    if adjust == 'resize':
+        return np.stack([cv2.resize(y, (ORIG_WIDTH, ORIG_HEIGHT), interpolation=cv2.INTER_LINEAR) for y in ys_pred])
+    height, width = ys_pred.shape[1:3]
+    top = (height - ORIG_HEIGHT) // 2
+    left = (width - ORIG_WIDTH) // 2
+    return ys_pred[:, top:top + ORIG_HEIGHT, left:left + ORIG_WIDTH]
+
+
+def evaluate(model, path, images, masks):
+    restore_checkpoint(model, path)
+    ys_outputs = model.predict(images, batch_size=FLAGS.batch_size)
+    if FLAGS.deep_supervised:
+        ys_outputs = ys_outputs[0]
+    ys_pred = to_original(sigmoid(ys_outputs[..., 0]), FLAGS.adjust)
+    return float(np.mean(mean_score_batch(masks, ys_pred, threshold=FLAGS.threshold)))
+
+
+def is_alive(pid):
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def save_best(dirname, best):
+    path = os.path.join(dirname, ASYNC_BEST)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(best, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def append_history(path, epoch, score):
+    is_new = not os.path.exists(path)
+    with open(path, 'a') as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(['epoch', VALID_MONITOR])
+        writer.writerow([epoch, score])
+
+
+def main(argv=None):
+    dirname = os.path.join(FLAGS.model, ASYNC_DIRNAME)
+    path_model = os.path.join(dirname, ASYNC_MODEL)
+    while not os.path.exists(path_model):
+        if not is_alive(FLAGS.parent_pid):
+            return
+        time.sleep(FLAGS.poll_interval)
+
+    dataset = Dataset(FLAGS.input, backend=FLAGS.backend, path_decoded=FLAGS.decoded,
+                      exclude_vert_hori=FLAGS.exclude_vert_hori)
+    images, masks = load_valid(dataset, load_input_size(FLAGS.model))
+    print("Loaded {} validation samples".format(len(images)))
+
+    sess = tf.Session(config=tf.ConfigProto(
+        allow_soft_placement=True, gpu_options=tf.GPUOptions(allow_growth=True)))
+    K.set_session(sess)
+    model = load_model(path_model, compile=False)
+
+    writer = tf.summary.FileWriter(os.path.join(FLAGS.log, VALID_LOG_DIRNAME))
+    best = load_best_pointer(dirname)
+    evaluated = set()
+    while True:
+        # check before listing, so that the last checkpoint is listed after training is done
+        done = os.path.exists(os.path.join(dirname, ASYNC_DONE))
+        paths = [p for p in sorted(glob.glob(os.path.join(dirname, "weights-*.npz"))) if p not in evaluated]
+        for path in paths:
+            epoch = int(os.path.splitext(os.path.basename(path))[0].split('-')[1])
+            score = evaluate(model, path, images, masks)
+            evaluated.add(path)
+            print("Epoch {:05d}: val_mean_score {:.5f}".format(epoch, score))
+            writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='val_mean_score', simple_value=score)]), epoch)
+            writer.flush()
+            append_history(os.path.join(FLAGS.model, NAME_VALID_HISTORY), epoch, score)
+
+            if best is None or score > best['score']:
+                path_prev = os.path.join(dirname, best['filename']) if best is not None else None
+                best = {'epoch': epoch, 'score': score, 'filename': os.path.basename(path)}
+                save_best(dirname, best)
+                print("Epoch {:05d}: val_mean_score improved, best is {}".format(epoch, best['filename']))
+            else:
+                path_prev = path
+            if not FLAGS.keep_checkpoints and path_prev is not None and os.path.exists(path_prev):
+                os.remove(path_prev)
+
+        if len(paths) == 0 and (done or not is_alive(FLAGS.parent_pid)):
+            break
+        if len(paths) == 0:
+            time.sleep(FLAGS.poll_interval)
+    writer.close()
+
+
+if __name__ == '__main__':
+    tf.app.run()
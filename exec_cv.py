@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Train all folds of k-fold cross validation concurrently
+
+Each worker is pinned to a disjoint set of CPU cores and limited to as many threads,
+so total wall time is about that of the slowest fold.
+"""
+
+import os
+import json
+import time
+import shlex
+import statistics
+from collections import OrderedDict
+
+from absl import app, flags
+
+from constant import *
+from workers import split_cores, popen_pinned, best_score, monitor_mode
+
+flags.DEFINE_string("train", "python train.py", """train command, --cv, --model, --log and --seed are appended""")
+flags.DEFINE_list("folds", None, """indices of folds to train (default: all folds)""")
+flags.DEFINE_list("seeds", None, """random seeds to train each fold with (default: no seed)""")
+flags.DEFINE_integer("workers", 0, """number of concurrent workers (0: number of jobs)""")
+flags.DEFINE_integer("cores", 0, """number of CPU cores per worker (0: divide available cores evenly)""")
+flags.DEFINE_list("gpus", None, """GPU ids assigned to workers in turn, 'none' to hide GPUs (default: inherit)""")
+flags.DEFINE_integer("retries", 1, """number of retries of a failed fold""")
+flags.DEFINE_string("output", "../output/cv", """path to output directory""")
+flags.DEFINE_string("monitor", "val_weighted_mean_score",
+                    """metric in history to report the best of (val_mean_score of valid_history.csv with --async_valid)""")
+flags.DEFINE_enum("mode", "auto", ["auto", "max", "min"],
+                  """whether larger or smaller monitor is better (auto: min for losses, max otherwise)""")
+flags.DEFINE_float("poll_interval", 5.0, """seconds between polls of workers""")
+
+FLAGS = flags.FLAGS
+
+REPORT_FILENAME = "cv_report.json"
+STDOUT_FILENAME = "train.log"
+
+
+class FoldJob(object):
+    def __init__(self, fold, seed, path_output):
+        self.fold = fold
+        self.seed = seed
+        self.name = "cv{}".format(fold) if seed is None else "cv{}-seed{}".format(fold, seed)
+        self.path_job = os.path.join(path_output, self.name)
+        self.path_model = os.path.join(self.path_job, "model")
+        self.path_log = os.path.join(self.path_job, "log")
+        self.attempts = 0
+        self.returncode = None
+        self.elapsed = 0.0
+
+    def args(self, train_command, num_threads):
+        args = shlex.split(train_command)
+        args += ["--cv", str(self.fold), "--model", self.path_model, "--log", self.path_log,
+                 "--num_threads", str(num_threads)]
+        if self.seed is not None:
+            args += ["--seed", str(self.seed)]
+        return args
+
+    def result(self, monitor, mode=None):
+        return OrderedDict([
+            ('name', self.name), ('fold', self.fold), ('seed', self.seed),
+            ('status', 'succeeded' if self.returncode == 0 else 'failed'),
+            ('attempts', self.attempts), ('elapsed', self.elapsed),
+            ('best_score', best_score(os.path.join(self.path_model, NAME_HISTORY), monitor, mode)),
+            ('model', self.path_model)])
+
+
+def run_jobs(jobs, train_command, slots, retries=1, poll_interval=5.0):
+    """Run `jobs` on `slots` of (cores, gpu), retrying failed jobs up to `retries` times"""
+    pending = list(jobs)
+    running = {}
+    while len(pending) > 0 or len(running) > 0:
+        for idx_slot, (cores, gpu) in enumerate(slots):
+            if idx_slot in running or len(pending) == 0:
+                continue
+            job = pending.pop(0)
+            os.makedirs(job.path_job, exist_ok=True)
+            print("Start {} on cores {} (attempt {})".format(job.name, cores, job.attempts + 1))
+            proc = popen_pinned(job.args(train_command, len(cores)), cores, gpu,
+                                path_stdout=os.path.join(job.path_job, STDOUT_FILENAME))
+            running[idx_slot] = (job, proc, time.time())
+
+        time.sleep(poll_interval)
+        for idx_slot, (job, proc, start) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            del running[idx_slot]
+            job.attempts += 1
+            job.returncode = proc.returncode
+            job.elapsed += time.time() - start
+            if job.returncode == 0:
+                print("Finished {} in {:.0f} sec".format(job.name, job.elapsed))
+            elif job.attempts <= retries:
+                print("Failed {} with code {}, retrying".format(job.name, job.returncode))
+                pending.append(job)
+            else:
+                print("Failed {} with code {}, see {}".format(
+                    job.name, job.returncode, os.path.join(job.path_job, STDOUT_FILENAME)))
+    return jobs
+
+
+def summarize(scores):
+    if len(scores) == 0:
+        return OrderedDict([('mean', None), ('std', None), ('num', 0)])
+    std = statistics.stdev(scores) if len(scores) > 1 else 0.0
+    return OrderedDict([('mean', statistics.mean(scores)), ('std', std), ('num', len(scores))])
+
+
+def cv_report(jobs, monitor, wall_time, mode=None):
+    results = [job.result(monitor, mode) for job in jobs]
+    scores = [r['best_score'] for r in results if r['status'] == 'succeeded' and r['best_score'] is not None]
+    mode = mode if mode is not None else monitor_mode(monitor)
+    report = OrderedDict([('monitor', monitor), ('mode', mode), ('summary', summarize(scores))])
+    seeds = sorted(set(r['seed'] for r in results if r['seed'] is not None))
+    if len(seeds) > 0:
+        report['seeds'] = OrderedDict(
+            (str(seed), summarize([r['best_score'] for r in results
+                                   if r['seed'] == seed and r['status'] == 'succeeded' and r['best_score'] is not None]))
+            for seed in seeds)
+    report['wall_time'] = wall_time
+    report['sum_time'] = sum(r['elapsed'] for r in results)
+    report['jobs'] = results
+    return report
+
+
+def print_report(report):
+    print("{:<16} {:>10} {:>8} {:>10} {:>12}  {}".format("name", "status", "attempts", "elapsed", "best_score", "model"))
+    for r in report['jobs']:
+        score = "{:.5f}".format(r['best_score']) if r['best_score'] is not None else "-"
+        print("{:<16} {:>10} {:>8} {:>10.0f} {:>12}  {}".format(
+            r['name'], r['status'], r['attempts'], r['elapsed'], score, r['model']))
+    summary = report['summary']
+    if summary['num'] > 0:
+        print("{}: {:.5f} +- {:.5f} ({} runs)".format(report['monitor'], summary['mean'], summary['std'], summary['num']))
+    for seed, s in report.get('seeds', {}).items():
+        if s['num'] > 0:
+            print("  seed {}: {:.5f} +- {:.5f}".format(seed, s['mean'], s['std']))
+    print("wall time: {:.0f} sec, sum of job times: {:.0f} sec".format(report['wall_time'], report['sum_time']))
+
+
+def main(argv):
+    folds = [int(f) for f in FLAGS.folds] if FLAGS.folds is not None else list(range(N_SPLITS))
+    for fold in folds:
+        if not 0 <= fold < N_SPLITS:
+            raise ValueError("fold {} is out of range of {} splits".format(fold, N_SPLITS))
+    seeds = [int(s) for s in FLAGS.seeds] if FLAGS.seeds is not None else [None]
+    jobs = [FoldJob(fold, seed, FLAGS.output) for seed in seeds for fold in folds]
+
+    num_workers = FLAGS.workers if FLAGS.workers > 0 else len(jobs)
+    num_workers = min(num_workers, len(jobs))
+    cores = split_cores(num_workers, FLAGS.cores)
+    gpus = [FLAGS.gpus[i % len(FLAGS.gpus)] if FLAGS.gpus is not None else None for i in range(num_workers)]
+    slots = list(zip(cores, gpus))
+
+    start = time.time()
+    run_jobs(jobs, FLAGS.train, slots, retries=FLAGS.retries, poll_interval=FLAGS.poll_interval)
+    report = cv_report(jobs, FLAGS.monitor, time.time() - start, mode=FLAGS.mode if FLAGS.mode != "auto" else None)
+
+    os.makedirs(FLAGS.output, exist_ok=True)
+    with open(os.path.join(FLAGS.output, REPORT_FILENAME), 'w') as f:
+        json.dump(report, f, indent=4)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import shlex
 import subprocess
 import datetime
 
 from gcp.upload import result_upload
+from job_daemon import run_for_last_line, parse_command
 from git import Repo
 from absl import app, flags
 
@@ -17,6 +19,7 @@ flags.DEFINE_string("name", "no-name", """name of job""")
 flags.DEFINE_bool("dry-run", False, """Do not upload anything""", short_name="n")
 flags.DEFINE_bool("force", False, """Ignore un-committed files""", short_name="f")
 flags.DEFINE_bool("verbose", True, """whether to print job commands""")
+flags.DEFINE_string("daemon", None, """address of job_daemon.py to run python entry points in (default: subprocess)""")
 
 FLAGS = flags.FLAGS
 
@@ -55,13 +58,19 @@ def main(argv):
     if FLAGS.preprocess != "":
         subprocess.run(shlex.split(FLAGS.preprocess), check=False)
 
-    if FLAGS.train != "":
+    # the daemon serves tensorboard for all jobs
+    if FLAGS.daemon is not None and FLAGS.train != "" and parse_command(FLAGS.train) is not None:
+        run_for_last_line(FLAGS.train, FLAGS.daemon)
+    elif FLAGS.train != "":
         proc_tb = subprocess.Popen(["tensorboard", "--logdir", "../output", "--port", "6699"])
         subprocess.run(shlex.split(FLAGS.train), check=True)
         proc_tb.kill()
 
     summary = ""
-    if FLAGS.eval != "":
+    if FLAGS.daemon is not None and FLAGS.eval != "" and parse_command(FLAGS.eval) is not None:
+        summary = run_for_last_line(FLAGS.eval, FLAGS.daemon)
+        print("summary: \"{}\"".format(summary))
+    elif FLAGS.eval != "":
         proc = subprocess.Popen(FLAGS.eval, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
         last_line = ""
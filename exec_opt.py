@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import json
 import shlex
+import hashlib
 import subprocess
 import datetime
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import os
 import yaml
@@ -12,21 +17,53 @@ import yaml
 from gcp.upload import result_upload
 from git import Repo
 from absl import app, flags
-from skopt import gp_minimize, dummy_minimize
+from skopt import gp_minimize, dummy_minimize, Optimizer
 from skopt.space import Categorical, Integer, Real
 import pandas as pd
 
+from workers import split_cores, popen_pinned, read_scores
+from job_daemon import run_for_last_line, parse_command
+from pruner import create_pruner, TrialPruned
+from trial_store import TrialStore, trial_key, study_key, STATUS_FAILED
+
 flags.DEFINE_string("yaml", "", """path to yaml file.""", short_name='y')
 flags.DEFINE_string("log", "../opt_log", """path to log directory.""")
 flags.DEFINE_bool("dry-run", False, """Do not upload anything""", short_name="n")
 flags.DEFINE_bool("force", False, """Ignore un-committed files""", short_name="f")
 flags.DEFINE_bool("verbose", True, """whether to print job commands""")
 flags.DEFINE_bool("debug", False, """whether to return dummy score and not execute job""")
+flags.DEFINE_integer("parallel", 0, """number of concurrent trials (0: run trials sequentially)""")
+flags.DEFINE_integer("cores", 0, """number of CPU cores per trial (0: divide available cores evenly)""")
+flags.DEFINE_list("gpus", None, """GPU ids assigned to trials in turn, 'none' to hide GPUs (default: inherit)""")
+flags.DEFINE_string("trials", "../output/trials", """path to output directories of parallel trials""")
+flags.DEFINE_enum("pruner", "none", ["none", "median", "asha"],
+                  """rule to stop unpromising trials by per-epoch validation score (requires --parallel)""")
+flags.DEFINE_integer("prune_warmup", 10, """epochs before the first pruning, and first rung of asha""")
+flags.DEFINE_integer("prune_eta", 3, """reduction factor of asha""")
+flags.DEFINE_string("prune_history", "<output>/model/history.csv", """path to per-epoch history of a trial""")
+flags.DEFINE_string("prune_monitor", "val_weighted_mean_score",
+                    """metric in history to prune by (val_mean_score of valid_history.csv with --async_valid)""")
+flags.DEFINE_enum("prune_mode", "max", ["max", "min"], """whether larger or smaller prune_monitor is better""")
+flags.DEFINE_float("poll_interval", 10.0, """seconds between polls of history of trials""")
+flags.DEFINE_string("store", None, """path to sqlite store of trials shared by sweeps (default: <log>/trials.sqlite)""")
+flags.DEFINE_bool("cache", True, """whether to reuse scores of trials with the same commands and commit""")
+flags.DEFINE_enum("warm_start", "commit", ["none", "commit", "all"],
+                  """trials in store to warm-start the optimizer from, of the same study and commit or of any commit""")
+flags.DEFINE_string("daemon", None, """address of job_daemon.py to run python entry points in (default: subprocess)""")
 
 FLAGS = flags.FLAGS
 
 OUTPUT_PATH = "../output"
 HISTORY_SHEET_NAME = "history.csv"
+STORE_FILENAME = "trials.sqlite"
+
+# replaced with output directory of each trial in templates
+OUTPUT_PLACEHOLDER = "<output>"
+TRAIN_STDOUT_FILENAME = "train.log"
+EVAL_STDOUT_FILENAME = "eval.log"
+TRIAL_RESULT_FILENAME = "trial.json"
+
+BASE_ESTIMATORS = {"bayesian": "GP", "random": "dummy"}
 
 
 def check_commit():
@@ -47,7 +84,8 @@ def yn(message):
 
 
 class Job(object):
-    def __init__(self, name_templ, train_templ, eval_templ, params, preprocess="", upload=True, verbose=True, debug=False):
+    def __init__(self, name_templ, train_templ, eval_templ, params, preprocess="", upload=True, verbose=True, debug=False,
+                 daemon=None):
         self.name_templ = name_templ
         self.train_templ = train_templ
         self.eval_templ = eval_templ
@@ -56,31 +94,37 @@ class Job(object):
         self.upload = upload
         self.verbose = verbose
         self.debug = debug
+        self.daemon = daemon
 
     def __call__(self, param_vals):
         if self.debug:
             import numpy as np
             return np.random.uniform()
 
-        name = self.set_param_val(self.name_templ, param_vals)
-        train_args = self.set_param_val(self.train_templ, param_vals)
-        eval_args = self.set_param_val(self.eval_templ, param_vals)
+        name, preprocess_args, train_args, eval_args = self.commands(param_vals)
 
         if self.verbose:
             print("name: {}".format(name))
             print("train command: {}".format(train_args))
             print("eval command: {}".format(eval_args))
 
-        if self.preprocess_args != "":
-            subprocess.run(shlex.split(self.preprocess_args), check=False)
+        if preprocess_args != "":
+            subprocess.run(shlex.split(preprocess_args), check=False)
 
-        if train_args != "":
+        # the daemon serves tensorboard for all jobs
+        if self.daemon is not None and train_args != "" and parse_command(train_args) is not None:
+            run_for_last_line(train_args, self.daemon, echo=self.verbose)
+        elif train_args != "":
             proc_tb = subprocess.Popen(["tensorboard", "--logdir", "../output", "--port", "6699"])
             subprocess.run(shlex.split(train_args), check=True)
             proc_tb.kill()
 
         summary = ""
-        if eval_args != "":
+        if self.daemon is not None and eval_args != "" and parse_command(eval_args) is not None:
+            summary = run_for_last_line(eval_args, self.daemon, echo=self.verbose)
+            print("summary: \"{}\"".format(summary))
+            score = parse_score(summary)
+        elif eval_args != "":
             proc = subprocess.Popen(eval_args, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
             last_line = ""
@@ -96,13 +140,22 @@ class Job(object):
 
             summary = last_line.replace('\n', '').replace('\r', '')
             print("summary: \"{}\"".format(summary))
-            score = float(summary.split(',')[0].split(':')[1])
+            score = parse_score(summary)
 
         if self.upload:
             result_upload(name, OUTPUT_PATH, summary, command=train_args + " " + eval_args)
 
         return score
 
+    def run_trial(self, param_vals):
+        """Return status and score of a trial"""
+        return 'completed', self(param_vals)
+
+    def commands(self, param_vals, path_output=OUTPUT_PATH):
+        """name, preprocess, train and eval commands of `param_vals` writing to `path_output`"""
+        templates = [self.name_templ, self.preprocess_args, self.train_templ, self.eval_templ]
+        return [self.set_param_val(templ, param_vals).replace(OUTPUT_PLACEHOLDER, path_output) for templ in templates]
+
     def set_param_val(self, template, param_vals):
         _template = template
         for param, val in zip(self.params, param_vals):
@@ -112,6 +165,182 @@ class Job(object):
         return _template
 
 
+def parse_score(summary):
+    return float(summary.split(',')[0].split(':')[1])
+
+
+def read_last_line(path):
+    last_line = ""
+    with open(path) as f:
+        for line in f:
+            if line.strip() != "":
+                last_line = line
+    return last_line.replace('\n', '').replace('\r', '')
+
+
+class ParallelJob(object):
+    """Run trials of `job` concurrently
+
+    Each trial takes one of `slots` of (cores, gpu) while it runs, and writes to its own
+    directory in `path_trials`, substituted for <output> in the templates.
+    With `pruner`, training is stopped when the per-epoch history at `path_history` falls below its rule,
+    and the best monitored score until then is returned as the partial result.
+    """
+    def __init__(self, job, slots, path_trials, pruner=None, path_history=None, monitor=None, poll_interval=10.0):
+        self.job = job
+        self.slots = queue.Queue()
+        for slot in slots:
+            self.slots.put(slot)
+        self.path_trials = path_trials
+        self.pruner = pruner
+        self.path_history = path_history
+        self.monitor = monitor
+        self.poll_interval = poll_interval
+        self.lock_upload = threading.Lock()
+
+    def run(self, args, cores, gpu, path_stdout, shell=False, check=True):
+        args = args if shell else shlex.split(args)
+        proc = popen_pinned(args, cores, gpu, path_stdout=path_stdout, shell=shell)
+        returncode = proc.wait()
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def run_train(self, args, cores, gpu, path_stdout, idx_trial, path_history):
+        """Run training, polling its history to prune it"""
+        if self.pruner is None:
+            return self.run(args, cores, gpu, path_stdout)
+        args = shlex.split(args)
+        proc = popen_pinned(args, cores, gpu, path_stdout=path_stdout)
+        num_reported = 0
+        returncode = None
+        try:
+            while True:
+                try:
+                    returncode = proc.wait(timeout=self.poll_interval)
+                except subprocess.TimeoutExpired:
+                    returncode = None
+                scores = read_scores(path_history, self.monitor)
+                for epoch, score in scores[num_reported:]:
+                    if self.pruner.report(idx_trial, epoch, score):
+                        raise TrialPruned(epoch, self.pruner.scores[idx_trial][epoch])
+                num_reported = len(scores)
+                if returncode is not None:
+                    break
+        finally:
+            # training must not outlive its slot when pruned or when its history cannot be read
+            if returncode is None:
+                proc.terminate()
+                proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def __call__(self, param_vals, idx_trial):
+        return self.run_trial(param_vals, idx_trial)[1]
+
+    def run_trial(self, param_vals, idx_trial):
+        """Return status and score of a trial"""
+        if self.job.debug:
+            import numpy as np
+            return 'completed', np.random.uniform()
+
+        path_output = os.path.join(self.path_trials, "trial-{:04d}".format(idx_trial))
+        name, preprocess_args, train_args, eval_args = self.job.commands(param_vals, path_output)
+        path_history = self.path_history.replace(OUTPUT_PLACEHOLDER, path_output) if self.path_history else None
+        os.makedirs(path_output, exist_ok=True)
+
+        cores, gpu = self.slots.get()
+        try:
+            if self.job.verbose:
+                print("trial {} ({}) on cores {}: {}".format(idx_trial, name, cores, train_args))
+            if preprocess_args != "":
+                self.run(preprocess_args, cores, gpu, None, check=False)
+            if train_args != "":
+                self.run_train(train_args, cores, gpu, os.path.join(path_output, TRAIN_STDOUT_FILENAME),
+                               idx_trial, path_history)
+            summary = ""
+            if eval_args != "":
+                path_stdout = os.path.join(path_output, EVAL_STDOUT_FILENAME)
+                self.run(eval_args, cores, gpu, path_stdout, shell=True)
+                summary = read_last_line(path_stdout)
+        except TrialPruned as e:
+            print("trial {} is {}".format(idx_trial, e))
+            self.save_result(path_output, param_vals, 'pruned', e.score, epoch=e.epoch)
+            return 'pruned', e.score
+        finally:
+            self.slots.put((cores, gpu))
+
+        print("trial {} summary: \"{}\"".format(idx_trial, summary))
+        score = parse_score(summary)
+        self.save_result(path_output, param_vals, 'completed', score, summary=summary)
+
+        if self.job.upload:
+            with self.lock_upload:
+                result_upload(name, path_output, summary, command=train_args + " " + eval_args)
+        return 'completed', score
+
+    def save_result(self, path_output, param_vals, status, score, **kwargs):
+        result = dict(params=dict(zip(self.job.params, [str(v) for v in param_vals])),
+                      status=status, score=score, **kwargs)
+        with open(os.path.join(path_output, TRIAL_RESULT_FILENAME), 'w') as f:
+            json.dump(result, f, indent=4)
+
+
+class CachedJob(object):
+    """Return the score of a trial run before with the same commands and commit instead of running it
+
+    `runner` is a Job or ParallelJob, trials are shared with other sweeps through `store`.
+    """
+    def __init__(self, runner, store, study, commit):
+        self.runner = runner
+        self.job = runner if isinstance(runner, Job) else runner.job
+        self.store = store
+        self.study = study
+        self.commit = commit
+
+    def __call__(self, param_vals, *args):
+        _, _, train_args, eval_args = self.job.commands(param_vals, OUTPUT_PLACEHOLDER)
+        key = trial_key(train_args, eval_args, self.commit)
+        cached = self.store.acquire(key, self.study, self.commit, param_vals, train_args + " " + eval_args)
+        if cached is not None:
+            print("{} is cached: {} ({})".format(param_vals, cached['score'], cached['status']))
+            return cached['score']
+
+        try:
+            status, score = self.runner.run_trial(param_vals, *args)
+        except BaseException:
+            self.store.finish(key, STATUS_FAILED)
+            raise
+        self.store.finish(key, status, score)
+        return score
+
+
+def get_commit():
+    """HEAD sha, with a hash of uncommitted changes and untracked files if the tree is dirty"""
+    repo = Repo()
+    commit = repo.head.object.hexsha
+    if repo.is_dirty(untracked_files=True):
+        h = hashlib.sha256(repo.git.diff("HEAD", binary=True).encode('utf-8'))
+        for path in sorted(repo.untracked_files):
+            h.update(path.encode('utf-8'))
+            with open(os.path.join(repo.working_tree_dir, path), 'rb') as f:
+                h.update(f.read())
+        commit += "-dirty-" + h.hexdigest()[:16]
+    return commit
+
+
+def warm_start_points(store, study, commit, spaces, warm_start, maximize):
+    """x0 and y0 of finished trials in `store` which are inside of `spaces`"""
+    if warm_start == "none":
+        return [], []
+    xs, scores = store.history(study, commit if warm_start == "commit" else None)
+    x0, y0 = [], []
+    for x, score in zip(xs, scores):
+        if len(x) == len(spaces) and all(v in space for v, space in zip(x, spaces)):
+            x0.append(x)
+            y0.append(-score if maximize else score)
+    return x0, y0
+
+
 def parse_parameters(parameter_dict):
     list_param = []
     list_space = []
@@ -157,6 +386,70 @@ def parse_yaml(path_yaml):
     return name_templ, train_templ, eval_templ, params, spaces, preprocess, optimizer
 
 
+def create_optimizer(spaces, optimizer):
+    """skopt Optimizer and number of calls equivalent to the config of gp_minimize/dummy_minimize"""
+    if optimizer["type"] not in BASE_ESTIMATORS:
+        raise ValueError("minimizer {} is invalid".format(optimizer["type"]))
+    config = dict(optimizer["config"])
+    n_calls = config.pop("n_calls", 100)
+    kwargs = {}
+    if "n_random_starts" in config:
+        kwargs["n_initial_points"] = config.pop("n_random_starts")
+    for key in ["n_initial_points", "acq_func", "acq_optimizer", "random_state"]:
+        if key in config:
+            kwargs[key] = config.pop(key)
+    if len(config) > 0:
+        print("optimizer config {} is ignored in parallel mode".format(config))
+    return Optimizer(spaces, base_estimator=BASE_ESTIMATORS[optimizer["type"]], **kwargs), n_calls
+
+
+def ask_pending(opt, pending, n_points):
+    """Ask `n_points` points which are not `pending`, with pending points told to a copy of `opt` as constant liars"""
+    if len(pending) > 0:
+        # liar value is the best value so far, so the acquisition looks away from pending points
+        liar = min(opt.yi) if len(opt.yi) > 0 else 0.0
+        opt = opt.copy(random_state=opt.rng)
+        opt.tell(pending, [liar] * len(pending))
+    return opt.ask(n_points=n_points) if n_points > 1 else [opt.ask()]
+
+
+def minimize_parallel(func, spaces, optimizer, n_parallel, callback=None, x0=None, y0=None):
+    """Minimize `func(x, idx_trial)` evaluating `n_parallel` points at once with ask/tell
+
+    A batch of points is asked whenever trials finish, given points of running trials as constant liars,
+    and results are told as each trial finishes.
+    Known points `x0` and their values `y0` are told before the first ask.
+    """
+    opt, n_calls = create_optimizer(spaces, optimizer)
+    callbacks = callback if callback is not None else []
+    futures = {}
+    n_asked = 0
+    result = None
+    if x0 is not None and len(x0) > 0:
+        result = opt.tell(x0, y0)
+    with ThreadPoolExecutor(n_parallel) as executor:
+        while n_asked < n_calls or len(futures) > 0:
+            n_points = min(n_parallel - len(futures), n_calls - n_asked)
+            if n_points > 0:
+                xs = ask_pending(opt, list(futures.values()), n_points)
+                for x in xs:
+                    futures[executor.submit(func, x, n_asked)] = x
+                    n_asked += 1
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                x = futures.pop(future)
+                try:
+                    y = future.result()
+                except Exception as e:
+                    print("trial {} failed: {}".format(x, e))
+                    continue
+                result = opt.tell(x, y)
+                for c in callbacks:
+                    c(result)
+    return result
+
+
 def main(argv):
     if not FLAGS.force:
         check_commit()
@@ -172,18 +465,62 @@ def main(argv):
 
     upload = not FLAGS['dry-run'].value
     job = Job(
-        name_templ, train_templ, eval_templ, params, preprocess, upload=upload, verbose=FLAGS.verbose, debug=FLAGS.debug)
+        name_templ, train_templ, eval_templ, params, preprocess, upload=upload, verbose=FLAGS.verbose, debug=FLAGS.debug,
+        daemon=FLAGS.daemon)
     callbacks = [LogCallback(params=params, path_out=path_history)]
 
+    store = TrialStore(FLAGS.store if FLAGS.store is not None else os.path.join(FLAGS.log, STORE_FILENAME))
+    study = study_key(name_templ, train_templ, eval_templ, params)
+    commit = get_commit()
+    x0, y0 = warm_start_points(store, study, commit, spaces, FLAGS.warm_start, optimizer["maximize"])
+    if len(x0) > 0:
+        print("warm-start from {} trials in store".format(len(x0)))
+    use_cache = FLAGS.cache and not FLAGS.debug
+
+    if FLAGS.pruner != "none" and FLAGS.parallel == 0:
+        raise ValueError("--pruner requires --parallel")
+    if FLAGS.daemon is not None and FLAGS.parallel > 0:
+        raise ValueError("--daemon runs one job at a time, it cannot be combined with --parallel")
+
+    if FLAGS.parallel > 0:
+        if OUTPUT_PLACEHOLDER not in train_templ + eval_templ:
+            raise ValueError("train/eval templates must write to {} in parallel mode".format(OUTPUT_PLACEHOLDER))
+        if preprocess != "" and OUTPUT_PLACEHOLDER not in preprocess:
+            print("preprocess \"{}\" is skipped in parallel mode, it is not specific to {}".format(
+                preprocess, OUTPUT_PLACEHOLDER))
+            job.preprocess_args = ""
+        cores = split_cores(FLAGS.parallel, FLAGS.cores)
+        gpus = [FLAGS.gpus[i % len(FLAGS.gpus)] if FLAGS.gpus is not None else None for i in range(FLAGS.parallel)]
+        pruner = create_pruner(FLAGS.pruner, warmup=FLAGS.prune_warmup, eta=FLAGS.prune_eta, mode=FLAGS.prune_mode)
+        parallel_job = ParallelJob(job, list(zip(cores, gpus)), FLAGS.trials, pruner=pruner,
+                                   path_history=FLAGS.prune_history, monitor=FLAGS.prune_monitor,
+                                   poll_interval=FLAGS.poll_interval)
+
+        if use_cache:
+            parallel_job = CachedJob(parallel_job, store, study, commit)
+
+        sign = -1 if optimizer["maximize"] else 1
+        func = lambda x, idx_trial: sign * parallel_job(x, idx_trial)
+        proc_tb = subprocess.Popen(["tensorboard", "--logdir", FLAGS.trials, "--port", "6699"])
+        try:
+            res = minimize_parallel(func, spaces, optimizer, FLAGS.parallel, callback=callbacks, x0=x0, y0=y0)
+        finally:
+            proc_tb.kill()
+        return
+
+    run = CachedJob(job, store, study, commit) if use_cache else job
     if not optimizer["maximize"]:
-        func = job
+        func = run
     else:
-        func = lambda x: -1 * job(x)
+        func = lambda x: -1 * run(x)
 
+    config = dict(optimizer["config"])
+    if len(x0) > 0:
+        config.update(x0=x0, y0=y0)
     if optimizer["type"] == "bayesian":
-        res = gp_minimize(func, spaces, callback=callbacks, **optimizer["config"])
+        res = gp_minimize(func, spaces, callback=callbacks, **config)
     elif optimizer["type"] == "random":
-        res = dummy_minimize(func, spaces, callback=callbacks, **optimizer["config"])
+        res = dummy_minimize(func, spaces, callback=callbacks, **config)
     else:
         raise ValueError("minimizer {} is invalid".format(optimizer["type"]))
 
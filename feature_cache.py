@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache of frozen encoder activations to train only the decoder of pretrained models
+"""
+
+import os
+import json
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+from tensorflow.keras.utils import Sequence
+from tqdm import tqdm
+
+CACHE_META_FILENAME = "meta.json"
+
+FLIPS = {
+    'none': lambda x: x,
+    'lr': lambda x: x[:, :, ::-1, :],
+    'ud': lambda x: x[:, ::-1, :, :],
+    'lrud': lambda x: x[:, ::-1, ::-1, :],
+}
+
+
+def list_flips(horizontal_flip=False, vertical_flip=False):
+    flips = ['none']
+    if horizontal_flip:
+        flips.append('lr')
+    if vertical_flip:
+        flips.append('ud')
+    if horizontal_flip and vertical_flip:
+        flips.append('lrud')
+    return flips
+
+
+class FeatureCache(object):
+    """Images, labels and encoder features of (flip, sample) pairs stored as memmaps
+
+    Features are stored as float16 to halve the size of the cache.
+    """
+    def __init__(self, path_cache):
+        self.path_cache = path_cache
+        with open(os.path.join(path_cache, CACHE_META_FILENAME)) as f:
+            self.meta = json.load(f)
+        self.num_samples = self.meta['num_samples']
+        self.flips = self.meta['flips']
+        self.images = np.load(os.path.join(path_cache, 'images.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(path_cache, 'labels.npy'), mmap_mode='r')
+        self.features = [np.load(os.path.join(path_cache, 'feature{}.npy'.format(i + 1)), mmap_mode='r')
+                         for i in range(self.meta['num_features'])]
+
+    @property
+    def feature_shapes(self):
+        return [f.shape[2:] for f in self.features]
+
+    @staticmethod
+    def is_valid(path_cache, key):
+        path_meta = os.path.join(path_cache, CACHE_META_FILENAME)
+        if not os.path.exists(path_meta):
+            return False
+        with open(path_meta) as f:
+            meta = json.load(f)
+        return meta['key'] == key
+
+    @classmethod
+    def build(cls, path_cache, encoder, sess, iterator, max_samples, flips, key):
+        """Run `encoder` once per (flip, sample) of `iterator` and store its outputs
+
+        `iterator` must yield (image, mask_and_weight) batches once without augmentation.
+        """
+        os.makedirs(path_cache, exist_ok=True)
+        path_meta = os.path.join(path_cache, CACHE_META_FILENAME)
+        if os.path.exists(path_meta):
+            os.remove(path_meta)
+
+        def _open(name, shape, dtype):
+            return np.lib.format.open_memmap(
+                os.path.join(path_cache, name), mode='w+', dtype=dtype, shape=(len(flips), max_samples) + tuple(shape))
+
+        feature_shapes = [K.int_shape(o)[1:] for o in encoder.outputs]
+        features = [_open('feature{}.npy'.format(i + 1), shape, np.float16) for i, shape in enumerate(feature_shapes)]
+        images, labels = None, None
+
+        next_batch = iterator.get_next()
+        num_samples = 0
+        with tqdm(total=max_samples, desc="caching encoder features") as pbar:
+            while num_samples < max_samples:
+                try:
+                    xs, ys = sess.run(next_batch)
+                except tf.errors.OutOfRangeError:
+                    break
+                xs, ys = xs[:max_samples - num_samples], ys[:max_samples - num_samples]
+                if images is None:
+                    images = _open('images.npy', xs.shape[1:], np.float16)
+                    labels = _open('labels.npy', ys.shape[1:], np.float16)
+                s = slice(num_samples, num_samples + len(xs))
+                for i, flip in enumerate(flips):
+                    _xs = FLIPS[flip](xs)
+                    outputs = encoder.predict_on_batch(_xs)
+                    if not isinstance(outputs, list):
+                        outputs = [outputs]
+                    images[i, s] = _xs
+                    labels[i, s] = FLIPS[flip](ys)
+                    for feature, output in zip(features, outputs):
+                        feature[i, s] = output
+                num_samples += len(xs)
+                pbar.update(len(xs))
+
+        for array in [images, labels] + features:
+            if array is not None:
+                array.flush()
+        del images, labels, features
+
+        meta = {'key': key, 'num_samples': num_samples, 'flips': flips, 'num_features': len(feature_shapes)}
+        with open(path_meta, 'w') as f:
+            json.dump(meta, f, indent=4)
+        return cls(path_cache)
+
+
+class FeatureCacheSequence(Sequence):
+    """Batches of ([image, feature1, ...], mask_and_weight) read from `FeatureCache`
+
+    With shuffle=True one flip is drawn per sample every epoch, same as random flip augmentation.
+    """
+    def __init__(self, cache, batch_size, shuffle=True, seed=None):
+        self.cache = cache
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def __len__(self):
+        if self.shuffle:
+            return self.cache.num_samples // self.batch_size
+        return int(np.ceil(self.cache.num_samples / self.batch_size))
+
+    def on_epoch_end(self):
+        num_samples = self.cache.num_samples
+        if self.shuffle:
+            self.sample_index = self.random_state.permutation(num_samples)
+            self.flip_index = self.random_state.randint(0, len(self.cache.flips), size=num_samples)
+        else:
+            self.sample_index = np.arange(num_samples)
+            self.flip_index = np.zeros(num_samples, dtype=np.int64)
+
+    def __getitem__(self, idx):
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        samples, flips = self.sample_index[batch], self.flip_index[batch]
+        # read memmaps in storage order
+        order = np.lexsort((samples, flips))
+        samples, flips = samples[order], flips[order]
+        inputs = [self.cache.images[flips, samples].astype(np.float32)]
+        inputs += [f[flips, samples].astype(np.float32) for f in self.cache.features]
+        labels = self.cache.labels[flips, samples].astype(np.float32)
+        return inputs, labels
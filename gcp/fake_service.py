@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local fake of the subset of Drive/Sheets API used by upload, to test uploads offline
+
+Drive files are stored under <root>/drive and Sheets rows are appended to <root>/sheets/<spreadsheet_id>.jsonl,
+so uploads by other threads and processes can be inspected.
+"""
+
+import os
+import json
+import uuid
+import fcntl
+
+
+def fake_config(path_root):
+    return {
+        'drive_root_id': 'root',
+        'drive_url_prefix': 'file://' + os.path.abspath(os.path.join(path_root, 'drive')) + '/',
+        'sheet_name': 'results',
+        'spreadsheet_id': 'fake',
+    }
+
+
+def _append_jsonl(path, record):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(record) + "\n")
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_jsonl(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+class FakeRequest(object):
+    def __init__(self, fn, media_body=None):
+        self.fn = fn
+        self.media_body = media_body
+        self.progress = 0
+        self.content = b''
+
+    def next_chunk(self):
+        """Receive one chunk of resumable media, return (progress, None) until complete and then (None, response)"""
+        size = self.media_body.size()
+        length = min(self.media_body.chunksize(), size - self.progress)
+        self.content += self.media_body.getbytes(self.progress, length)
+        self.progress += length
+        if self.progress < size:
+            return (self.progress, size), None
+        return None, self.fn(self.content)
+
+    def execute(self):
+        if self.media_body is None:
+            return self.fn(None)
+        response = None
+        while response is None:
+            _, response = self.next_chunk()
+        return response
+
+
+class FakeDrive(object):
+    def __init__(self, path_root):
+        self.path_drive = os.path.join(path_root, 'drive')
+        os.makedirs(self.path_drive, exist_ok=True)
+
+    def files(self):
+        return self
+
+    def create(self, body, media_body=None, fields=None):
+        def _create(content):
+            id = uuid.uuid4().hex
+            record = dict(body, id=id)
+            if content is not None:
+                with open(os.path.join(self.path_drive, id), 'wb') as f:
+                    f.write(content)
+                record['size'] = len(content)
+            _append_jsonl(os.path.join(self.path_drive, 'files.jsonl'), record)
+            return {'id': id}
+        return FakeRequest(_create, media_body)
+
+    def list_files(self):
+        return _read_jsonl(os.path.join(self.path_drive, 'files.jsonl'))
+
+
+class FakeSheets(object):
+    def __init__(self, path_root, failures=0):
+        self.path_sheets = os.path.join(path_root, 'sheets')
+        # number of next appends failing by connection error
+        self.failures = failures
+        os.makedirs(self.path_sheets, exist_ok=True)
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _path(self, spreadsheet_id):
+        return os.path.join(self.path_sheets, spreadsheet_id + '.jsonl')
+
+    def get(self, spreadsheetId, range):
+        return FakeRequest(lambda _: {'values': [row[:1] for row in self.rows(spreadsheetId)]})
+
+    def append(self, spreadsheetId, range, valueInputOption=None, insertDataOption=None, body=None):
+        def _append(_):
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError("fake connection error")
+            for row in body['values']:
+                _append_jsonl(self._path(spreadsheetId), row)
+            return {'spreadsheetId': spreadsheetId, 'updates': {'updatedRows': len(body['values'])}}
+        return FakeRequest(_append)
+
+    def rows(self, spreadsheet_id):
+        return _read_jsonl(self._path(spreadsheet_id))
+
+
+class FakeServiceManager(object):
+    """Same interface as ServiceManager, without credentials"""
+    def __init__(self, path_root):
+        self.path_root = path_root
+
+    def get_drive_service(self):
+        return FakeDrive(self.path_root)
+
+    def get_sheets_service(self):
+        return FakeSheets(self.path_root)
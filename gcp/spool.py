@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local spool of job results waiting for upload
+
+A result is first written atomically to an SQLite spool with its staged output directory.
+A flusher uploads the outputs, then appends all pending rows to Sheets in one batched request,
+so jobs do not fail or wait when the network is unavailable.
+"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import socket
+import sqlite3
+from pprint import pprint
+
+from googleapiclient.errors import HttpError
+
+# states of a result
+PENDING_UPLOAD = 'pending_upload'
+PENDING_ROW = 'pending_row'
+FLUSHED = 'flushed'
+
+# index of drive path in job_info
+DRIVE_PATH_INDEX = 4
+
+
+class ResultSpool(object):
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname != "":
+            os.makedirs(dirname, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, job_info TEXT, path TEXT, state TEXT,
+                attempts INTEGER DEFAULT 0, created REAL)""")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _execute(self, query, args=()):
+        conn = self._connect()
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def append(self, job_info, path):
+        """Spool a row of job and its staged outputs at `path`, return id of the result"""
+        conn = self._connect()
+        try:
+            cursor = conn.execute("INSERT INTO results (job_info, path, state, created) VALUES (?, ?, ?, ?)",
+                                  (json.dumps(job_info), path, PENDING_UPLOAD, time.time()))
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def _records(self, state, limit=-1):
+        rows = self._execute("SELECT * FROM results WHERE state = ? ORDER BY id LIMIT ?", (state, limit))
+        return [dict(row, job_info=json.loads(row['job_info'])) for row in rows]
+
+    def pending_uploads(self):
+        return self._records(PENDING_UPLOAD)
+
+    def pending_rows(self, limit=-1):
+        return self._records(PENDING_ROW, limit)
+
+    def set_uploaded(self, id, job_info):
+        self._execute("UPDATE results SET job_info = ?, state = ? WHERE id = ?", (json.dumps(job_info), PENDING_ROW, id))
+
+    def set_flushed(self, ids):
+        self._execute("UPDATE results SET state = ? WHERE id IN ({})".format(", ".join("?" * len(ids))),
+                      [FLUSHED] + list(ids))
+
+    def add_attempt(self, id):
+        self._execute("UPDATE results SET attempts = attempts + 1 WHERE id = ?", (id,))
+
+
+def with_retry(fn, retries=5, backoff=1.0):
+    """Call `fn`, retrying on server, rate limit and connection errors with exponential backoff"""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except (HttpError, ConnectionError, socket.timeout) as e:
+            if isinstance(e, HttpError) and e.resp.status < 500 and e.resp.status != 429:
+                raise
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+            print("{}, retrying in {:.1f} sec".format(e, wait))
+            time.sleep(wait)
+
+
+def append_rows(service, rows, config, retries=5, backoff=1.0):
+    """Append `rows` after the last row of the sheet in one request"""
+    body = {"values": rows}
+    request = service.spreadsheets().values().append(
+        spreadsheetId=config['spreadsheet_id'], range='{}!A:A'.format(config['sheet_name']),
+        valueInputOption='USER_ENTERED', insertDataOption='INSERT_ROWS', body=body)
+    response = with_retry(request.execute, retries, backoff)
+    pprint(response)
+    return response
+
+
+def flush(spool, upload, sheets_service, config, batch_size=100, retries=5, backoff=1.0, blocking=True):
+    """Upload pending outputs by `upload(name, path)` returning drive path, then append pending rows in batches
+
+    Flushers of a spool run one at a time. Results failed to upload or to append stay in the spool for the next flush,
+    so that jobs do not fail when the network is down.
+    With blocking=False, returns False at once if another flusher holds the spool, which then flushes
+    the results spooled while it runs.
+    """
+    attempted = set()
+    with open(spool.path + ".lock", 'w') as lock:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                for record in spool.pending_uploads():
+                    if record['id'] in attempted:
+                        continue
+                    attempted.add(record['id'])
+                    job_info = record['job_info']
+                    try:
+                        job_info[DRIVE_PATH_INDEX] = upload(job_info[0], record['path'])
+                    except Exception as e:
+                        print("failed to upload {}: {}".format(record['path'], e))
+                        spool.add_attempt(record['id'])
+                        continue
+                    spool.set_uploaded(record['id'], job_info)
+                    shutil.rmtree(record['path'], ignore_errors=True)
+
+                service = None
+                while True:
+                    records = spool.pending_rows(batch_size)
+                    if len(records) == 0:
+                        break
+                    try:
+                        service = service if service is not None else sheets_service()
+                        append_rows(service, [r['job_info'] for r in records], config, retries, backoff)
+                    except (HttpError, ConnectionError, socket.timeout, OSError) as e:
+                        print("failed to append {} rows, they are left for the next flush: {}".format(len(records), e))
+                        return False
+                    spool.set_flushed([r['id'] for r in records])
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+            # results spooled during the flush, whose non-blocking flushers have given up
+            if all(r['id'] in attempted for r in spool.pending_uploads()) and len(spool.pending_rows(1)) == 0:
+                return True
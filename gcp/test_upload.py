@@ -1,14 +1,51 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import datetime
+import tempfile
+
+from absl import app, flags
 
 from .upload import result_upload
+from .fake_service import FakeServiceManager, FakeSheets, fake_config
+from .spool import ResultSpool, flush
+
+flags.DEFINE_bool('fake', False, 'upload to a local fake Drive/Sheets instead of GCP.')
+
+FLAGS = flags.FLAGS
+
 
 def main(argv=None):
-    result_upload(
-        name="test", datetime_str=str(datetime.datetime.now()), path="./output", summary="this is upload test")
+    if FLAGS.fake:
+        if FLAGS.fake_gcp is None:
+            FLAGS.fake_gcp = tempfile.mkdtemp()
+        if not os.path.exists(FLAGS.upload_manifest):
+            FLAGS.upload_manifest = os.path.join(FLAGS.fake_gcp, 'upload_manifest.json')
+
+    # second upload of the same contents is skipped by the manifest
+    for i in range(2):
+        proc = result_upload(
+            name="test", datetime_str=str(datetime.datetime.now()), path="./output", summary="this is upload test")
+        if proc is not None:
+            proc.wait()
+
+    if FLAGS.fake:
+        service_manager = FakeServiceManager(FLAGS.fake_gcp)
+        files = service_manager.get_drive_service().list_files()
+        rows = service_manager.get_sheets_service().rows(fake_config(FLAGS.fake_gcp)['spreadsheet_id'])
+        print("{} drive objects and {} sheet rows in {}".format(len(files), len(rows), FLAGS.fake_gcp))
+
+        # rows spooled while offline are appended in one request after retries
+        spool = ResultSpool(os.path.join(FLAGS.fake_gcp, 'spool.sqlite'))
+        for i in range(3):
+            job_info = ["offline{}".format(i), str(datetime.datetime.now()), "", "", "", ""]
+            spool.set_uploaded(spool.append(job_info, FLAGS.fake_gcp), job_info)
+        config = dict(fake_config(FLAGS.fake_gcp), spreadsheet_id='offline')
+        sheets = FakeSheets(FLAGS.fake_gcp, failures=2)
+        flush(spool, None, lambda: sheets, config, backoff=0.1)
+        print("{} rows appended after {} failures".format(len(sheets.rows('offline')), 2))
 
 
 if __name__ == '__main__':
-    main()
+    app.run(main)
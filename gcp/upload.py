@@ -3,15 +3,26 @@
 
 import os
 import sys
-from pprint import pprint
+import time
+import shutil
+import socket
+import fcntl
+import hashlib
+import tempfile
+import threading
+import zipfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import json
 
 import datetime
 from absl import app, flags
 import git
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
 
 from .service_manager import ServiceManager
+from .spool import ResultSpool, flush
 
 FLAGS = flags.FLAGS
 
@@ -21,23 +32,129 @@ flags.DEFINE_string(
 flags.DEFINE_string(
     'config', os.path.join(os.path.dirname(__file__), 'config.json'), 'path to GCP token file.')
 
+flags.DEFINE_string(
+    'fake_gcp', None, 'path to directory of local fake Drive/Sheets used instead of GCP.')
+
+flags.DEFINE_bool(
+    'upload_background', True, 'whether to upload results in a background process.')
+
+flags.DEFINE_integer(
+    'upload_workers', 8, 'number of concurrent uploads.')
+
+flags.DEFINE_integer(
+    'upload_chunk_mb', 8, 'chunk size of resumable uploads in MB.')
+
+flags.DEFINE_integer(
+    'upload_pack_kb', 0, 'pack files smaller than this size in KB into one archive (0: never pack).')
+
+flags.DEFINE_string(
+    'upload_manifest', '../upload_manifest.json',
+    'path to manifest of contents uploaded before, unchanged files are not uploaded again.')
+
+flags.DEFINE_string(
+    'upload_spool', '../upload_spool.sqlite', 'path to local spool of results waiting for upload.')
+
+flags.DEFINE_integer(
+    'upload_batch_rows', 100, 'max number of rows appended to Sheets in one request.')
+
+flags.DEFINE_bool(
+    'flush_blocking', True, 'wait for another flusher of the spool, instead of leaving the results to it.')
+
+STAGING_DIRNAME = ".upload_staging"
+MANIFEST_FILENAME = "manifest.json"
+PACK_FILENAME = "small_files.zip"
+UPLOAD_RETRIES = 5
 
-def result_upload(name, path, summary, command=None, datetime_str=None):
+
+def result_upload(name, path, summary, command=None, datetime_str=None, background=None):
+    """Spool a row of the job with files in `path`, then upload them to Drive and append the row to Sheets
+
+    `path` is staged by hard links and the row is written to the local spool first, so `path` can be removed
+    right after, and results are kept when upload fails. Files must not be rewritten in place (e.g. reopened with
+    mode 'w' or appended) until they are uploaded, since hard links share their contents; removing or replacing
+    them by os.replace is safe.
+    With background=True, the spool is flushed by a detached `python -m gcp.upload` process, which is returned
+    without waiting. The process exits at once if another flusher is running, which then flushes this result too.
+    """
     if command is None:
         command = " ".join(sys.argv)
     if datetime_str is None:
         datetime_str = str(datetime.datetime.now())
-    service_manager = ServiceManager(FLAGS.credentials)
+    if background is None:
+        background = FLAGS.upload_background
+
+    path_staging = stage_outputs(path, name)
+    job_info = create_job_info(name, datetime_str, summary, command, None)
+    ResultSpool(FLAGS.upload_spool).append(job_info, path_staging)
+
+    if not background:
+        flush_results()
+        return None
+
+    # a new interpreter, not a fork of a process with threads and open sqlite handles, which exits on its own
+    proc = subprocess.Popen([sys.executable, "-m", "gcp.upload", "--noflush_blocking"] + _flag_args(),
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            stdin=subprocess.DEVNULL, start_new_session=True)
+    print("uploading {} in background process {}".format(name, proc.pid))
+    return proc
+
+
+def _flag_args():
+    """Flags of this module given to the background flusher, with paths relative to the working directory"""
+    args = []
+    for name in ['credentials', 'config', 'upload_manifest', 'upload_spool', 'fake_gcp']:
+        if FLAGS[name].value is not None:
+            args.append("--{}={}".format(name, os.path.abspath(FLAGS[name].value)))
+    for name in ['upload_workers', 'upload_chunk_mb', 'upload_pack_kb', 'upload_batch_rows']:
+        args.append("--{}={}".format(name, FLAGS[name].value))
+    return args
+
+
+def flush_results(blocking=True):
+    """Upload outputs and append rows of all results pending in the spool, see `spool.flush` for `blocking`"""
+    service_manager = get_service_manager()
     config = get_config()
-    service = service_manager.get_drive_service()
-    drive_path = upload_outputs(service, name, path, config)
 
-    job_info = create_job_info(name, datetime_str, summary, command, drive_path)
-    service = service_manager.get_sheets_service()
-    append_row(service, job_info, config)
+    def _upload(name, path):
+        return upload_outputs(
+            service_manager.get_drive_service, name, path, config, workers=FLAGS.upload_workers,
+            chunksize=FLAGS.upload_chunk_mb * 2**20, pack_threshold=FLAGS.upload_pack_kb * 2**10,
+            path_manifest=FLAGS.upload_manifest)
+
+    flush(ResultSpool(FLAGS.upload_spool), _upload, service_manager.get_sheets_service, config,
+          batch_size=FLAGS.upload_batch_rows, retries=UPLOAD_RETRIES, blocking=blocking)
+
+
+def stage_outputs(path, name):
+    """Snapshot of `path` by hard links (copies if not possible) beside it"""
+    path_staging = os.path.join(os.path.dirname(os.path.abspath(path)), STAGING_DIRNAME,
+                                "{}-{}-{}".format(name, os.getpid(), int(time.time() * 1000)))
+
+    def _link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    os.makedirs(os.path.dirname(path_staging), exist_ok=True)
+    if os.path.isdir(path):
+        shutil.copytree(path, path_staging, copy_function=_link)
+    else:
+        os.makedirs(path_staging)
+    return path_staging
+
+
+def get_service_manager():
+    if FLAGS.fake_gcp is not None:
+        from .fake_service import FakeServiceManager
+        return FakeServiceManager(FLAGS.fake_gcp)
+    return ServiceManager(FLAGS.credentials)
 
 
 def get_config():
+    if FLAGS.fake_gcp is not None and not os.path.exists(FLAGS.config):
+        from .fake_service import fake_config
+        return fake_config(FLAGS.fake_gcp)
     with open(FLAGS.config) as f:
         config = json.load(f)
     return config
@@ -49,64 +166,175 @@ def create_job_info(name, datetime_str, summary, command, drive_path):
     return job_info
 
 
-def append_row(service, job_info, config):
-    range_name = '{}!A:A'.format(config['sheet_name'])
-    result = service.spreadsheets().values().get(spreadsheetId=config['spreadsheet_id'],
-                                                 range=range_name).execute()
-    values = result.get('values', [])
+def file_sha256(path, block_size=2**20):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class UploadManifest(object):
+    """Drive locations of contents uploaded before, keyed by sha256
 
-    next_row = len(values) + 1
+    Shared by concurrent uploads, updates are merged under a lock file.
+    """
+    def __init__(self, path):
+        self.path = path
 
-    target_range = '{}!A{}'.format(config['sheet_name'], next_row)
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
 
-    body = {"values": [job_info]}
+    def load(self):
+        # manifest is replaced atomically, no lock is needed to read
+        return self._read()
 
-    value_input_option = 'USER_ENTERED'
-    insert_data_option = 'INSERT_ROWS'
-    request = service.spreadsheets().values().append(spreadsheetId=config['spreadsheet_id'], range=target_range,
-                                                     valueInputOption=value_input_option,
-                                                     insertDataOption=insert_data_option, body=body)
-    response = request.execute()
-    pprint(response)
+    def update(self, entries):
+        with open(self.path + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                manifest = self._read()
+                manifest.update(entries)
+                with open(self.path + ".tmp", 'w') as f:
+                    json.dump(manifest, f)
+                os.replace(self.path + ".tmp", self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
 
-def upload_outputs(service, name, output_dir, config):
-    def create_dir(name, parent_id=None):
-        file_metadata = {
-            'name': name,
-            'mimeType': 'application/vnd.google-apps.folder'
-        }
-        if parent_id is not None:
-            file_metadata['parents'] = [parent_id]
+def create_dir(service, name, parent_id=None):
+    file_metadata = {
+        'name': name,
+        'mimeType': 'application/vnd.google-apps.folder'
+    }
+    if parent_id is not None:
+        file_metadata['parents'] = [parent_id]
 
-        file = service.files().create(body=file_metadata, fields='id').execute()
-        return file.get('id')
+    file = service.files().create(body=file_metadata, fields='id').execute()
+    return file.get('id')
 
-    def upload_file(name, source_path, parent_id=None):
-        file_metadata = {'name': name}
-        if parent_id is not None:
-            file_metadata['parents'] = [parent_id]
 
+def upload_file(service, name, source_path, parent_id=None, chunksize=8 * 2**20, retries=UPLOAD_RETRIES):
+    """Upload a file by resumable chunks, retrying a chunk on server or connection errors"""
+    file_metadata = {'name': name}
+    if parent_id is not None:
+        file_metadata['parents'] = [parent_id]
+
+    if os.path.getsize(source_path) == 0:
         media = MediaFileUpload(source_path)
-        file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-        return file.get('id')
+        return service.files().create(body=file_metadata, media_body=media, fields='id').execute().get('id')
 
-    object_ids = {}
+    media = MediaFileUpload(source_path, chunksize=chunksize, resumable=True)
+    request = service.files().create(body=file_metadata, media_body=media, fields='id')
+    response = None
+    failures = 0
+    while response is None:
+        try:
+            _, response = request.next_chunk()
+            failures = 0
+        except (HttpError, ConnectionError, socket.timeout) as e:
+            if isinstance(e, HttpError) and e.resp.status < 500:
+                raise
+            failures += 1
+            if failures > retries:
+                raise
+            time.sleep(2 ** failures)
+    return response.get('id')
 
-    id = create_dir(name, config['drive_root_id'])
-    object_ids[output_dir] = id
-    drive_path = config['drive_url_prefix'] + id
 
-    for root, dirs, files in os.walk(output_dir):
-        for d in dirs:
-            id = create_dir(d, object_ids[root])
-            object_ids[os.path.join(root, d)] = id
+def upload_outputs(service_factory, name, output_dir, config, workers=8, chunksize=8 * 2**20, pack_threshold=0,
+                   path_manifest=None):
+    """Upload files in `output_dir` to a new Drive folder `name` with `workers` threads
+
+    Files whose contents are in the manifest are not uploaded again, files smaller than `pack_threshold`
+    bytes are packed into one zip archive. `manifest.json` in the folder lists the Drive location of every file.
+    `service_factory` is called once per thread since Drive services are not thread-safe.
+    """
+    local = threading.local()
 
+    def service():
+        if not hasattr(local, 'service'):
+            local.service = service_factory()
+        return local.service
+
+    manifest = UploadManifest(path_manifest) if path_manifest is not None else None
+    uploaded = manifest.load() if manifest is not None else {}
+
+    relpaths = []
+    for root, dirs, files in os.walk(output_dir):
         for f in files:
-            source_path = os.path.join(root, f)
-            id = upload_file(f, source_path, object_ids[root])
-            object_ids[source_path] = id
+            relpaths.append(os.path.relpath(os.path.join(root, f), output_dir))
+    relpaths = sorted(relpaths)
 
+    with ThreadPoolExecutor(workers) as executor:
+        sha256s = list(executor.map(lambda rel: file_sha256(os.path.join(output_dir, rel)), relpaths))
+
+    root_id = create_dir(service(), name, config['drive_root_id'])
+    drive_path = config['drive_url_prefix'] + root_id
+
+    entries = {}
+    to_upload = []
+    to_pack = []
+    for rel, sha256 in zip(relpaths, sha256s):
+        if sha256 in uploaded:
+            entries[rel] = dict(uploaded[sha256], sha256=sha256, status='unchanged')
+        elif pack_threshold > 0 and os.path.getsize(os.path.join(output_dir, rel)) < pack_threshold:
+            to_pack.append((rel, sha256))
+        else:
+            to_upload.append((rel, sha256))
+
+    folder_ids = {'': root_id}
+    lock_folder = threading.RLock()
+
+    def folder_id(reldir):
+        with lock_folder:
+            if reldir not in folder_ids:
+                parent_id = folder_id(os.path.dirname(reldir))
+                folder_ids[reldir] = create_dir(service(), os.path.basename(reldir), parent_id)
+            return folder_ids[reldir]
+
+    def _upload(item):
+        rel, sha256 = item
+        id = upload_file(service(), os.path.basename(rel), os.path.join(output_dir, rel),
+                         folder_id(os.path.dirname(rel)), chunksize=chunksize)
+        return rel, sha256, id
+
+    new_entries = {}
+    with ThreadPoolExecutor(workers) as executor:
+        for rel, sha256, id in executor.map(_upload, to_upload):
+            entries[rel] = {'id': id, 'member': None, 'sha256': sha256, 'status': 'uploaded'}
+            new_entries[sha256] = {'id': id, 'member': None}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if len(to_pack) > 0:
+            path_pack = os.path.join(tmpdir, PACK_FILENAME)
+            with zipfile.ZipFile(path_pack, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                for rel, _ in to_pack:
+                    zf.write(os.path.join(output_dir, rel), rel)
+            pack_id = upload_file(service(), PACK_FILENAME, path_pack, root_id, chunksize=chunksize)
+            for rel, sha256 in to_pack:
+                entries[rel] = {'id': pack_id, 'member': rel, 'sha256': sha256, 'status': 'packed'}
+                new_entries[sha256] = {'id': pack_id, 'member': rel}
+
+        path_job_manifest = os.path.join(tmpdir, MANIFEST_FILENAME)
+        with open(path_job_manifest, 'w') as f:
+            json.dump(entries, f, indent=4, sort_keys=True)
+        upload_file(service(), MANIFEST_FILENAME, path_job_manifest, root_id, chunksize=chunksize)
+
+    if manifest is not None and len(new_entries) > 0:
+        manifest.update(new_entries)
+
+    print("uploaded {} files ({} packed, {} unchanged) to {}".format(
+        len(to_upload), len(to_pack), len(relpaths) - len(to_upload) - len(to_pack), drive_path))
     return drive_path
 
 
+def main(argv=None):
+    flush_results(blocking=FLAGS.flush_blocking)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -2,19 +2,22 @@
 # -*- coding: utf-8 -*-
 
 import os
+import csv
+import gzip
+import collections
+import multiprocessing
 
-import pandas as pd
 import numpy as np
-from skimage.util import crop
 from tensorflow.keras.models import load_model
 import tensorflow.keras.backend as K
 import tensorflow as tf
 from skimage.transform import resize
-from tqdm import tnrange, tqdm_notebook, tqdm
+from tqdm import tqdm
 
-from util import RLenc, sigmoid
+from util import RLenc, sigmoid, load_input_size
 from dataset import Dataset
 from metrics import mean_iou, mean_score, weighted_bce_dice_loss
+from timing import StageTimer
 from constant import *
 
 tf.flags.DEFINE_string(
@@ -44,16 +47,60 @@ tf.flags.DEFINE_float(
 
 tf.flags.DEFINE_bool('with_depth', False, """whether to use depth information""")
 
+tf.flags.DEFINE_integer(
+    'workers', 4, """number of processes to crop, threshold and encode predictions (0: in main process)""")
+
+tf.flags.DEFINE_string(
+    'timing', None, """path to json of time of each stage, printed as a table (default: not measured)""")
+
 FLAGS = tf.flags.FLAGS
 
 
+def encode_batch(args):
+    """Crop, threshold and run-length encode predictions of a batch
+
+    Return rows of submission and time of stages, which is empty if `timed` is False.
+    """
+    ys_logits, ids, adjust, threshold, timed = args
+    timer = StageTimer(enabled=timed)
+    rows = []
+    for logits, id in zip(ys_logits, ids):
+        with timer.stage('sigmoid'):
+            pred = sigmoid(np.squeeze(logits))
+        with timer.stage('crop/resize'):
+            if adjust in ['resize']:
+                pred = resize(pred, (ORIG_HEIGHT, ORIG_WIDTH), mode='constant', preserve_range=True)
+            elif adjust in ['reflect', 'constant', 'symmetric']:
+                height, width = pred.shape[:2]
+                top = (height - ORIG_HEIGHT) // 2
+                left = (width - ORIG_WIDTH) // 2
+                pred = pred[top:top + ORIG_HEIGHT, left:left + ORIG_WIDTH]
+        with timer.stage('rle'):
+            rows.append((os.path.splitext(id)[0], RLenc(pred > threshold)))
+    return rows, timer.stages
+
+
+def open_submission(path):
+    """Open submission to write, compressed by gzip if path ends with .gz"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', newline='')
+    return open(path, 'w', newline='')
+
+
 def main(argv=None):
 
+    timer = StageTimer(enabled=FLAGS.timing is not None)
+
     if not tf.gfile.Exists(os.path.dirname(FLAGS.submission)):
         tf.gfile.MakeDirs(os.path.dirname(FLAGS.submission))
 
-    dataset = Dataset(FLAGS.input)
-    iter_test  = dataset.gen_test(batch_size=FLAGS.batch_size, adjust=FLAGS.adjust, with_depth=FLAGS.with_depth)
+    # workers are forked before TensorFlow session is created
+    pool = multiprocessing.Pool(FLAGS.workers) if FLAGS.workers > 0 else None
+
+    with timer.stage('file listing'):
+        dataset = Dataset(FLAGS.input)
+    iter_test  = dataset.gen_test(batch_size=FLAGS.batch_size, adjust=FLAGS.adjust, with_depth=FLAGS.with_depth,
+                                  target_shape=load_input_size(FLAGS.model))
 
     sess = tf.Session(config=tf.ConfigProto(
         allow_soft_placement=True,  gpu_options=tf.GPUOptions(
@@ -61,39 +108,51 @@ def main(argv=None):
     K.set_session(sess)
 
     path_model = os.path.join(FLAGS.model, NAME_MODEL)
-    model = load_model(path_model, compile=False)
-    model.compile(optimizer="adam", loss='binary_crossentropy')
+    with timer.stage('model load'):
+        model = load_model(path_model, compile=False)
+        model.compile(optimizer="adam", loss='binary_crossentropy')
 
     num_batch = int(np.ceil(len(dataset) / FLAGS.batch_size))
     sample_tensor = iter_test.get_next()
 
-    preds_test_upsampled = []
-    test_ids = []
-    for id_batch in tqdm(range(num_batch)):
-        xs, paths = sess.run(sample_tensor)
-        ids = np.asarray([os.path.split(path)[1].decode() for path in paths])
-        test_ids.extend(ids)
-        ys_logits = model.predict_on_batch(xs)
-        ys_pred = sigmoid(ys_logits)
-
-        for pred in ys_pred:
-            pred = np.squeeze(pred)
-            if FLAGS.adjust in ['resize']:
-                pred = resize(pred, (ORIG_HEIGHT, ORIG_WIDTH), mode='constant', preserve_range=True)
-            elif FLAGS.adjust in ['reflect', 'constant', 'symmetric']:
-                height_padding = ((IM_HEIGHT - ORIG_HEIGHT) // 2, IM_HEIGHT - ORIG_HEIGHT - (IM_HEIGHT - ORIG_HEIGHT) // 2)
-                width_padding = ((IM_WIDTH - ORIG_WIDTH) // 2, IM_WIDTH - ORIG_WIDTH - (IM_WIDTH - ORIG_WIDTH) // 2)
-                pred = crop(pred, (height_padding, width_padding))
-            preds_test_upsampled.append(pred)
-
-    # 四捨五入している
-    pred_dict = {fn[:-4]: RLenc((preds_test_upsampled[i] > FLAGS.threshold).astype(np.float)) for i, fn in tqdm_notebook(enumerate(test_ids))}
-
-    sub = pd.DataFrame.from_dict(pred_dict, orient='index')
-    sub.index.names = ['id']
-    sub.columns = ['rle_mask']
-    sub.to_csv(FLAGS.submission)
+    def write(result):
+        rows, stages = result
+        timer.merge(stages)
+        with timer.stage('csv write', len(rows)):
+            writer.writerows(rows)
+
+    # rows are written in order of batches while next batches are inferred, so memory does not grow with test set
+    with open_submission(FLAGS.submission) as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id', 'rle_mask'])
+        pending = collections.deque()
+        for id_batch in tqdm(range(num_batch)):
+            with timer.stage('decode wait'):
+                xs, paths = sess.run(sample_tensor)
+            ids = [os.path.split(path)[1].decode() for path in paths]
+            timer.count(len(ids))
+            with timer.stage('forward', len(ids)):
+                ys_logits = model.predict_on_batch(xs)
+            args = (ys_logits, ids, FLAGS.adjust, FLAGS.threshold, timer.enabled)
+            if pool is None:
+                write(encode_batch(args))
+                continue
+            pending.append(pool.apply_async(encode_batch, (args,)))
+            while len(pending) > 0 and (len(pending) > 2 * FLAGS.workers or pending[0].ready()):
+                with timer.stage('encode wait'):
+                    result = pending.popleft().get()
+                write(result)
+        while len(pending) > 0:
+            with timer.stage('encode wait'):
+                result = pending.popleft().get()
+            write(result)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    timer.report(FLAGS.timing)
 
 
 if __name__ == '__main__':
-    tf.app.run()
\ No newline at end of file
+    tf.app.run()
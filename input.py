@@ -1,136 +1,229 @@
 import os
 import sys
+import json
+from multiprocessing import Pool, RawArray
 
 import cv2
 import numpy as np
 from sklearn.model_selection import KFold
 from tqdm import tqdm_notebook
 from skimage.transform import resize
-from skimage.util import pad
 from tensorflow.keras.preprocessing.image import load_img, img_to_array, ImageDataGenerator
 
 from constant import *
-from random_erase import RandomErasing
+from random_erase import BatchRandomErasing
+from util import files_digest
+from dataset_index import coverage_weight_params
+
+
+# mask is stored as uint8 scaled by MASK_SCALE, weight as float16
+MASK_SCALE = 255
+CACHE_META_FILENAME = "meta.json"
+
+_ARRAYS = {}
+
+
+def _get_shape(adjust):
+    if adjust in ['resize', 'resize-cv', 'pad']:
+        return IM_HEIGHT, IM_WIDTH
+    elif adjust in ['never']:
+        return ORIG_HEIGHT, ORIG_WIDTH
+    raise ValueError("adjust-mode {} is not supported".format(adjust))
+
+
+def _get_padding():
+    height_padding = ((IM_HEIGHT - ORIG_HEIGHT) // 2, IM_HEIGHT - ORIG_HEIGHT - (IM_HEIGHT - ORIG_HEIGHT) // 2)
+    width_padding = ((IM_WIDTH - ORIG_WIDTH) // 2, IM_WIDTH - ORIG_WIDTH - (IM_WIDTH - ORIG_WIDTH) // 2)
+    return height_padding, width_padding
+
+
+def _adjust_image(x, adjust, interpolation):
+    if adjust in ['resize', 'resize-cv']:
+        x = cv2.resize(x, (IM_WIDTH, IM_HEIGHT), interpolation=interpolation)
+    elif adjust == 'pad':
+        (top, bottom), (left, right) = _get_padding()
+        x = cv2.copyMakeBorder(x, top, bottom, left, right, cv2.BORDER_REFLECT_101)
+    return x
+
+
+def _init_worker(arrays):
+    """Attach preallocated arrays, given as (name, shape, dtype, RawArray or path of .npy)"""
+    for name, shape, dtype, buf in arrays:
+        if isinstance(buf, str):
+            _ARRAYS[name] = np.load(buf, mmap_mode='r+')
+        else:
+            _ARRAYS[name] = np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+def _load_sample(args):
+    """Decode and adjust n-th sample into the shared arrays, return coverage of its original mask"""
+    n, path_input, id_, adjust = args
+    x = cv2.imread(os.path.join(path_input, 'images', id_), cv2.IMREAD_GRAYSCALE)
+    _ARRAYS['X'][n, :, :, 0] = _adjust_image(x, adjust, cv2.INTER_LINEAR)
+    if 'M' not in _ARRAYS:
+        return None
+
+    mask = cv2.imread(os.path.join(path_input, 'masks', id_), cv2.IMREAD_GRAYSCALE)
+    mask = (mask > 127).astype(np.float32)
+    coverage = float(np.mean(mask))
+    interpolation = cv2.INTER_NEAREST if adjust == 'resize-cv' else cv2.INTER_LINEAR
+    mask = _adjust_image(mask, adjust, interpolation)
+    _ARRAYS['M'][n, :, :, 0] = np.round(mask * MASK_SCALE).astype(np.uint8)
+    return coverage
 
 
 class Dataset(object):
-    def __init__(self, path_input):
+    def __init__(self, path_input, processes=None, path_cache=None):
+        """
+        processes: number of processes to decode images (default: number of CPUs)
+        path_cache: directory to persist loaded arrays as .npy, reloaded as memmaps by the next load,
+            arrays of train and test are stored in its subdirectories 'train' and 'test'
+        """
         self.path_input = path_input
-
+        self.processes = processes
+        self.path_cache = path_cache
+
+    def _cache_dir(self, split):
+        return os.path.join(self.path_cache, split)
+
+    def _load_cached(self, key, split):
+        if self.path_cache is None:
+            return None
+        path_cache = self._cache_dir(split)
+        path_meta = os.path.join(path_cache, CACHE_META_FILENAME)
+        if not os.path.exists(path_meta):
+            return None
+        with open(path_meta) as f:
+            meta = json.load(f)
+        if meta['key'] != key:
+            return None
+        print('Loading cached arrays from {}'.format(path_cache))
+        arrays = {name: np.load(os.path.join(path_cache, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+        return np.array(meta['ids']), arrays
+
+    def _load_parallel(self, ids, adjust, with_mask, split):
+        """Decode images (and masks) of `ids` with a process pool into preallocated uint8 arrays"""
+        im_height, im_width = _get_shape(adjust)
+        shape = (len(ids), im_height, im_width, IM_CHAN)
+        names = ['X', 'M'] if with_mask else ['X']
+
+        specs = []
+        if self.path_cache is not None:
+            path_cache = self._cache_dir(split)
+            os.makedirs(path_cache, exist_ok=True)
+            path_meta = os.path.join(path_cache, CACHE_META_FILENAME)
+            if os.path.exists(path_meta):
+                os.remove(path_meta)
+            for name in names:
+                path = os.path.join(path_cache, name + '.npy')
+                np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape).flush()
+                specs.append((name, shape, np.uint8, path))
+        else:
+            for name in names:
+                specs.append((name, shape, np.uint8, RawArray('B', int(np.prod(shape)))))
+
+        tasks = [(n, self.path_input, id_, adjust) for n, id_ in enumerate(ids)]
+        with Pool(self.processes, initializer=_init_worker, initargs=(specs,)) as pool:
+            coverage = list(tqdm_notebook(pool.imap(_load_sample, tasks, chunksize=64), total=len(tasks)))
+
+        _init_worker(specs)
+        arrays = {name: _ARRAYS.pop(name) for name in names}
+        coverage = np.array(coverage, dtype=np.float64) if with_mask else None
+        return arrays, coverage
+
+    def _create_weight(self, masks, coverage, adjust, weight_fg, weight_bg, weight_adaptive, chunk=512):
+        """Weight maps of all samples as float16, computed vectorized over chunks of the stack"""
+        if self.path_cache is not None:
+            weights = np.lib.format.open_memmap(
+                os.path.join(self._cache_dir('train'), 'W.npy'), mode='w+', dtype=np.float16, shape=masks.shape)
+        else:
+            weights = np.empty(masks.shape, dtype=np.float16)
+
+        params = coverage_weight_params(coverage, weight_fg, weight_bg, weight_adaptive, num=len(masks))
+        fg, bg = params[:, 0, None, None, None], params[:, 1, None, None, None]
+        for start in range(0, len(masks), chunk):
+            s = slice(start, start + chunk)
+            # linear in mask, same as interpolating the weight map along with the mask
+            weights[s] = bg[s] + (fg[s] - bg[s]) * (masks[s] / np.float32(MASK_SCALE))
+
+        if adjust == 'pad':
+            (top, bottom), (left, right) = _get_padding()
+            weights[:, :top] = 0.0
+            weights[:, weights.shape[1] - bottom:] = 0.0
+            weights[:, :, :left] = 0.0
+            weights[:, :, weights.shape[2] - right:] = 0.0
+        return weights
+
+    def _save_meta(self, key, ids, names, split):
+        if self.path_cache is None:
+            return
+        for array in [self.X_samples, self.M_samples, self.W_samples]:
+            if isinstance(array, np.memmap):
+                array.flush()
+        meta = {'key': key, 'ids': list(ids), 'arrays': names}
+        with open(os.path.join(self._cache_dir(split), CACHE_META_FILENAME), 'w') as f:
+            json.dump(meta, f)
 
     def load_train(self, adjust='resize', weight_fg=1.0, weight_bg=1.0, weight_adaptive=None):
         train_ids = next(os.walk(os.path.join(self.path_input, "images")))[2]
         train_ids = sorted(train_ids)
 
-        # Get and resize train images and masks
-        if adjust in ['resize', 'resize-cv', 'pad']:
-            im_height, im_width = IM_HEIGHT, IM_WIDTH
-        elif adjust in ['never']:
-            im_height, im_width = ORIG_HEIGHT, ORIG_WIDTH
+        key = {'path_input': os.path.abspath(self.path_input), 'adjust': adjust, 'weight_fg': weight_fg,
+               'weight_bg': weight_bg, 'num_samples': len(train_ids),
+               'files': files_digest(self.path_input, train_ids, ['images', 'masks']),
+               'weight_adaptive': list(weight_adaptive) if weight_adaptive is not None else None}
+        cached = self._load_cached(key, 'train')
+        if cached is not None:
+            self.id_samples, arrays = cached
+            self.X_samples, self.M_samples, self.W_samples = arrays['X'], arrays['M'], arrays['W']
+            return
 
-        X_samples = np.zeros((len(train_ids), im_height, im_width, IM_CHAN), dtype=np.uint8)
-        Y_samples = np.zeros((len(train_ids), im_height, im_width, 2), dtype=np.float)
         print('Getting and resizing train images and masks ... ')
         sys.stdout.flush()
-        for n, id_ in tqdm_notebook(enumerate(train_ids), total=len(train_ids)):
-            path = self.path_input
-            img_x = load_img(path + '/images/' + id_)
-            img_m = load_img(path + '/masks/' + id_)
-            x = img_to_array(img_x)[:, :, 1]
-            mask = np.round(img_to_array(img_m)[:, :, 1] / 255)
-            weight = np.empty_like(mask, dtype=np.float32)
-
-            if weight_fg == 1.0 and weight_bg == 1.0 and weight_adaptive is None:
-                weight.fill(1.0)
-            elif weight_adaptive is not None:
-                # Threshold to apply weight_adaptive
-                tmin, tmax = weight_adaptive
-                coverage_fg = np.mean(mask)
-                if coverage_fg > tmax or coverage_fg == 0.0:
-                    weight.fill(1.0)
-                elif coverage_fg < tmin:
-                    weight_bg = 0.5 / (1 - coverage_fg)
-                    weight_fg = (1-weight_bg * (1-coverage_fg)) / coverage_fg
-                    weight[np.where(mask>0.5)] = weight_fg
-                    weight[np.where(mask<=0.5)] = weight_bg
-                else:
-                    weight[np.where(mask>0.5)] = 0.5 / coverage_fg
-                    weight[np.where(mask<=0.5)] = 0.5 / (1 - coverage_fg)
-
-                assert np.any(np.isinf(weight)) == False
-                assert 0.99 <= np.mean(weight) <= 1.01
-            else:
-                weight[np.where(mask>0.5)] = weight_fg
-                weight[np.where(mask<=0.5)] = weight_bg
-
-            if adjust == 'resize':
-                x = resize(x, (IM_HEIGHT, IM_WIDTH, 1), mode='constant', preserve_range=True)
-                mask = resize(mask, (IM_HEIGHT, IM_WIDTH, 1), mode='constant', preserve_range=True)
-                weight = resize(weight, (IM_HEIGHT, IM_WIDTH, 1), mode='constant', preserve_range=True)
-            if adjust == 'resize-cv':
-                x = np.reshape(cv2.resize(x, (IM_HEIGHT, IM_WIDTH), interpolation=cv2.INTER_LINEAR), (IM_HEIGHT, IM_WIDTH, 1))
-                mask = np.reshape(cv2.resize(mask, (IM_HEIGHT, IM_WIDTH), interpolation=cv2.INTER_NEAREST), (IM_HEIGHT, IM_WIDTH, 1))
-                weight = np.reshape(cv2.resize(weight, (IM_HEIGHT, IM_WIDTH), interpolation=cv2.INTER_NEAREST), (IM_HEIGHT, IM_WIDTH, 1))
-            elif adjust == 'pad':
-                height_padding = ((IM_HEIGHT - ORIG_HEIGHT) // 2, IM_HEIGHT - ORIG_HEIGHT - (IM_HEIGHT - ORIG_HEIGHT) // 2)
-                width_padding = ((IM_WIDTH - ORIG_WIDTH) // 2, IM_WIDTH - ORIG_WIDTH - (IM_WIDTH - ORIG_WIDTH) // 2)
-                constant_values = ((0,0), (0,0))
-                x = pad(x, (height_padding, width_padding), mode='reflect')
-                mask = pad(mask, (height_padding, width_padding), mode='reflect')
-                weight = pad(weight, (height_padding, width_padding), mode='constant', constant_values=constant_values)
-                x = np.reshape(x, newshape=(im_height, im_width, IM_CHAN))
-                mask = np.reshape(mask, newshape=(im_height, im_width, 1))
-                weight = np.reshape(weight, newshape=(im_height, im_width, 1))
-            elif adjust == 'never':
-                x = np.reshape(x, newshape=(im_height, im_width, IM_CHAN))
-                mask = np.reshape(mask, newshape=(im_height, im_width, 1))
-                weight = np.reshape(weight, newshape=(im_height, im_width, 1))
-
-            mask_and_weight = np.concatenate((mask, weight), axis=2)
-            X_samples[n] = x
-            Y_samples[n] = mask_and_weight
-
+        arrays, coverage = self._load_parallel(train_ids, adjust, with_mask=True, split='train')
         print('Done!')
 
-        id_samples = np.array(train_ids)
-
-        self.id_samples = id_samples
-        self.X_samples = X_samples
-        self.Y_samples = Y_samples
+        self.id_samples = np.array(train_ids)
+        self.X_samples = arrays['X']
+        self.M_samples = arrays['M']
+        self.W_samples = self._create_weight(
+            self.M_samples, coverage, adjust, weight_fg, weight_bg, weight_adaptive)
+        self._save_meta(key, train_ids, ['X', 'M', 'W'], 'train')
 
     def load_test(self, adjust='resize'):
         test_ids = next(os.walk(os.path.join(self.path_input, "images")))[2]
         test_ids = sorted(test_ids)
 
-        # Get and resize train images and masks
-        if adjust in ['resize', 'pad']:
-            im_height, im_width = IM_HEIGHT, IM_WIDTH
-        elif adjust in ['never']:
-            im_height, im_width = ORIG_HEIGHT, ORIG_WIDTH
+        key = {'path_input': os.path.abspath(self.path_input), 'adjust': adjust, 'num_samples': len(test_ids),
+               'files': files_digest(self.path_input, test_ids, ['images'])}
+        cached = self._load_cached(key, 'test')
+        if cached is not None:
+            self.id_samples, arrays = cached
+            self.X_samples = arrays['X']
+            return
 
-        X_samples = np.zeros((len(test_ids), im_height, im_width, IM_CHAN), dtype=np.uint8)
         print('Getting and resizing test images ... ')
         sys.stdout.flush()
-        for n, id_ in tqdm_notebook(enumerate(test_ids), total=len(test_ids)):
-            path = self.path_input
-            img = load_img(path + '/images/' + id_)
-            x = img_to_array(img)[:, :, 1]
-            if adjust == 'resize':
-                X_samples[n] = resize(x, (IM_HEIGHT, IM_WIDTH, 1), mode='constant', preserve_range=True)
-            elif adjust == 'pad':
-                height_padding = ((IM_HEIGHT - ORIG_HEIGHT) // 2, IM_HEIGHT - ORIG_HEIGHT - (IM_HEIGHT - ORIG_HEIGHT) // 2)
-                width_padding = ((IM_WIDTH - ORIG_WIDTH) // 2, IM_WIDTH - ORIG_WIDTH - (IM_WIDTH - ORIG_WIDTH) // 2)
-                x = pad(x, (height_padding, width_padding), mode='reflect')
-                X_samples[n] = np.reshape(x, newshape=(im_height, im_width, IM_CHAN))
-            else:
-                X_samples[n] = np.reshape(x, newshape=(im_height, im_width, IM_CHAN))
-
+        arrays, _ = self._load_parallel(test_ids, adjust, with_mask=False, split='test')
         print('Done!')
 
-        id_samples = np.array(test_ids)
+        self.id_samples = np.array(test_ids)
+        self.X_samples = arrays['X']
+        self.M_samples = None
+        self.W_samples = None
+        self._save_meta(key, test_ids, ['X'], 'test')
+
+    def get_mask_and_weight(self, index=None):
+        """Float32 array of concatenated mask and weight, of samples at `index` or all samples"""
+        if index is None:
+            index = np.arange(len(self.M_samples))
+        mask = self.M_samples[index].astype(np.float32) / MASK_SCALE
+        weight = self.W_samples[index].astype(np.float32)
+        return np.concatenate((mask, weight), axis=3)
 
-        self.id_samples = id_samples
-        self.X_samples = X_samples
+    @property
+    def Y_samples(self):
+        return self.get_mask_and_weight()
 
     @property
     def num_samples(self):
@@ -152,11 +245,11 @@ class Dataset(object):
                 break
 
         self.X_train = self.X_samples[train_index]
-        self.Y_train = self.Y_samples[train_index]
+        self.Y_train = self.get_mask_and_weight(train_index)
         self.id_train = self.id_samples[train_index]
 
         self.X_valid = self.X_samples[valid_index]
-        self.Y_valid = self.Y_samples[valid_index]
+        self.Y_valid = self.get_mask_and_weight(valid_index)
         self.id_valid = self.id_samples[valid_index]
 
     def create_train_generator(self, n_splits=10, idx_kfold=0, batch_size=8, augment_dict={}, random_erase=None, shuffle=True, with_id=False):
@@ -166,22 +259,20 @@ class Dataset(object):
         seed = 1
 
         if random_erase == 'pixel':
-            random_erase_x = RandomErasing(seed=seed, min_val=0, max_val=256, pixel_wise=True)
-            random_erase_y = RandomErasing(seed=seed, min_val=0.0, max_val=0.0)
+            random_erase_fn = BatchRandomErasing(seed=seed, min_val=0, max_val=256, pixel_wise=True)
         elif random_erase == 'constant':
-            random_erase_x = RandomErasing(seed=seed, min_val=0, max_val=256, pixel_wise=False)
-            random_erase_y = RandomErasing(seed=seed, min_val=0.0, max_val=0.0)
+            random_erase_fn = BatchRandomErasing(seed=seed, min_val=0, max_val=256, pixel_wise=False)
         else:
-            random_erase_x = None
-            random_erase_y = None
+            random_erase_fn = None
 
-
-        X_train_datagen = ImageDataGenerator(**data_gen_args, preprocessing_function=random_erase_x)
-        Y_train_datagen = ImageDataGenerator(**data_gen_args, preprocessing_function=random_erase_y)
+        X_train_datagen = ImageDataGenerator(**data_gen_args)
+        Y_train_datagen = ImageDataGenerator(**data_gen_args)
         id_train = self.id_train if with_id else None
         X_train_generator = X_train_datagen.flow(self.X_train, y=id_train, seed=seed, batch_size=batch_size, shuffle=shuffle)
         Y_train_generator = Y_train_datagen.flow(self.Y_train, seed=seed, batch_size=batch_size, shuffle=shuffle)
         train_generator = zip(X_train_generator, Y_train_generator)
+        if random_erase_fn is not None:
+            train_generator = _erase_batches(train_generator, random_erase_fn, with_id)
 
         X_valid_datagen = ImageDataGenerator()
         Y_valid_datagen = ImageDataGenerator()
@@ -200,6 +291,15 @@ class Dataset(object):
         return X_sample_generator
 
 
+def _erase_batches(generator, random_erase_fn, with_id=False):
+    """Erase the same rectangles of images and mask_and_weight of each batch"""
+    for xs, ys in generator:
+        images = xs[0] if with_id else xs
+        # batches of ImageDataGenerator are new arrays, safe to modify in place
+        random_erase_fn(images, masks=ys, inplace=True)
+        yield xs, ys
+
+
 def input_test(path_test):
     test_ids = next(os.walk(os.path.join(path_test, "images")))[2]
 
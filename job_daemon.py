@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Job runner daemon which keeps TensorFlow warm between train/eval/predict jobs
+
+The daemon imports TensorFlow, Keras and the modules of the repository once, then runs each job
+of its queue in a process forked from it, so a job pays only for its own entry point module.
+The forked process starts without a Keras session or graph, and exits with them after the job.
+One tensorboard serves all jobs. exec_job.py and exec_opt.py submit jobs with --daemon.
+
+    python job_daemon.py --address ../job_daemon.sock
+"""
+
+import os
+import sys
+import time
+import shlex
+import queue
+import tempfile
+import importlib
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from absl import app, flags
+
+DEFAULT_ADDRESS = "../job_daemon.sock"
+AUTHKEY = b"tgs_salt_model"
+
+# environment variables of the client applied to a job, before TensorFlow is initialized in it
+JOB_ENV_NAMES = ["CUDA_VISIBLE_DEVICES", "OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+# modules imported by the daemon and inherited by jobs, entry point modules must not be here
+PRELOAD_MODULES = ["numpy", "pandas", "cv2", "skimage.transform", "tensorflow", "tensorflow.keras",
+                   "constant", "util", "metrics", "dataset", "model", "checkpoint", "feature_cache"]
+
+
+def parse_command(command):
+    """Return (module, args) of "python <module>.py args...", None if the command is not an entry point"""
+    args = shlex.split(command)
+    if len(args) < 2 or os.path.basename(args[0]) not in ("python", "python3") or not args[1].endswith(".py"):
+        return None
+    if any(arg in ("|", ">", "&&", ";") for arg in args):
+        return None
+    return os.path.splitext(os.path.basename(args[1]))[0], args[2:]
+
+
+def _run_job(module, args, cwd, env, path_stdout, conn):
+    """Run main of `module` with `args` in a forked process, send its startup time to `conn`"""
+    fd = os.open(path_stdout, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    os.chdir(cwd)
+    if cwd not in sys.path:
+        sys.path.insert(0, cwd)
+    os.environ.update(env)
+
+    start = time.time()
+    entry = importlib.import_module(module)
+    conn.send(time.time() - start)
+    conn.close()
+    app.run(entry.main, argv=[module + ".py"] + args)
+
+
+class JobDaemon(object):
+    """Accept jobs at `address` and run them one by one in processes forked from the daemon"""
+    def __init__(self, address, preload=PRELOAD_MODULES, tensorboard_logdir=None, tensorboard_port=6699):
+        start = time.time()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        self.interpreter_startup = time.time() - start
+
+        start = time.time()
+        for module in preload:
+            importlib.import_module(module)
+        self.preload_time = time.time() - start
+        print("Imported {} modules in {:.2f} sec, interpreter starts in {:.2f} sec".format(
+            len(preload), self.preload_time, self.interpreter_startup))
+
+        self.proc_tb = None
+        if tensorboard_logdir is not None:
+            self.proc_tb = subprocess.Popen(
+                ["tensorboard", "--logdir", tensorboard_logdir, "--port", str(tensorboard_port)])
+
+        if os.path.exists(address):
+            os.remove(address)
+        self.listener = Listener(address, family='AF_UNIX', authkey=AUTHKEY)
+        self.jobs = queue.Queue()
+
+    def accept(self):
+        # this thread must not print, a job forked while it holds the lock of stdout would deadlock on its output
+        while True:
+            conn = self.listener.accept()
+            job = conn.recv()
+            self.jobs.put((conn, job))
+
+    def run(self, job):
+        """Run a job in a forked process, return its result"""
+        # jobs are forked from the main thread of the daemon, which never creates a TensorFlow session
+        ctx = multiprocessing.get_context('fork')
+        conn_startup, conn_child = ctx.Pipe(duplex=False)
+        start = time.time()
+        proc = ctx.Process(target=_run_job, args=(job['module'], job['args'], job['cwd'], job['env'],
+                                                  job['path_stdout'], conn_child))
+        proc.start()
+        conn_child.close()
+        try:
+            startup = conn_startup.recv()
+        except EOFError:
+            startup = None
+        proc.join()
+        elapsed = time.time() - start
+        saved = self.interpreter_startup + self.preload_time
+        return {'returncode': proc.exitcode, 'startup': startup, 'saved': saved, 'elapsed': elapsed}
+
+    def serve(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+        try:
+            while True:
+                conn, job = self.jobs.get()
+                print("Starting {} {} ({} jobs in queue)".format(job['module'], ' '.join(job['args']), self.jobs.qsize()))
+                sys.stdout.flush()
+                result = self.run(job)
+                print("Finished {} with code {} in {:.1f} sec, startup {} sec, saved about {:.2f} sec".format(
+                    job['module'], result['returncode'], result['elapsed'],
+                    "{:.2f}".format(result['startup']) if result['startup'] is not None else "-", result['saved']))
+                try:
+                    conn.send(result)
+                except (BrokenPipeError, EOFError):
+                    print("Client of {} has gone".format(job['module']))
+                conn.close()
+        finally:
+            self.listener.close()
+            if self.proc_tb is not None:
+                self.proc_tb.kill()
+
+
+def _echo(path, offset):
+    """Print lines appended to `path` since `offset`, return the new offset"""
+    if not os.path.exists(path):
+        return offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    sys.stdout.write(data.decode('utf-8', errors='replace'))
+    sys.stdout.flush()
+    return offset + len(data)
+
+
+def submit(command, path_stdout, address=DEFAULT_ADDRESS, echo=True, poll_interval=1.0):
+    """Run `command` ("python <module>.py args...") in the daemon at `address` and wait for it
+
+    Output of the job is written to `path_stdout`, and printed while it runs if `echo`.
+    Returns dict of returncode, startup, saved and elapsed seconds.
+    """
+    parsed = parse_command(command)
+    if parsed is None:
+        raise ValueError("{} is not a command of a python entry point".format(command))
+    module, args = parsed
+    path_stdout = os.path.abspath(path_stdout)
+    job = {'module': module, 'args': args, 'cwd': os.getcwd(), 'path_stdout': path_stdout,
+           'env': {name: os.environ[name] for name in JOB_ENV_NAMES if name in os.environ}}
+    conn = Client(address, family='AF_UNIX', authkey=AUTHKEY)
+    conn.send(job)
+    offset = 0
+    while not conn.poll(poll_interval):
+        if echo:
+            offset = _echo(path_stdout, offset)
+    result = conn.recv()
+    conn.close()
+    if echo:
+        _echo(path_stdout, offset)
+    return result
+
+
+def check_submit(command, path_stdout, address=DEFAULT_ADDRESS, echo=True):
+    """Same as `submit`, raise CalledProcessError if the job fails"""
+    result = submit(command, path_stdout, address=address, echo=echo)
+    if result['returncode'] != 0:
+        raise subprocess.CalledProcessError(result['returncode'], command)
+    return result
+
+
+def run_for_last_line(command, address=DEFAULT_ADDRESS, echo=True):
+    """Same as `check_submit` with output to a temporary file, return the last non-empty line of the output"""
+    fd, path_stdout = tempfile.mkstemp(prefix="job-", suffix=".log")
+    os.close(fd)
+    try:
+        result = check_submit(command, path_stdout, address=address, echo=echo)
+        print("startup {:.2f} sec, saved about {:.2f} sec by the daemon".format(result['startup'], result['saved']))
+        last_line = ""
+        with open(path_stdout, errors='replace') as f:
+            for line in f:
+                if line.strip() != "":
+                    last_line = line
+    finally:
+        os.remove(path_stdout)
+    return last_line.replace('\n', '').replace('\r', '')
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    preload = FLAGS.preload if FLAGS.preload is not None else PRELOAD_MODULES
+    daemon = JobDaemon(FLAGS.address, preload, tensorboard_logdir=FLAGS.tensorboard_logdir or None,
+                       tensorboard_port=FLAGS.tensorboard_port)
+    print("Waiting for jobs at {}".format(FLAGS.address))
+    daemon.serve()
+
+
+if __name__ == '__main__':
+    # flags are defined only for the daemon, so that they do not collide with flags of jobs
+    flags.DEFINE_string('address', DEFAULT_ADDRESS, """path to unix socket to accept jobs""")
+    flags.DEFINE_list('preload', None, """modules imported once by the daemon (default: PRELOAD_MODULES)""")
+    flags.DEFINE_string('tensorboard_logdir', "../output", """log directory of tensorboard ("": no tensorboard)""")
+    flags.DEFINE_integer('tensorboard_port', 6699, """port of tensorboard""")
+    app.run(main)
@@ -11,6 +11,7 @@ import errno
 import zipfile
 import json
 from collections import defaultdict
+from multiprocessing import Pool
 from sacred import Experiment, Ingredient
 import numpy as np
 from PIL import Image
@@ -100,6 +101,134 @@ def mkdir_p(path):
             raise
 
 
+def chunks(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def is_up_to_date(path, source_mtime):
+    """Whether `path` exists and is newer than its source"""
+    return os.path.exists(path) and os.path.getmtime(path) >= source_mtime
+
+
+def save_atomic(path, save_fn):
+    """Write by `save_fn(file)` to a temporary file and rename it, so partial outputs are never up to date"""
+    with open(path + '.tmp', 'wb') as f:
+        save_fn(f)
+    os.replace(path + '.tmp', path)
+
+
+# COCO api shared by workers of the pool
+_coco = None
+
+
+def _init_worker(coco):
+    global _coco
+    _coco = coco
+
+
+def map_chunks(fn, coco, args, processes=None):
+    """Yield results of `fn` over `args` in order, in a process pool sharing `coco`"""
+    if processes == 1:
+        _init_worker(coco)
+        for arg in args:
+            yield fn(arg)
+        return
+    with Pool(processes, initializer=_init_worker, initargs=(coco,)) as pool:
+        for result in pool.imap(fn, args):
+            yield result
+
+
+def _convert_png_chunk(args):
+    img_ids, seg_mask_path, source_mtime = args
+    converted = 0
+    for img_id in img_ids:
+        img = _coco.loadImgs(img_id)[0]
+        filename = os.path.join(seg_mask_path, img['file_name'][:-4] + ".png")
+        if is_up_to_date(filename, source_mtime):
+            continue
+        MASK = np.zeros((img['height'], img['width']), dtype=np.uint8)
+        for ann in _coco.imgToAnns[img_id]:
+            MASK[_coco.annToMask(ann) > 0] = ann['category_id']
+        save_atomic(filename, lambda f: Image.fromarray(MASK).save(f, format='PNG'))
+        converted += 1
+    return converted, len(img_ids)
+
+
+def _convert_npy_chunk(args):
+    img_ids, seg_mask_path, source_mtime = args
+    converted = 0
+    for img_id in img_ids:
+        img = _coco.loadImgs(img_id)[0]
+        filename = os.path.join(seg_mask_path, img['file_name'][:-4] + ".npy")
+        if is_up_to_date(filename, source_mtime):
+            continue
+        target_shape = (img['height'], img['width'], max(ids()) + 1)
+        anns = _coco.loadAnns(_coco.getAnnIds(imgIds=img['id'], iscrowd=None))
+        mask_one_hot = np.zeros(target_shape, dtype=np.uint8)
+        mask_one_hot[:, :, 0] = 1  # every pixel begins as background
+        for ann in anns:
+            mask_partial = _coco.annToMask(ann)
+            mask_one_hot[mask_partial > 0, ann['category_id']] = 1
+            mask_one_hot[mask_partial > 0, 0] = 0
+        save_atomic(filename, lambda f: np.save(f, mask_one_hot))
+        converted += 1
+    return converted, len(img_ids)
+
+
+def convert_annotations(coco, seg_mask_path, source_mtime, img_ids, fmt='png', processes=None, chunk_size=64,
+                        progbar=None):
+    """Write segmentation masks of `img_ids` as .png of category ids or one hot encoded .npy
+
+    Masks newer than `source_mtime` are skipped. Returns the number of converted masks.
+    """
+    fn = {'png': _convert_png_chunk, 'npy': _convert_npy_chunk}[fmt]
+    args = [(chunk, seg_mask_path, source_mtime) for chunk in chunks(list(img_ids), chunk_size)]
+    total_converted = 0
+    for converted, num in map_chunks(fn, coco, args, processes):
+        total_converted += converted
+        if progbar is not None:
+            progbar.add(num, [('file_fraction_already_exists', 1 - converted / num)])
+    return total_converted
+
+
+def _histogram_chunk(img_ids):
+    max_bin_count = max(ids()) + 2
+    bin_count = np.zeros(max_bin_count, dtype=np.int64)
+    total_pixels = 0
+    for img_id in img_ids:
+        img = _coco.loadImgs(img_id)[0]
+        anns = _coco.loadAnns(_coco.getAnnIds(imgIds=img['id'], iscrowd=None))
+        # union of masks per category, counted once per pixel
+        unions = {}
+        for ann in anns:
+            mask = _coco.annToMask(ann) > 0
+            cid = ann['category_id']
+            unions[cid] = unions[cid] | mask if cid in unions else mask
+        background = np.ones((img['height'], img['width']), dtype=bool)
+        for mask in unions.values():
+            background &= ~mask
+        # bins are shifted up by 1, so that bin 1 counts background and bin 0 counts no category
+        bins = np.array([1] + [cid + 1 for cid in unions.keys()])
+        masks = np.stack([background] + list(unions.values()))
+        bin_count += np.bincount(bins[np.nonzero(masks)[0]], minlength=max_bin_count)
+        total_pixels += img['height'] * img['width']
+    return bin_count, total_pixels
+
+
+def segmentation_histogram(coco, img_ids, processes=None, chunk_size=64, progbar=None):
+    """Return pixel counts of each category (shifted up by 1) and the total number of pixels of `img_ids`"""
+    bin_count = np.zeros(max(ids()) + 2, dtype=np.int64)
+    total_pixels = 0
+    img_id_chunks = chunks(list(img_ids), chunk_size)
+    results = map_chunks(_histogram_chunk, coco, img_id_chunks, processes)
+    for chunk, (chunk_count, chunk_pixels) in zip(img_id_chunks, results):
+        bin_count += chunk_count
+        total_pixels += chunk_pixels
+        if progbar is not None:
+            progbar.add(len(chunk))
+    return bin_count, total_pixels
+
+
 # ============== Ingredient 2: dataset =======================
 data_coco = Experiment("dataset")
 
@@ -149,6 +278,9 @@ def coco_config():
     ]
     filenames = image_filenames + annotation_filenames
     seg_mask_path = os.path.join(dataset_path, 'seg_mask')
+    # number of processes (None: number of CPUs) and images per task to convert annotations
+    processes = None
+    chunk_size = 64
     annotation_json = [
         'annotations/instances_train2014.json',
         'annotations/instances_val2014.json'
@@ -192,7 +324,8 @@ def coco_download(dataset_path, filenames, dataset_root, urls, md5s, annotation_
 
 
 @data_coco.command
-def coco_json_to_segmentation(seg_mask_output_paths, annotation_paths, seg_mask_image_paths, verbose):
+def coco_json_to_segmentation(seg_mask_output_paths, annotation_paths, seg_mask_image_paths, verbose,
+                              processes=None, chunk_size=64):
     for (seg_mask_path, annFile, image_path) in zip(seg_mask_output_paths, annotation_paths, seg_mask_image_paths):
         print('Loading COCO Annotations File: ', annFile)
         print('Segmentation Mask Output Folder: ', seg_mask_path)
@@ -212,77 +345,20 @@ def coco_json_to_segmentation(seg_mask_output_paths, annotation_paths, seg_mask_
               'an opportunity to improve how this training data is handled &'
               'integrated with your training scripts and utilities...')
         coco = COCO(annFile)
+        # masks older than the annotation file are converted again
+        source_mtime = os.path.getmtime(annFile)
 
         print('Converting Annotations to Segmentation Masks...')
         mkdir_p(seg_mask_path)
-        total_imgs = len(coco.imgToAnns.keys())
-        progbar = Progbar(total_imgs + len(coco.getImgIds()), verbose=verbose)
         # 'annotations' was previously 'instances' in an old version
-        for img_num in range(total_imgs):
-            # Both [0]'s are used to extract the element from a list
-            img = coco.loadImgs(coco.imgToAnns[coco.imgToAnns.keys()[img_num]][0]['image_id'])[0]
-            h = img['height']
-            w = img['width']
-            name = img['file_name']
-            root_name = name[:-4]
-            filename = os.path.join(seg_mask_path, root_name + ".png")
-            file_exists = os.path.exists(filename)
-            if file_exists:
-                progbar.update(img_num, [('file_fraction_already_exists', 1)])
-                continue
-            else:
-                progbar.update(img_num, [('file_fraction_already_exists', 0)])
-                print(filename)
-
-            MASK = np.zeros((h, w), dtype=np.uint8)
-            np.where(MASK > 0)
-            for ann in coco.imgToAnns[coco.imgToAnns.keys()[img_num]]:
-                mask = coco.annToMask(ann)
-                idxs = np.where(mask > 0)
-                MASK[idxs] = ann['category_id']
-
-            im = Image.fromarray(MASK)
-            im.save(filename)
+        img_ids_with_anns = list(coco.imgToAnns.keys())
+        img_ids = coco.getImgIds()
+        progbar = Progbar(len(img_ids_with_anns) + len(img_ids), verbose=verbose)
+        convert_annotations(coco, seg_mask_path, source_mtime, img_ids_with_anns, 'png', processes, chunk_size, progbar)
 
         print('\nConverting Annotations to one hot encoded'
               'categorical .npy Segmentation Masks...')
-        img_ids = coco.getImgIds()
-        use_original_dims = True  # not target_shape
-        for idx, img_id in enumerate(img_ids):
-            img = coco.loadImgs(img_id)[0]
-            name = img['file_name']
-            root_name = name[:-4]
-            filename = os.path.join(seg_mask_path, root_name + ".npy")
-            file_exists = os.path.exists(filename)
-            if file_exists:
-                progbar.add(1, [('file_fraction_already_exists', 1)])
-                continue
-            else:
-                progbar.add(1, [('file_fraction_already_exists', 0)])
-
-            if use_original_dims:
-                target_shape = (img['height'], img['width'], max(ids()) + 1)
-            ann_ids = coco.getAnnIds(imgIds=img['id'], iscrowd=None)
-            anns = coco.loadAnns(ann_ids)
-            mask_one_hot = np.zeros(target_shape, dtype=np.uint8)
-            mask_one_hot[:, :, 0] = 1  # every pixel begins as background
-            # mask_one_hot = cv2.resize(mask_one_hot,
-            #                           target_shape[:2],
-            #                           interpolation=cv2.INTER_NEAREST)
-
-            for ann in anns:
-                mask_partial = coco.annToMask(ann)
-                # mask_partial = cv2.resize(mask_partial,
-                #                           (target_shape[1], target_shape[0]),
-                #                           interpolation=cv2.INTER_NEAREST)
-                # # width and height match
-                # assert mask_one_hot.shape[:2] == mask_partial.shape[:2]
-                #    print('another shape:',
-                #          mask_one_hot[mask_partial > 0].shape)
-                mask_one_hot[mask_partial > 0, ann['category_id']] = 1
-                mask_one_hot[mask_partial > 0, 0] = 0
-
-            np.save(filename, mask_one_hot)
+        convert_annotations(coco, seg_mask_path, source_mtime, img_ids, 'npy', processes, chunk_size, progbar)
 
 
 @data_coco.command
@@ -296,7 +372,8 @@ def coco_to_pascal_voc_imageset_txt(voc_imageset_txt_paths, image_dirs,
 
 
 @data_coco.command
-def coco_image_segmentation_stats(seg_mask_output_paths, annotation_paths, seg_mask_image_paths, verbose):
+def coco_image_segmentation_stats(seg_mask_output_paths, annotation_paths, seg_mask_image_paths, verbose,
+                                  processes=None, chunk_size=64):
     for (seg_mask_path, annFile, image_path) in zip(seg_mask_output_paths, annotation_paths, seg_mask_image_paths):
         print('Loading COCO Annotations File: ', annFile)
         print('Segmentation Mask Output Folder: ', seg_mask_path)
@@ -320,55 +397,11 @@ def coco_image_segmentation_stats(seg_mask_output_paths, annotation_paths, seg_m
         nms = set([cat['supercategory'] for cat in cats])
         print('supercategories: \n', ' '.join(nms))
         img_ids = coco.getImgIds()
-        use_original_dims = True  # not target_shape
-        max_ids = max(ids()) + 1  # add background category
-        # 0 indicates no category (not even background) for counting bins
-        max_bin_count = max_ids + 1
-        bin_count = np.zeros(max_bin_count)
-        total_pixels = 0
 
         print('Calculating image segmentation stats...')
         progbar = Progbar(len(img_ids), verbose=verbose)
-        i = 0
-        for idx, img_id in enumerate(img_ids):
-            img = coco.loadImgs(img_id)[0]
-            i += 1
-            progbar.update(i)
-            ann_ids = coco.getAnnIds(imgIds=img['id'], iscrowd=None)
-            anns = coco.loadAnns(ann_ids)
-            target_shape = (img['height'], img['width'], max_ids)
-            # print('\ntarget_shape:', target_shape)
-            mask_one_hot = np.zeros(target_shape, dtype=np.uint8)
-
-            # Note to only count background pixels once, we define a temporary
-            # null class of 0, and shift all class category ids up by 1
-            mask_one_hot[:, :, 0] = 1  # every pixel begins as background
-
-            for ann in anns:
-                mask_partial = coco.annToMask(ann)
-                mask_one_hot[mask_partial > 0, ann['category_id']] = ann['category_id'] + 1
-                mask_one_hot[mask_partial > 0, 0] = 0
-
-            # print( mask_one_hot)
-            # print('initial bin_count shape:', np.shape(bin_count))
-            # flat_mask_one_hot = mask_one_hot.flatten()
-            bincount_result = np.bincount(mask_one_hot.flatten())
-            # print('bincount_result TYPE:', type(bincount_result))
-            # np.array(np.ndarray.flatten(np.bincount(np.ndarray.flatten(np.array(mask_one_hot)).astype(int))).resize(max_bin_count))
-            # print('bincount_result:', bincount_result)
-            # print('bincount_result_shape', np.shape(bincount_result))
-            length = int(np.shape(bincount_result)[0])
-            zeros_to_add = max_bin_count - length
-            z = np.zeros(zeros_to_add)
-            # print('zeros_to_add TYPE:', type(zeros_to_add))
-            # this is a workaround because for some strange reason the
-            # output type of bincount couldn't interact with other numpy arrays
-            bincount_result_long = bincount_result.tolist() + z.tolist()
-            # bincount_result = bincount_result.resize(max_bin_count)
-            # print('bincount_result2:', bincount_result_long)
-            # print('bincount_result2_shape',bincount_result_long)
-            bin_count = bin_count + np.array(bincount_result_long)
-            total_pixels += (img['height'] * img['width'])
+        bin_count, total_pixels = segmentation_histogram(coco, img_ids, processes, chunk_size, progbar)
+        bin_count = bin_count.astype(np.float64)
 
         print('Final Tally:')
         # shift categories back down by 1
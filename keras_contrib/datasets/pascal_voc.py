@@ -22,6 +22,7 @@ import os
 import shutil
 import errno
 import tarfile
+from multiprocessing import Pool
 from sacred import Ingredient, Experiment
 import numpy as np
 from PIL import Image
@@ -264,37 +265,68 @@ def get_pascal_segmentation_image_annotation_filenames_pairs(pascal_root):
     return image_annotation_filename_pairs
 
 
+def read_class_annotation_array_from_berkeley_mat(mat_filename, key='GTcls'):
+
+    #  Mat to png conversion for http://www.cs.berkeley.edu/~bharath2/codes/SBD/download.html
+    # 'GTcls' key is for class segmentation
+    # 'GTinst' key is for instance segmentation
+    # Credit:
+    # https://github.com/martinkersner/train-DeepLab/blob/master/utils.py
+
+    import scipy.io
+
+    mat = scipy.io.loadmat(mat_filename, mat_dtype=True,
+                           squeeze_me=True, struct_as_record=False)
+    return mat[key].Segmentation
+
+
+def convert_berkeley_mat_chunk(filename_pairs):
+    """Convert pairs of (.mat, .png) full paths, skipping .png newer than its .mat.
+    Returns the number of converted files.
+    """
+    converted = 0
+    for mat_file_full_path, png_file_full_path in filename_pairs:
+        if os.path.exists(png_file_full_path) and \
+                os.path.getmtime(png_file_full_path) >= os.path.getmtime(mat_file_full_path):
+            continue
+
+        annotation_array = read_class_annotation_array_from_berkeley_mat(mat_file_full_path)
+
+        # write to a temporary file first, so an interrupted conversion leaves no partial .png
+        tmp_file_full_path = png_file_full_path[:-len('.png')] + '.tmp.png'
+        # TODO: hide 'low-contrast' image warning during saving.
+        io.imsave(tmp_file_full_path, annotation_array.astype(np.uint8))
+        os.replace(tmp_file_full_path, png_file_full_path)
+        converted += 1
+    return converted
+
+
 @data_pascal_voc.command
-def convert_pascal_berkeley_augmented_mat_annotations_to_png(pascal_berkeley_augmented_root):
+def convert_pascal_berkeley_augmented_mat_annotations_to_png(pascal_berkeley_augmented_root,
+                                                             processes=None, chunk_size=64):
     """ Creates a new folder in the root folder of the dataset with annotations stored in .png.
     The function accepts a full path to the root of Berkeley augmented Pascal VOC segmentation
     dataset and converts annotations that are stored in .mat files to .png files. It creates
-    a new folder dataset/cls_png where all the converted files will be located. If this
-    directory already exists the function does nothing. The Berkley augmented dataset
-    can be downloaded from here:
+    a new folder dataset/cls_png where all the converted files will be located. Files which
+    are already converted and newer than their .mat are skipped, so an interrupted conversion
+    can be resumed. The Berkley augmented dataset can be downloaded from here:
     http://www.eecs.berkeley.edu/Research/Projects/CS/vision/grouping/semantic_contours/benchmark.tgz
 
     Parameters
     ----------
     pascal_berkeley_augmented_root : string
         Full path to the root of augmented Berkley PASCAL VOC dataset.
+    processes : int
+        Number of processes to convert files, None for the number of CPUs.
+    chunk_size : int
+        Number of files converted by a task of a process.
 
+    Returns
+    -------
+    converted : int
+        Number of converted files.
     """
 
-    import scipy.io
-
-    def read_class_annotation_array_from_berkeley_mat(mat_filename, key='GTcls'):
-
-        #  Mat to png conversion for http://www.cs.berkeley.edu/~bharath2/codes/SBD/download.html
-        # 'GTcls' key is for class segmentation
-        # 'GTinst' key is for instance segmentation
-        # Credit:
-        # https://github.com/martinkersner/train-DeepLab/blob/master/utils.py
-
-        mat = scipy.io.loadmat(mat_filename, mat_dtype=True,
-                               squeeze_me=True, struct_as_record=False)
-        return mat[key].Segmentation
-
     mat_file_extension_string = '.mat'
     png_file_extension_string = '.png'
     relative_path_to_annotation_mat_files = 'dataset/cls'
@@ -309,34 +341,21 @@ def convert_pascal_berkeley_augmented_mat_annotations_to_png(pascal_berkeley_aug
                                                 relative_path_to_annotation_png_files)
 
     # Create the folder where all the converted png files will be placed
-    # If the folder already exists, do nothing
-    if not os.path.exists(annotation_png_save_fullpath):
-
-        os.makedirs(annotation_png_save_fullpath)
-    else:
-
-        return
+    mkdir_p(annotation_png_save_fullpath)
 
-    mat_files_names = os.listdir(annotation_mat_files_fullpath)
+    mat_files_names = sorted(name for name in os.listdir(annotation_mat_files_fullpath)
+                             if name.endswith(mat_file_extension_string))
 
-    for current_mat_file_name in mat_files_names:
+    filename_pairs = [(os.path.join(annotation_mat_files_fullpath, name),
+                       os.path.join(annotation_png_save_fullpath,
+                                    name[:-mat_file_extension_string_length] + png_file_extension_string))
+                      for name in mat_files_names]
+    chunks = [filename_pairs[i:i + chunk_size] for i in range(0, len(filename_pairs), chunk_size)]
 
-        current_file_name_without_extention = current_mat_file_name[
-            :-mat_file_extension_string_length]
-
-        current_mat_file_full_path = os.path.join(annotation_mat_files_fullpath,
-                                                  current_mat_file_name)
-
-        current_png_file_full_path_to_be_saved = os.path.join(annotation_png_save_fullpath,
-                                                              current_file_name_without_extention)
-
-        current_png_file_full_path_to_be_saved += png_file_extension_string
-
-        annotation_array = read_class_annotation_array_from_berkeley_mat(
-            current_mat_file_full_path)
-
-        # TODO: hide 'low-contrast' image warning during saving.
-        io.imsave(current_png_file_full_path_to_be_saved, annotation_array)
+    if processes == 1:
+        return sum(map(convert_berkeley_mat_chunk, chunks))
+    with Pool(processes) as pool:
+        return sum(pool.imap_unordered(convert_berkeley_mat_chunk, chunks))
 
 
 def get_pascal_berkeley_augmented_segmentation_images_lists_txts(pascal_berkeley_root):
@@ -697,6 +716,10 @@ def voc_config():
     # see get_augmented_pascal_image_annotation_filename_pairs()
     voc_data_subset_mode = 2
 
+    # number of processes (None: number of CPUs) and files per task to convert annotations
+    processes = None
+    chunk_size = 64
+
 
 @data_pascal_voc.capture
 def pascal_voc_files(dataset_path, filenames, dataset_root, urls, md5s):
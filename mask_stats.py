@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Statistics and shape classes of masks, stored as one manifest beside the masks
+
+Masks are classified by vectorized operations over chunks of masks, read in a process pool.
+"""
+
+import os
+import csv
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+MASK_STATS_FILENAME = "mask_stats.csv"
+COLUMNS = ['fg_sum', 'coverage', 'uniform', 'vertical', 'horizontal']
+CHUNK_SIZE = 256
+
+
+def default_path(path_input):
+    return os.path.join(path_input, MASK_STATS_FILENAME)
+
+
+def classify_masks(masks):
+    """Statistics of masks (N, H, W) of 0 or 255, return list of dict of COLUMNS
+
+    uniform: all pixels are foreground or background
+    vertical/horizontal: every column/row is uniform, such as a rectangle cut by the image border
+    """
+    is_empty = masks == 0
+    is_full = masks == 255
+    uniform = np.all(is_empty, axis=(1, 2)) | np.all(is_full, axis=(1, 2))
+    vertical = np.all(np.all(is_empty, axis=1) | np.all(is_full, axis=1), axis=1)
+    horizontal = np.all(np.all(is_empty, axis=2) | np.all(is_full, axis=2), axis=1)
+    fg_sum = np.sum(masks.reshape(len(masks), -1), axis=1, dtype=np.int64)
+    coverage = np.mean(masks > 127, axis=(1, 2))
+    return [{'fg_sum': int(s), 'coverage': float(c), 'uniform': bool(u), 'vertical': bool(v), 'horizontal': bool(h)}
+            for s, c, u, v, h in zip(fg_sum, coverage, uniform, vertical, horizontal)]
+
+
+def _classify_files(paths):
+    return classify_masks(np.stack([cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in paths]))
+
+
+def compute(path_input, ids, masks=None, processes=None):
+    """Statistics of masks of `ids`, {id: dict of COLUMNS}
+
+    masks: decoded masks (N, H, W) or (N, H, W, 1) in the order of ids, read from files of `path_input` if None
+    """
+    chunks = [ids[i:i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE)]
+    if masks is not None:
+        masks = np.reshape(masks, masks.shape[:3])
+        results = [classify_masks(np.asarray(masks[i:i + CHUNK_SIZE])) for i in range(0, len(ids), CHUNK_SIZE)]
+    else:
+        paths = [[os.path.join(path_input, 'masks', idx) for idx in chunk] for chunk in chunks]
+        with Pool(processes) as pool:
+            results = pool.map(_classify_files, paths)
+    stats = {}
+    for chunk, result in zip(chunks, results):
+        stats.update(zip(chunk, result))
+    return stats
+
+
+def is_vert_hori(row):
+    """Whether the mask is vertical or horizontal but not uniform, excluded by filter_vert_hori"""
+    return not row['uniform'] and (row['vertical'] or row['horizontal'])
+
+
+def read(path):
+    """Return {id: dict of COLUMNS}, None if there is no manifest or it lacks columns"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        reader = csv.DictReader(f)
+        if not set(COLUMNS) <= set(reader.fieldnames or []):
+            return None
+        return {row['id']: {'fg_sum': int(row['fg_sum']), 'coverage': float(row['coverage']),
+                            'uniform': row['uniform'] == '1', 'vertical': row['vertical'] == '1',
+                            'horizontal': row['horizontal'] == '1'} for row in reader}
+
+
+def write(path, stats):
+    with open(path + ".tmp", 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id'] + COLUMNS)
+        for idx, row in sorted(stats.items()):
+            writer.writerow([idx] + [int(row[c]) if isinstance(row[c], bool) else row[c] for c in COLUMNS])
+    os.replace(path + ".tmp", path)
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import math
 
 import tensorflow as tf
 from tensorflow.keras.layers import *
@@ -92,16 +93,34 @@ def get_unet_resnet_contrib(input_shape, inputs, encoder='resnet34', residual_un
     else:
         return conv10, conv5
 
-def get_unet_resnet50_shallow(input_shape, inputs, retrain=True, with_bottleneck=False, renorm=False):
-    base_model = resnet50.ResNet50(input_shape=input_shape, input_tensor=inputs, include_top=False, weights='imagenet', renorm=renorm)
+# names of layers used as skip-connections of pretrained encoders
+ENCODER_FEATURES = {
+    'resnet50': ["activation", "activation_9", "activation_21", "activation_39", "activation_48"],
+    'resnet50-shallow': ["activation", "activation_9", "activation_21", "activation_39"],
+    'densenet121': ["conv1/relu", "pool2_conv", "pool3_conv", "pool4_conv", "bn"],
+}
+
+
+def get_encoder_pretrained(input_shape, inputs, encoder='resnet50', retrain=True, renorm=False):
+    if encoder in ['resnet50', 'resnet50-shallow']:
+        base_model = resnet50.ResNet50(input_shape=input_shape, input_tensor=inputs, include_top=False, weights='imagenet', renorm=renorm)
+    elif encoder == 'densenet121':
+        base_model = densenet.DenseNet121(
+            input_shape=input_shape, input_tensor=inputs, include_top=False, weights='imagenet')
+        if renorm:
+            raise NotImplementedError()
+    else:
+        raise ValueError('encoder {} is not supported'.format(encoder))
 
     for i, layer in enumerate(base_model.layers):
         layer.trainable = retrain
 
-    conv1 = base_model.get_layer("activation").output
-    conv2 = base_model.get_layer("activation_9").output
-    conv3 = base_model.get_layer("activation_21").output
-    conv4 = base_model.get_layer("activation_39").output
+    features = [base_model.get_layer(name).output for name in ENCODER_FEATURES[encoder]]
+    return base_model, features
+
+
+def get_decoder_resnet50_shallow(inputs, features, renorm=False):
+    conv1, conv2, conv3, conv4 = features
 
     conv5 = conv_block_simple(conv4, 256, "conv5_1", renorm=renorm)
     conv5 = conv_block_simple(conv5, 256, "conv5_2", renorm=renorm)
@@ -118,26 +137,15 @@ def get_unet_resnet50_shallow(input_shape, inputs, retrain=True, with_bottleneck
     conv8 = conv_block_simple(up8, 64, "conv8_1", renorm=renorm)
     conv8 = conv_block_simple(conv8, 64, "conv8_2", renorm=renorm)
 
-    up9 = concatenate([UpSampling2D()(conv8), base_model.input], axis=-1)
+    up9 = concatenate([UpSampling2D()(conv8), inputs], axis=-1)
     conv9 = conv_block_simple(up9, 32, "conv9_1", renorm=renorm)
     conv9 = conv_block_simple(conv9, 32, "conv9_2", renorm=renorm)
 
-    if not with_bottleneck:
-        return conv9
-    else:
-        return conv9, conv5
-
-def get_unet_resnet50(input_shape, inputs, retrain=True, with_bottleneck=False, renorm=False):
-    base_model = resnet50.ResNet50(input_shape=input_shape, input_tensor=inputs, include_top=False, weights='imagenet', renorm=renorm)
+    return conv9, conv5
 
-    for i, layer in enumerate(base_model.layers):
-        layer.trainable = retrain
 
-    conv1 = base_model.get_layer("activation").output
-    conv2 = base_model.get_layer("activation_9").output
-    conv3 = base_model.get_layer("activation_21").output
-    conv4 = base_model.get_layer("activation_39").output
-    conv5 = base_model.get_layer("activation_48").output
+def get_decoder_resnet50(inputs, features, renorm=False):
+    conv1, conv2, conv3, conv4, conv5 = features
 
     up6 = concatenate([UpSampling2D()(conv5), conv4], axis=-1)
     conv6 = conv_block_simple(up6, 256, "conv6_1", renorm=renorm)
@@ -155,57 +163,89 @@ def get_unet_resnet50(input_shape, inputs, retrain=True, with_bottleneck=False,
     conv9 = conv_block_simple(up9, 64, "conv9_1", renorm=renorm)
     conv9 = conv_block_simple(conv9, 64, "conv9_2", renorm=renorm)
 
-    up10 = concatenate([UpSampling2D()(conv9), base_model.input], axis=-1)
+    up10 = concatenate([UpSampling2D()(conv9), inputs], axis=-1)
     conv10 = conv_block_simple(up10, 32, "conv10_1", renorm=renorm)
     conv10 = conv_block_simple(conv10, 32, "conv10_2", renorm=renorm)
 
-    if not with_bottleneck:
-        return conv10
-    else:
-        return conv10, conv5
+    return conv10, conv5
 
 
-def get_unet_densenet121(input_shape, inputs, retrain=True, with_bottleneck=False, renorm=False):
-    base_model = densenet.DenseNet121(
-        input_shape=input_shape, input_tensor=inputs, include_top=False, weights='imagenet')
+def get_decoder_densenet121(inputs, features):
+    return get_decoder_resnet50(inputs, features)
 
-    if renorm:
-        raise NotImplementedError()
 
-    for i, layer in enumerate(base_model.layers):
-        layer.trainable = retrain
+def get_decoder_pretrained(inputs, features, encoder='resnet50', renorm=False):
+    if encoder == 'resnet50':
+        return get_decoder_resnet50(inputs, features, renorm=renorm)
+    elif encoder == 'resnet50-shallow':
+        return get_decoder_resnet50_shallow(inputs, features, renorm=renorm)
+    elif encoder == 'densenet121':
+        return get_decoder_densenet121(inputs, features)
+    else:
+        raise ValueError('encoder {} is not supported'.format(encoder))
 
-    conv1 = base_model.get_layer("conv1/relu").output
-    conv2 = base_model.get_layer("pool2_conv").output
-    conv3 = base_model.get_layer("pool3_conv").output
-    conv4 = base_model.get_layer("pool4_conv").output
-    conv5 = base_model.get_layer("bn").output
 
-    up6 = concatenate([UpSampling2D()(conv5), conv4], axis=-1)
-    conv6 = conv_block_simple(up6, 256, "conv6_1")
-    conv6 = conv_block_simple(conv6, 256, "conv6_2")
+def get_unet_resnet50_shallow(input_shape, inputs, retrain=True, with_bottleneck=False, renorm=False):
+    base_model, features = get_encoder_pretrained(
+        input_shape, inputs, encoder='resnet50-shallow', retrain=retrain, renorm=renorm)
+    conv9, conv5 = get_decoder_resnet50_shallow(base_model.input, features, renorm=renorm)
 
-    up7 = concatenate([UpSampling2D()(conv6), conv3], axis=-1)
-    conv7 = conv_block_simple(up7, 192, "conv7_1")
-    conv7 = conv_block_simple(conv7, 192, "conv7_2")
+    if not with_bottleneck:
+        return conv9
+    else:
+        return conv9, conv5
 
-    up8 = concatenate([UpSampling2D()(conv7), conv2], axis=-1)
-    conv8 = conv_block_simple(up8, 128, "conv8_1")
-    conv8 = conv_block_simple(conv8, 128, "conv8_2")
+def get_unet_resnet50(input_shape, inputs, retrain=True, with_bottleneck=False, renorm=False):
+    base_model, features = get_encoder_pretrained(
+        input_shape, inputs, encoder='resnet50', retrain=retrain, renorm=renorm)
+    conv10, conv5 = get_decoder_resnet50(base_model.input, features, renorm=renorm)
 
-    up9 = concatenate([UpSampling2D()(conv8), conv1], axis=-1)
-    conv9 = conv_block_simple(up9, 64, "conv9_1")
-    conv9 = conv_block_simple(conv9, 64, "conv9_2")
+    if not with_bottleneck:
+        return conv10
+    else:
+        return conv10, conv5
 
-    up10 = concatenate([UpSampling2D()(conv9), base_model.input], axis=-1)
-    conv10 = conv_block_simple(up10, 32, "conv10_1")
-    conv10 = conv_block_simple(conv10, 32, "conv10_2")
+
+def get_unet_densenet121(input_shape, inputs, retrain=True, with_bottleneck=False, renorm=False):
+    base_model, features = get_encoder_pretrained(
+        input_shape, inputs, encoder='densenet121', retrain=retrain, renorm=renorm)
+    conv10, conv5 = get_decoder_densenet121(base_model.input, features)
 
     if not with_bottleneck:
         return conv10
     else:
         return conv10, conv5
 
+# multiple of input height/width required by each model, 2 ** (number of down-samplings)
+STRIDE_MULTIPLES = {
+    'unet': 16,
+    'ref2': 16,
+    'contrib': 32,
+    'resnet50': 32,
+    'resnet50-shallow': 16,
+    'densenet121': 32,
+}
+
+
+def get_stride_multiple(contrib=None, pretrained=None, use_ref=False, use_ref2=False, depth=5):
+    """Return multiple of input size required by the model selected with the same arguments as train.py"""
+    if contrib is not None:
+        return STRIDE_MULTIPLES['contrib']
+    elif pretrained is not None:
+        return STRIDE_MULTIPLES[pretrained]
+    elif use_ref2:
+        return STRIDE_MULTIPLES['ref2']
+    elif use_ref:
+        return 2 ** depth
+    else:
+        return STRIDE_MULTIPLES['unet']
+
+
+def get_minimal_size(size, multiple):
+    """Return the smallest multiple of `multiple` which is not smaller than `size`"""
+    return int(math.ceil(size / multiple) * multiple)
+
+
 def build_model_contrib(height, width, channels, encoder='resnet34', residual_unit='v2',
                            spatial_dropout=None, preprocess=False, last_kernel=1, last_1x1=False):
     input_shape=[height, width, channels]
@@ -264,6 +304,45 @@ def build_model_pretrained(height, width, channels, encoder='resnet50',
     return model
 
 
+def build_encoder_pretrained(model, encoder='resnet50'):
+    """Sub-model of a model built by `build_model_pretrained` which outputs skip-connections of the encoder"""
+    features = [model.get_layer(name).output for name in ENCODER_FEATURES[encoder]]
+    return Model(inputs=model.inputs, outputs=features)
+
+
+def build_decoder_pretrained(height, width, channels, feature_shapes, encoder='resnet50',
+                             spatial_dropout=None, renorm=False, last_kernel=1, last_1x1=False):
+    """Decoder of `build_model_pretrained` which takes the input image and cached encoder features
+
+    Layer names are the same as `build_model_pretrained`, so weights are exchangeable with `copy_weights_by_name`.
+    """
+    inputs = Input(shape=[height, width, channels], name="image")
+    features = [Input(shape=shape, name="feature{}".format(i + 1)) for i, shape in enumerate(feature_shapes)]
+
+    outputs, _ = get_decoder_pretrained(inputs, features, encoder=encoder, renorm=renorm)
+
+    if spatial_dropout is not None:
+        outputs = SpatialDropout2D(spatial_dropout)(outputs)
+
+    if not last_1x1:
+        outputs = Conv2D(1, (last_kernel, last_kernel), name='prediction', padding='same')(outputs)
+    else:
+        outputs = Conv2D(32, (last_kernel, last_kernel), name='last', padding='same')(outputs)
+        outputs = Conv2D(1, (1, 1), name='prediction', padding='same')(outputs)
+
+    model = Model(inputs=[inputs] + features, outputs=[outputs])
+    return model
+
+
+def copy_weights_by_name(src, dst):
+    """Copy weights of layers in `src` to layers with the same name in `dst`"""
+    dst_names = set(layer.name for layer in dst.layers)
+    for layer in src.layers:
+        if len(layer.weights) == 0 or layer.name not in dst_names:
+            continue
+        dst.get_layer(layer.name).set_weights(layer.get_weights())
+
+
 def build_model_pretrained_deep_supervised(height, width, channels, encoder='resnet50',
                            spatial_dropout=None, preprocess=False, retrain=True, renorm=False, last_kernel=1, last_1x1=False):
     input_shape=[height, width, channels]
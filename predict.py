@@ -16,7 +16,9 @@ import pandas as pd
 from dataset import Dataset
 from metrics import mean_iou, mean_score
 from constant import *
-from util import get_metrics, get_custom_objects, sigmoid
+from util import get_metrics, get_custom_objects, sigmoid, load_input_size
+from checkpoint import restore_averaged_checkpoint
+from timing import StageTimer
 
 tf.flags.DEFINE_string(
     'input', '../input/train',
@@ -50,47 +52,65 @@ tf.flags.DEFINE_bool('deep_supervised', False, """whether to use deep-supervised
 
 tf.flags.DEFINE_bool('with_depth', False, """whether to use depth information""")
 
+tf.flags.DEFINE_list(
+    'checkpoint', None, """path to checkpoints to restore weights from (averaged when several are given)""")
+
+tf.flags.DEFINE_string(
+    'timing', None, """path to json of time of each stage, printed as a table (default: not measured)""")
+
 FLAGS = tf.flags.FLAGS
 
+NULL_TIMER = StageTimer(enabled=False)
+
 FILENAME_IMAGE_PREDS = "image_preds.csv"
 
 
-def save_png(ys_pred, ids, path_out, adjust='resize'):
+def save_png(ys_pred, ids, path_out, adjust='resize', timer=NULL_TIMER):
     """Save confidence image as uint.8"""
     ys_pred = np.clip(ys_pred * 255, 0, 255)
     ys_pred = np.squeeze(ys_pred.astype(np.uint8), axis=3)
     ids = ids.astype(str)
     for y_pred, id in zip(ys_pred, ids):
-        if adjust in ['resize']:
-            y_pred = resize(y_pred, (ORIG_HEIGHT, ORIG_WIDTH))
-        elif adjust in ['reflect', 'constant', 'symmetric']:
-            height_padding = ((IM_HEIGHT - ORIG_HEIGHT) // 2, IM_HEIGHT - ORIG_HEIGHT - (IM_HEIGHT - ORIG_HEIGHT) // 2)
-            width_padding = ((IM_WIDTH - ORIG_WIDTH) // 2, IM_WIDTH - ORIG_WIDTH - (IM_WIDTH - ORIG_WIDTH) // 2)
-            y_pred = crop(y_pred, (height_padding, width_padding))
+        with timer.stage('crop/resize'):
+            if adjust in ['resize']:
+                y_pred = resize(y_pred, (ORIG_HEIGHT, ORIG_WIDTH))
+            elif adjust in ['reflect', 'constant', 'symmetric']:
+                height, width = y_pred.shape[:2]
+                height_padding = ((height - ORIG_HEIGHT) // 2, height - ORIG_HEIGHT - (height - ORIG_HEIGHT) // 2)
+                width_padding = ((width - ORIG_WIDTH) // 2, width - ORIG_WIDTH - (width - ORIG_WIDTH) // 2)
+                y_pred = crop(y_pred, (height_padding, width_padding))
         filename = os.path.join(path_out, id)
-        imsave(filename, y_pred)
+        with timer.stage('png write'):
+            imsave(filename, y_pred)
 
 
-def save_npz(ys_pred, ids, path_out, adjust='resize'):
+def save_npz(ys_pred, ids, path_out, adjust='resize', timer=NULL_TIMER):
     ids = [os.path.splitext(id)[0] + '.npz' for id in ids]
     ys_pred = np.squeeze(ys_pred, axis=3)
     for y_pred, id in zip(ys_pred, ids):
-        if adjust in ['resize']:
-            y_pred = resize(y_pred, (ORIG_HEIGHT, ORIG_WIDTH))
-        elif adjust in ['reflect', 'constant', 'symmetric']:
-            height_padding = ((IM_HEIGHT - ORIG_HEIGHT) // 2, IM_HEIGHT - ORIG_HEIGHT - (IM_HEIGHT - ORIG_HEIGHT) // 2)
-            width_padding = ((IM_WIDTH - ORIG_WIDTH) // 2, IM_WIDTH - ORIG_WIDTH - (IM_WIDTH - ORIG_WIDTH) // 2)
-            y_pred = crop(y_pred, (height_padding, width_padding))
+        with timer.stage('crop/resize'):
+            if adjust in ['resize']:
+                y_pred = resize(y_pred, (ORIG_HEIGHT, ORIG_WIDTH))
+            elif adjust in ['reflect', 'constant', 'symmetric']:
+                height, width = y_pred.shape[:2]
+                height_padding = ((height - ORIG_HEIGHT) // 2, height - ORIG_HEIGHT - (height - ORIG_HEIGHT) // 2)
+                width_padding = ((width - ORIG_WIDTH) // 2, width - ORIG_WIDTH - (width - ORIG_WIDTH) // 2)
+                y_pred = crop(y_pred, (height_padding, width_padding))
         filename = os.path.join(path_out, id)
-        np.savez(filename, y_pred)
+        with timer.stage('npz write'):
+            np.savez(filename, y_pred)
 
 
 def main(argv=None):
 
+    timer = StageTimer(enabled=FLAGS.timing is not None)
+
     tf.gfile.MakeDirs(FLAGS.prediction)
 
-    dataset = Dataset(FLAGS.input)
-    iter_test  = dataset.gen_test(batch_size=FLAGS.batch_size, adjust=FLAGS.adjust, with_depth=FLAGS.with_depth)
+    with timer.stage('file listing'):
+        dataset = Dataset(FLAGS.input)
+    iter_test  = dataset.gen_test(batch_size=FLAGS.batch_size, adjust=FLAGS.adjust, with_depth=FLAGS.with_depth,
+                                  target_shape=load_input_size(FLAGS.model))
 
     sess = tf.Session(config=tf.ConfigProto(
         allow_soft_placement=True,  gpu_options=tf.GPUOptions(
@@ -98,54 +118,69 @@ def main(argv=None):
     K.set_session(sess)
 
     path_model = os.path.join(FLAGS.model, NAME_MODEL)
-    model = load_model(path_model, compile=False)
-    model.compile(optimizer="adam", loss='binary_crossentropy')
+    with timer.stage('model load'):
+        model = load_model(path_model, compile=False)
+        if FLAGS.checkpoint is not None:
+            print("Restoring weights from {}".format(FLAGS.checkpoint))
+            restore_averaged_checkpoint(model, FLAGS.checkpoint)
+        model.compile(optimizer="adam", loss='binary_crossentropy')
 
     num_batch = int(np.ceil(len(dataset) / FLAGS.batch_size))
     sample_tensor = iter_test.get_next()
     image_preds = {}
     for id_batch in tqdm(range(num_batch)):
-        xs, paths = sess.run(sample_tensor)
+        with timer.stage('decode wait'):
+            xs, paths = sess.run(sample_tensor)
 
         ids = np.asarray([os.path.split(path)[1].decode() for path in paths])
+        num = len(ids)
+        timer.count(num)
 
         if id_batch == num_batch:
             break
 
-        if FLAGS.vertical_flip and FLAGS.horizontal_flip:
-            xs = xs[:, ::-1, ::-1, :]
-        elif FLAGS.vertical_flip:
-            xs = np.flip(xs, axis=(1))
-        elif FLAGS.horizontal_flip:
-            xs = np.flip(xs, axis=(2))
-
-        ys_outputs = model.predict_on_batch(xs)
-
-        if FLAGS.vertical_flip and FLAGS.horizontal_flip:
-            ys_outputs = ys_outputs[:, ::-1, ::-1, :]
-        elif FLAGS.vertical_flip:
-            ys_outputs = np.flip(ys_outputs, axis=(1))
-        elif FLAGS.horizontal_flip:
-            ys_outputs = np.flip(ys_outputs, axis=(2))
+        with timer.stage('flip', num):
+            if FLAGS.vertical_flip and FLAGS.horizontal_flip:
+                xs = xs[:, ::-1, ::-1, :]
+            elif FLAGS.vertical_flip:
+                xs = np.flip(xs, axis=(1))
+            elif FLAGS.horizontal_flip:
+                xs = np.flip(xs, axis=(2))
+
+        with timer.stage('forward', num):
+            ys_outputs = model.predict_on_batch(xs)
+
+        with timer.stage('flip undo', num):
+            if FLAGS.vertical_flip and FLAGS.horizontal_flip:
+                ys_outputs = ys_outputs[:, ::-1, ::-1, :]
+            elif FLAGS.vertical_flip:
+                ys_outputs = np.flip(ys_outputs, axis=(1))
+            elif FLAGS.horizontal_flip:
+                ys_outputs = np.flip(ys_outputs, axis=(2))
 
         if not FLAGS.deep_supervised:
             ys_logits = ys_outputs
-            ys_pred = sigmoid(ys_logits)
-            save_png(ys_pred, ids, FLAGS.prediction, FLAGS.adjust)
+            with timer.stage('sigmoid', num):
+                ys_pred = sigmoid(ys_logits)
+            save_png(ys_pred, ids, FLAGS.prediction, FLAGS.adjust, timer)
             if FLAGS.npz:
-                save_npz(ys_pred, ids, FLAGS.prediction, FLAGS.adjust)
+                save_npz(ys_pred, ids, FLAGS.prediction, FLAGS.adjust, timer)
         else:
             ys_logits, image_logits = ys_outputs[0], ys_outputs[2]
-            image_pred = sigmoid(image_logits)
-            image_preds.update({i: p for i, p in zip(ids, image_pred)})
-            ys_pred = sigmoid(ys_logits)
-            save_png(ys_pred, ids, FLAGS.prediction, FLAGS.adjust)
+            with timer.stage('sigmoid', num):
+                image_pred = sigmoid(image_logits)
+                image_preds.update({i: p for i, p in zip(ids, image_pred)})
+                ys_pred = sigmoid(ys_logits)
+            save_png(ys_pred, ids, FLAGS.prediction, FLAGS.adjust, timer)
             if FLAGS.npz:
-                save_npz(ys_pred, ids, FLAGS.prediction, FLAGS.adjust)
+                save_npz(ys_pred, ids, FLAGS.prediction, FLAGS.adjust, timer)
 
     if FLAGS.deep_supervised:
-        df_image_preds = pd.DataFrame.from_dict(image_preds, orient='index')
-        df_image_preds.to_csv(os.path.join(FLAGS.prediction, FILENAME_IMAGE_PREDS))
+        with timer.stage('csv write'):
+            df_image_preds = pd.DataFrame.from_dict(image_preds, orient='index')
+            df_image_preds.to_csv(os.path.join(FLAGS.prediction, FILENAME_IMAGE_PREDS))
+
+    timer.report(FLAGS.timing)
 
 
 if __name__ == '__main__':
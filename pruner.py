@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pruning of unpromising trials from their per-epoch validation scores
+
+Trials report the best score until each epoch, and a pruner decides whether to stop them.
+"""
+
+import threading
+import statistics
+
+
+class TrialPruned(Exception):
+    def __init__(self, epoch, score):
+        super(TrialPruned, self).__init__("pruned at epoch {} with score {}".format(epoch, score))
+        self.epoch = epoch
+        self.score = score
+
+
+class Pruner(object):
+    """Base of pruners, keeps best scores of trials at each epoch"""
+    def __init__(self, mode='max'):
+        if mode not in ['max', 'min']:
+            raise ValueError("mode {} is not supported".format(mode))
+        self.mode = mode
+        self.lock = threading.Lock()
+        # {trial: {epoch: best score until the epoch}}
+        self.scores = {}
+
+    def _better(self, a, b):
+        return max(a, b) if self.mode == 'max' else min(a, b)
+
+    def report(self, trial, epoch, score):
+        """Record `score` of `trial` at `epoch` (1-based), return True if the trial should be stopped"""
+        with self.lock:
+            history = self.scores.setdefault(trial, {})
+            if len(history) > 0:
+                score = self._better(score, history[max(history.keys())])
+            history[epoch] = score
+            return self.should_prune(trial, epoch, score)
+
+    def should_prune(self, trial, epoch, score):
+        raise NotImplementedError()
+
+    def scores_at(self, epoch, exclude=None):
+        return [history[epoch] for trial, history in self.scores.items() if trial != exclude and epoch in history]
+
+
+class MedianPruner(Pruner):
+    """Median stopping rule
+
+    Stop a trial whose best score is worse than the median of other trials at the same epoch,
+    checked every `interval` epochs after `warmup` epochs once `min_trials` other trials reached the epoch.
+    """
+    def __init__(self, warmup=10, interval=1, min_trials=3, mode='max'):
+        super(MedianPruner, self).__init__(mode)
+        self.warmup = warmup
+        self.interval = interval
+        self.min_trials = min_trials
+
+    def should_prune(self, trial, epoch, score):
+        if epoch < self.warmup or (epoch - self.warmup) % self.interval != 0:
+            return False
+        others = self.scores_at(epoch, exclude=trial)
+        if len(others) < self.min_trials:
+            return False
+        median = statistics.median(others)
+        return score < median if self.mode == 'max' else score > median
+
+
+class SuccessiveHalvingPruner(Pruner):
+    """Asynchronous successive halving
+
+    Rungs are at epochs min_epochs * eta^k. A trial reaching a rung continues only if its best score is
+    in the top 1/eta of scores recorded at that rung so far, so no trial waits for others.
+    """
+    def __init__(self, min_epochs=10, eta=3, mode='max'):
+        super(SuccessiveHalvingPruner, self).__init__(mode)
+        self.min_epochs = min_epochs
+        self.eta = eta
+
+    def is_rung(self, epoch):
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.eta
+        return rung == epoch
+
+    def should_prune(self, trial, epoch, score):
+        if not self.is_rung(epoch):
+            return False
+        scores = self.scores_at(epoch)
+        num_promoted = len(scores) // self.eta
+        if num_promoted == 0:
+            return False
+        top = sorted(scores, reverse=(self.mode == 'max'))[:num_promoted]
+        return score not in top
+
+
+def create_pruner(name, warmup=10, eta=3, mode='max'):
+    if name == 'none':
+        return None
+    elif name == 'median':
+        return MedianPruner(warmup=warmup, mode=mode)
+    elif name == 'asha':
+        return SuccessiveHalvingPruner(min_epochs=warmup, eta=eta, mode=mode)
+    raise ValueError("pruner {} is not supported".format(name))
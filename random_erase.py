@@ -72,6 +72,96 @@ class RandomErasing(object):
         return erased_img
 
 
+class BatchRandomErasing(object):
+    """Random Erasing of a batch of images (N, H, W[, C]) at once
+
+    Sizes and aspect ratios are drawn for all images at once, and redrawn only for the images whose
+    rectangles are rejected, with the same distribution as RandomErasing. The position is then drawn
+    from the range keeping the rectangle inside the image.
+    Masks and weights given with images are erased at the same rectangles with constant values.
+    """
+    def __init__(self, probability=0.5, min_size=0.02, max_size=0.4, min_aspect_ratio=0.3, max_aspect_ratio=1/0.3, min_val=0, max_val=256, pixel_wise=False, seed=None):
+        self.probability = probability
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_aspect_ratio = min_aspect_ratio
+        self.max_aspect_ratio = max_aspect_ratio
+        self.min_val = min_val
+        self.max_val = max_val
+        self.pixel_wise = pixel_wise
+        self.random_state = np.random.RandomState(seed)
+
+    def sample_regions(self, num, height, width):
+        """Boolean array (N, H, W) which is True inside the erased rectangle of each image"""
+        rs = self.random_state
+        erase = rs.rand(num) < self.probability
+        w = np.zeros(num, dtype=np.int64)
+        h = np.zeros(num, dtype=np.int64)
+        pending = np.nonzero(erase)[0]
+        while len(pending) > 0:
+            n = len(pending)
+            s = rs.uniform(self.min_size, self.max_size, size=n) * height * width
+            r = rs.uniform(self.min_aspect_ratio, self.max_aspect_ratio, size=n)
+            w_new = np.sqrt(s / r).astype(np.int64)
+            h_new = np.sqrt(s * r).astype(np.int64)
+            # RandomErasing draws a position in the whole image and rejects rectangles out of it,
+            # a size is accepted with the same probability, the fraction of positions keeping it inside
+            p_accept = np.clip((width - w_new + 1) / width, 0.0, 1.0) * \
+                np.clip((height - h_new + 1) / height, 0.0, 1.0)
+            accepted = rs.rand(n) < p_accept
+            w[pending[accepted]] = w_new[accepted]
+            h[pending[accepted]] = h_new[accepted]
+            pending = pending[~accepted]
+        left = (rs.rand(num) * (width - w + 1)).astype(np.int64)
+        top = (rs.rand(num) * (height - h + 1)).astype(np.int64)
+
+        rows = np.arange(height)
+        cols = np.arange(width)
+        in_rows = (rows >= top[:, None]) & (rows < (top + h)[:, None]) & erase[:, None]
+        in_cols = (cols >= left[:, None]) & (cols < (left + w)[:, None])
+        return in_rows[:, :, None] & in_cols[:, None, :]
+
+    def _random(self, dtype, size):
+        if np.issubdtype(dtype, np.integer):
+            return self.random_state.randint(self.min_val, self.max_val, size=size)
+        elif np.issubdtype(dtype, np.floating):
+            return self.random_state.uniform(self.min_val, self.max_val, size=size)
+        raise NotImplementedError()
+
+    def __call__(self, images, masks=None, weights=None, mask_value=0, weight_value=0, inplace=False):
+        """Erase images, and masks/weights if given
+
+        With inplace=False, each given array is copied once as a whole batch.
+        Returns images, or (images, masks, weights) if masks or weights are given.
+        """
+        if images.ndim not in [3, 4]:
+            raise ValueError("images rank must be 3 or 4")
+        if not inplace:
+            images = np.copy(images)
+            masks = np.copy(masks) if masks is not None else None
+            weights = np.copy(weights) if weights is not None else None
+
+        num, height, width = images.shape[:3]
+        region = self.sample_regions(num, height, width)
+        index_sample = np.nonzero(region)[0]
+        channels = images.shape[3:]
+        if self.pixel_wise:
+            values = self._random(images.dtype, (len(index_sample),) + channels)
+        else:
+            values = self._random(images.dtype, num)[index_sample]
+            values = np.reshape(values, (-1,) + (1,) * len(channels))
+        images[region] = values
+
+        if masks is not None:
+            masks[region] = mask_value
+        if weights is not None:
+            weights[region] = weight_value
+
+        if masks is None and weights is None:
+            return images
+        return images, masks, weights
+
+
 def main():
     import matplotlib.pyplot as plt
     import cv2
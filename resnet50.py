@@ -47,13 +47,10 @@ from tensorflow.python.keras.layers import MaxPooling2D
 from tensorflow.python.keras.layers import ZeroPadding2D
 from tensorflow.python.keras.models import Model
 from tensorflow.python.keras.utils import layer_utils
-from tensorflow.python.keras.utils.data_utils import get_file
 from tensorflow.python.platform import tf_logging as logging
 from tensorflow.python.util.tf_export import tf_export
 
-
-WEIGHTS_PATH = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.2/resnet50_weights_tf_dim_ordering_tf_kernels.h5'
-WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.2/resnet50_weights_tf_dim_ordering_tf_kernels_notop.h5'
+import weight_store
 
 
 def identity_block(input_tensor, kernel_size, filters, stage, block, renorm):
@@ -219,7 +216,7 @@ def ResNet50(include_top=True,
     input_shape = _obtain_input_shape(
         input_shape,
         default_size=224,
-        min_size=128,
+        min_size=32,
         data_format=K.image_data_format(),
         require_flatten=include_top,
         weights=weights)
@@ -284,19 +281,8 @@ def ResNet50(include_top=True,
 
     # load weights
     if weights == 'imagenet':
-        if include_top:
-            weights_path = get_file(
-                'resnet50_weights_tf_dim_ordering_tf_kernels.h5',
-                WEIGHTS_PATH,
-                cache_subdir='models',
-                md5_hash='a7b3fe01876f51b976af0dea6bc144eb')
-        else:
-            weights_path = get_file(
-                'resnet50_weights_tf_dim_ordering_tf_kernels_notop.h5',
-                WEIGHTS_PATH_NO_TOP,
-                cache_subdir='models',
-                md5_hash='a268eb855778b3df3c7506639542a6af')
-        model.load_weights(weights_path, by_name=True)
+        weights_path = weight_store.get_weights_path('resnet50', include_top)
+        weight_store.load_weights(model, weights_path)
     elif weights is not None:
         model.load_weights(weights)
 
@@ -5,14 +5,13 @@ import os
 import numpy as np
 import sys
 from absl import app, flags
-from sklearn.metrics import confusion_matrix
 from PIL import Image
 from tqdm import tqdm
 import pandas as pd
 
 from constant import *
-from dataset import Dataset
-from metrics import mean_score_per_image
+from dataset_index import DatasetIndex
+from scoring import mean_score_per_image
 
 flags.DEFINE_string(
     'input', '../input/train',
@@ -49,7 +48,7 @@ def load_npz(path_pred):
 
 
 def main(argv):
-    dataset = Dataset(FLAGS.input)
+    dataset = DatasetIndex(FLAGS.input)
     train_ids, valid_ids = dataset.kfold_split(N_SPLITS, FLAGS.cv)
 
     if not os.path.isdir(FLAGS.score):
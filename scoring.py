@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""
+Competition score of predictions by NumPy, importable without TensorFlow
+"""
+
+import numpy as np
+
+
+def mean_score_per_image(y_true, y_pred, threshold=None):
+    """Calculate score per image"""
+    # GT, Predともに前景ゼロの場合はスコアを1とする
+    y_true = np.round(y_true).astype(np.int)
+    if threshold is None:
+        y_pred = np.round(y_pred).astype(np.int)
+    else:
+        y_pred = (y_pred>threshold).astype(np.int)
+
+    if np.any(y_true) == False and np.any(y_pred) == False:
+        return 1.
+
+    from sklearn.metrics import confusion_matrix
+
+    threasholds_iou = np.arange(0.5, 1.0, 0.05, dtype=float)
+    y_true = np.reshape(y_true, (-1))
+    y_pred = np.reshape(y_pred, (-1))
+    total_cm = confusion_matrix(y_true, y_pred, labels=[0, 1])
+    sum_over_row = np.sum(total_cm, 0).astype(float)
+    sum_over_col = np.sum(total_cm, 1).astype(float)
+    cm_diag = np.diag(total_cm).astype(float)
+    denominator = sum_over_row + sum_over_col - cm_diag
+    denominator = np.where(np.greater(denominator, 0), denominator, np.ones_like(denominator))
+    # iou[0]: 背景のIoU
+    # iou[1]: 前景のIoU
+    iou = np.divide(cm_diag, denominator)
+    iou_fg = iou[1]
+    greater = np.greater(iou_fg, threasholds_iou)
+    score_per_image = np.mean(greater.astype(float))
+    return score_per_image
+
+
+def mean_score_batch(y_true, y_pred, threshold=0.5):
+    """Calculate scores of images at once, same as mean_score_per_image for each image
+
+    :param y_true: array of ground truth, such as [NHW] or [NHWC]
+    :param y_pred: array of confidence with the same shape as y_true
+    :return: 1-D array of score per image
+    """
+    num = y_true.shape[0]
+    y_true = np.reshape(np.round(y_true) > 0, (num, -1))
+    y_pred = np.reshape(y_pred > threshold, (num, -1))
+    intersection = np.count_nonzero(y_true & y_pred, axis=1)
+    union = np.count_nonzero(y_true | y_pred, axis=1)
+    iou = intersection / np.maximum(union, 1)
+    threasholds_iou = np.arange(0.5, 1.0, 0.05, dtype=float)
+    scores = np.mean(iou[:, np.newaxis] > threasholds_iou[np.newaxis, :], axis=1)
+    # GT, Predともに前景ゼロの場合はスコアを1とする
+    return np.where(union == 0, 1.0, scores)
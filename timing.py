@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cumulative time of each stage of a run, reported with throughput and peak memory
+
+A disabled timer returns one shared no-op stage, so instrumented loops cost a method call per stage.
+"""
+
+import json
+import time
+import resource
+from collections import OrderedDict
+
+
+class _Stage(object):
+    __slots__ = ('timer', 'name', 'items', 'start')
+
+    def __init__(self, timer, name, items):
+        self.timer = timer
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timer.add(self.name, time.perf_counter() - self.start, self.items)
+        return False
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class StageTimer(object):
+    """Record time of stages by `with timer.stage(name, items):`
+
+    Stages may be timed in other processes and merged by `merge(timer.stages)`.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # name: [seconds, calls, items]
+        self.stages = OrderedDict()
+        self.items = 0
+        self.start = time.perf_counter()
+
+    def stage(self, name, items=1):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name, items)
+
+    def add(self, name, seconds, items=1, calls=1):
+        if not self.enabled:
+            return
+        stage = self.stages.setdefault(name, [0.0, 0, 0])
+        stage[0] += seconds
+        stage[1] += calls
+        stage[2] += items
+
+    def merge(self, stages):
+        for name, (seconds, calls, items) in stages.items():
+            self.add(name, seconds, items, calls)
+
+    def count(self, items):
+        """Count items processed by the run, for items/sec"""
+        self.items += items
+
+    def summary(self):
+        wall = time.perf_counter() - self.start
+        stages = OrderedDict()
+        for name, (seconds, calls, items) in self.stages.items():
+            stages[name] = {'seconds': seconds, 'calls': calls, 'items': items,
+                            'ms_per_item': 1000 * seconds / max(items, 1), 'fraction': seconds / max(wall, 1e-9)}
+        # ru_maxrss is in KB on Linux
+        return {'wall_seconds': wall, 'items': self.items, 'items_per_sec': self.items / max(wall, 1e-9),
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+                'stages': stages}
+
+    def report(self, path_json=None):
+        """Print a table of stages and write the summary to `path_json`, nothing if disabled"""
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        print("{:<20s} {:>10s} {:>8s} {:>10s} {:>12s} {:>7s}".format(
+            'stage', 'seconds', 'calls', 'items', 'ms/item', '%'))
+        for name, s in summary['stages'].items():
+            print("{:<20s} {:>10.3f} {:>8d} {:>10d} {:>12.3f} {:>7.1f}".format(
+                name, s['seconds'], s['calls'], s['items'], s['ms_per_item'], 100 * s['fraction']))
+        print("{} items in {:.2f} sec ({:.1f} items/sec), peak RSS {:.0f} MB (children {:.0f} MB)".format(
+            summary['items'], summary['wall_seconds'], summary['items_per_sec'], summary['peak_rss_mb'],
+            summary['peak_rss_children_mb']))
+        if path_json is not None:
+            with open(path_json, 'w') as f:
+                json.dump(summary, f, indent=4)
+        return summary
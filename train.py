@@ -2,26 +2,37 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import json
+import subprocess
 from pprint import pprint
 
+import numpy as np
 import tensorflow as tf
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint, LearningRateScheduler
+from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint, LearningRateScheduler, CSVLogger
 import tensorflow.keras.backend as K
 from tensorflow.python.keras.callbacks import ReduceLROnPlateau
 from tensorflow.keras.models import load_model
 
 from model import build_model, build_model_ref, build_model_pretrained, compile_model, \
-    build_model_pretrained_deep_supervised, build_model_contrib, build_model_ref2
+    build_model_pretrained_deep_supervised, build_model_contrib, build_model_ref2, \
+    build_encoder_pretrained, build_decoder_pretrained, copy_weights_by_name, ENCODER_FEATURES, \
+    get_stride_multiple, get_minimal_size
 from dataset import Dataset
 from constant import *
-from util import StepDecay, MyTensorBoard, write_summary, CLRDecay
+from util import StepDecay, write_summary, CLRDecay, save_input_size, load_input_size
+from checkpoint import TopKCheckpoint, CHECKPOINT_DIRNAME, list_checkpoints, restore_checkpoint, \
+    PeriodicCheckpoint, MyTensorBoard, ASYNC_DIRNAME, load_best_pointer
+from feature_cache import FeatureCache, FeatureCacheSequence, list_flips
 import config_train
 
 FLAGS = tf.flags.FLAGS
 
 FLAGS_FILENAME = "flags.json"
 MODEL_SUMMARY_FILENAME = "model_summary.txt"
+# flags passed to evaluator process of asynchronous validation
+EVALUATOR_FLAGS = ['input', 'model', 'log', 'adjust', 'cv', 'batch_size', 'deep_supervised', 'with_depth',
+                   'backend', 'decoded', 'exclude_vert_hori']
 
 
 def augment_dict():
@@ -41,17 +52,100 @@ def augment_dict():
         fill_mode=FLAGS.fill_mode)
 
 
-def train(dataset):
+def save_flags():
     flag_values_dict = FLAGS.flag_values_dict()
     pprint(flag_values_dict, indent=4)
     with open(os.path.join(FLAGS.model, FLAGS_FILENAME), 'w') as f:
         json.dump(flag_values_dict, f, indent=4)
 
+
+def get_weight_adaptive():
     # FLAGS.weight_ad is parsed to [coverage_min, coverage_max], threshold to apply adaptive weight
     if FLAGS.weight_ad is not None:
-        weight_adaptive = [float(x) for x in FLAGS.weight_ad]
+        return [float(x) for x in FLAGS.weight_ad]
     else:
-        weight_adaptive = None
+        return None
+
+
+def get_input_size():
+    if FLAGS.restore is not None:
+        return load_input_size(FLAGS.restore)
+    if not FLAGS.minimal_padding:
+        return IM_HEIGHT, IM_WIDTH
+    multiple = get_stride_multiple(
+        contrib=FLAGS.contrib, pretrained=FLAGS.pretrained, use_ref=FLAGS.use_ref, use_ref2=FLAGS.use_ref2, depth=FLAGS.depth)
+    return get_minimal_size(ORIG_HEIGHT, multiple), get_minimal_size(ORIG_WIDTH, multiple)
+
+
+def session_config():
+    return tf.ConfigProto(
+        allow_soft_placement=True, gpu_options=tf.GPUOptions(
+            per_process_gpu_memory_fraction=0.9, allow_growth=True),
+        intra_op_parallelism_threads=FLAGS.num_threads, inter_op_parallelism_threads=FLAGS.num_threads)
+
+
+def schedule_callbacks():
+    if not FLAGS.cyclic:
+        lrscheduler = LearningRateScheduler(
+            StepDecay(FLAGS.lr, FLAGS.lr_decay, FLAGS.epochs_decay, FLAGS.freeze_once), verbose=1)
+    else:
+        lrscheduler = LearningRateScheduler(
+            CLRDecay(FLAGS.lr, max_lr=FLAGS.max_lr,
+                     epoch_size=FLAGS.epoch_size, mode=FLAGS.mode_clr, freeze_once=FLAGS.freeze_once), verbose=1)
+
+    callbacks = [lrscheduler]
+    if FLAGS.early_stopping:
+        callbacks.append(EarlyStopping(patience=5, verbose=1))
+    if FLAGS.reduce_on_plateau:
+        lrreducer = ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=8, verbose=1, mode='min',
+                                      epsilon=0.0001, cooldown=4)
+        callbacks.append(lrreducer)
+    return callbacks
+
+
+def start_evaluator():
+    """Run evaluator.py on weights saved by training in a separate process"""
+    args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "evaluator.py")]
+    for name in EVALUATOR_FLAGS:
+        if FLAGS[name].value is not None:
+            args.append("--{}={}".format(name, FLAGS[name].value))
+    args.append("--parent_pid={}".format(os.getpid()))
+    # history of a previous run would be read as this run's by exec_cv and the pruner of exec_opt
+    path_history = os.path.join(FLAGS.model, NAME_VALID_HISTORY)
+    if os.path.exists(path_history):
+        os.remove(path_history)
+    env = dict(os.environ)
+    if FLAGS.valid_gpu is not None:
+        env['CUDA_VISIBLE_DEVICES'] = FLAGS.valid_gpu
+    return subprocess.Popen(args, env=env)
+
+
+def export_async_best(model, evaluator, path_model):
+    """Wait for evaluator and save model with the best weights found by it"""
+    print("Waiting for evaluator to validate remaining weights")
+    returncode = evaluator.wait()
+    dirname = os.path.join(FLAGS.model, ASYNC_DIRNAME)
+    if returncode != 0:
+        raise RuntimeError("evaluator exited with code {}, weights of each epoch are left in {}".format(
+            returncode, dirname))
+    best = load_best_pointer(dirname)
+    if best is None:
+        print("No weights are validated, saving the last weights to {}".format(path_model))
+    else:
+        print("Exporting best weights of epoch {} (val_mean_score {:.5f}) to {}".format(
+            best['epoch'], best['score'], path_model))
+        restore_checkpoint(model, os.path.join(dirname, best['filename']))
+    model.save(path_model)
+
+
+def train(dataset):
+    if FLAGS.async_valid and (FLAGS.early_stopping or FLAGS.reduce_on_plateau or FLAGS.top_k > 0):
+        raise ValueError("--async_valid cannot be used with early_stopping, reduce_on_plateau and top_k")
+    save_flags()
+    weight_adaptive = get_weight_adaptive()
+    im_height, im_width = get_input_size()
+    save_input_size(FLAGS.model, im_height, im_width)
+    print("Input size is {}x{}".format(im_height, im_width))
 
     with tf.device('/cpu:0'):
         iter_train, iter_valid = dataset.gen_train_valid(
@@ -59,11 +153,9 @@ def train(dataset):
             weight_fg=FLAGS.weight_fg, weight_bg=FLAGS.weight_bg, weight_adaptive=weight_adaptive,
             filter_vert_hori=FLAGS.filter_vert_hori, ignore_tiny=FLAGS.ignore_tiny,
             augment_dict=augment_dict(), deep_supervised=FLAGS.deep_supervised, mask_padding=FLAGS.mask_padding,
-            with_depth=FLAGS.with_depth)
+            with_depth=FLAGS.with_depth, target_shape=(im_height, im_width))
 
-    sess = tf.Session(config=tf.ConfigProto(
-        allow_soft_placement=True,  gpu_options=tf.GPUOptions(
-            per_process_gpu_memory_fraction=0.9, allow_growth=True)))
+    sess = tf.Session(config=session_config())
     K.set_session(sess)
 
     if FLAGS.debug:
@@ -76,29 +168,29 @@ def train(dataset):
             model = load_model(path_restore, compile=False)
         elif FLAGS.contrib is not None:
             model = build_model_contrib(
-                IM_HEIGHT, IM_WIDTH, IM_CHAN, encoder=FLAGS.contrib, residual_unit=FLAGS.residual_unit,
+                im_height, im_width, IM_CHAN, encoder=FLAGS.contrib, residual_unit=FLAGS.residual_unit,
                 spatial_dropout=FLAGS.spatial_dropout, preprocess=FLAGS.preprocess, last_kernel=FLAGS.last_kernel, last_1x1=FLAGS.last_1x1)
         elif FLAGS.pretrained is not None:
             if not FLAGS.deep_supervised:
                 model = build_model_pretrained(
-                    IM_HEIGHT, IM_WIDTH, IM_CHAN, encoder=FLAGS.pretrained,
+                    im_height, im_width, IM_CHAN, encoder=FLAGS.pretrained,
                     spatial_dropout=FLAGS.spatial_dropout, retrain=FLAGS.retrain, preprocess=FLAGS.preprocess,
                     renorm=FLAGS.renorm, last_kernel=FLAGS.last_kernel, last_1x1=FLAGS.last_1x1)
             else:
                 model = build_model_pretrained_deep_supervised(
-                    IM_HEIGHT, IM_WIDTH, IM_CHAN, encoder=FLAGS.pretrained,
+                    im_height, im_width, IM_CHAN, encoder=FLAGS.pretrained,
                     spatial_dropout=FLAGS.spatial_dropout, retrain=FLAGS.retrain, preprocess=FLAGS.preprocess,
                     last_kernel=FLAGS.last_kernel, last_1x1=FLAGS.last_1x1)
         elif FLAGS.use_ref2:
             model = build_model_ref2(
-                IM_HEIGHT, IM_WIDTH, IM_CHAN, preprocess=FLAGS.preprocess)
+                im_height, im_width, IM_CHAN, preprocess=FLAGS.preprocess)
         elif FLAGS.use_ref:
             model = build_model_ref(
-                IM_HEIGHT, IM_WIDTH, IM_CHAN, batch_norm=FLAGS.batch_norm, drop_out=FLAGS.drop_out,
+                im_height, im_width, IM_CHAN, batch_norm=FLAGS.batch_norm, drop_out=FLAGS.drop_out,
                 depth=FLAGS.depth, start_ch=FLAGS.start_ch)
         else:
             model = build_model(
-                IM_HEIGHT, IM_WIDTH, IM_CHAN, batch_norm=FLAGS.batch_norm, drop_out=FLAGS.drop_out)
+                im_height, im_width, IM_CHAN, batch_norm=FLAGS.batch_norm, drop_out=FLAGS.drop_out)
 
         if FLAGS.restore_weight is not None:
             path_weight = os.path.join(FLAGS.restore_weight, NAME_MODEL)
@@ -116,37 +208,143 @@ def train(dataset):
         monitor = 'val_weighted_mean_score'
     else:
         monitor = 'val_output_final_weighted_mean_score'
-    checkpointer = ModelCheckpoint(path_model, monitor=monitor, verbose=1, save_best_only=FLAGS.save_best_only, mode='max')
-    tensorboarder = MyTensorBoard(FLAGS.log, model=model)
-    if not FLAGS.cyclic:
-        lrscheduler = LearningRateScheduler(
-            StepDecay(FLAGS.lr, FLAGS.lr_decay, FLAGS.epochs_decay, FLAGS.freeze_once), verbose=1)
+    evaluator = None
+    if FLAGS.async_valid:
+        checkpointer = PeriodicCheckpoint(os.path.join(FLAGS.model, ASYNC_DIRNAME), period=FLAGS.valid_freq)
+        evaluator = start_evaluator()
+    elif FLAGS.top_k > 0:
+        checkpointer = TopKCheckpoint(
+            os.path.join(FLAGS.model, CHECKPOINT_DIRNAME), monitor=monitor, mode='max', top_k=FLAGS.top_k,
+            weights_format=FLAGS.checkpoint_format, path_export=path_model, verbose=1)
     else:
-        lrscheduler = LearningRateScheduler(
-            CLRDecay(FLAGS.lr, max_lr=FLAGS.max_lr,
-                     epoch_size=FLAGS.epoch_size, mode=FLAGS.mode_clr, freeze_once=FLAGS.freeze_once), verbose=1)
-
-    callbacks = [checkpointer, tensorboarder, lrscheduler]
-    if FLAGS.early_stopping:
-        callbacks.append(EarlyStopping(patience=5, verbose=1))
-    if FLAGS.reduce_on_plateau:
-        lrreducer = ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=8, verbose=1, mode='min',
-                                      epsilon=0.0001, cooldown=4)
-        callbacks.append(lrreducer)
+        checkpointer = ModelCheckpoint(path_model, monitor=monitor, verbose=1, save_best_only=FLAGS.save_best_only, mode='max')
+    tensorboarder = MyTensorBoard(FLAGS.log, model=model)
+    csvlogger = CSVLogger(os.path.join(FLAGS.model, NAME_HISTORY))
+    callbacks = [checkpointer, tensorboarder, csvlogger] + schedule_callbacks()
 
     num_train, num_valid = dataset.len_train_valid(n_splits=N_SPLITS, idx_kfold=FLAGS.cv)
 
     steps_per_epoch = int(num_train / FLAGS.batch_size)
     validation_steps = int(num_valid / FLAGS.batch_size)
 
+    if evaluator is not None:
+        # training runs only forward/backward passes, validation is done by evaluator
+        results = model.fit(
+            x=iter_train, epochs=FLAGS.epochs, steps_per_epoch=steps_per_epoch, shuffle=True, callbacks=callbacks)
+        export_async_best(model, evaluator, path_model)
+        return
+
     results = model.fit(
         x=iter_train, validation_data=iter_valid,
         epochs=FLAGS.epochs, steps_per_epoch=steps_per_epoch, validation_steps=validation_steps,
         shuffle=True, callbacks=callbacks)
 
 
+def train_decoder(dataset):
+    """Train only the decoder of a pretrained model from cached features of the frozen encoder"""
+    if FLAGS.pretrained not in ENCODER_FEATURES or FLAGS.retrain or FLAGS.deep_supervised:
+        raise ValueError("feature cache requires --pretrained, --noretrain and --nodeep_supervised")
+    if FLAGS.async_valid:
+        raise ValueError("--async_valid cannot be used with feature cache")
+    if FLAGS.augment:
+        not_flip = ['rotation_range', 'zoom_range', 'shift_range', 'brightness_range', 'gradation_range', 'mixup']
+        if any(FLAGS[name].value for name in not_flip) or FLAGS.random_erase != 'none':
+            raise ValueError("feature cache supports only flip augmentation, "
+                             "disable {} and random_erase".format(", ".join(not_flip)))
+        flips = list_flips(FLAGS.horizontal_flip, FLAGS.vertical_flip)
+    else:
+        flips = list_flips()
+
+    save_flags()
+    weight_adaptive = get_weight_adaptive()
+    im_height, im_width = get_input_size()
+    save_input_size(FLAGS.model, im_height, im_width)
+    print("Input size is {}x{}".format(im_height, im_width))
+
+    with tf.device('/cpu:0'):
+        iter_train, iter_valid = dataset.gen_train_valid(
+            n_splits=N_SPLITS, idx_kfold=FLAGS.cv, batch_size=FLAGS.batch_size, adjust=FLAGS.adjust,
+            weight_fg=FLAGS.weight_fg, weight_bg=FLAGS.weight_bg, weight_adaptive=weight_adaptive,
+            filter_vert_hori=FLAGS.filter_vert_hori, ignore_tiny=FLAGS.ignore_tiny,
+            augment_dict=None, repeat=1, mask_padding=FLAGS.mask_padding, with_depth=FLAGS.with_depth,
+            target_shape=(im_height, im_width))
+
+    sess = tf.Session(config=session_config())
+    K.set_session(sess)
+
+    with tf.device('/gpu:0'):
+        model = build_model_pretrained(
+            im_height, im_width, IM_CHAN, encoder=FLAGS.pretrained,
+            spatial_dropout=FLAGS.spatial_dropout, retrain=False, preprocess=FLAGS.preprocess,
+            renorm=FLAGS.renorm, last_kernel=FLAGS.last_kernel, last_1x1=FLAGS.last_1x1)
+        if FLAGS.restore_weight is not None:
+            path_weight = os.path.join(FLAGS.restore_weight, NAME_MODEL)
+            print("Restoring weights from {}".format(path_weight))
+            model.load_weights(path_weight, by_name=True)
+        encoder = build_encoder_pretrained(model, encoder=FLAGS.pretrained)
+
+    # cache is rebuilt when any flag changing encoder features or labels differs
+    key_names = ['input', 'cv', 'adjust', 'pretrained', 'preprocess', 'renorm', 'restore_weight', 'weight_fg',
+                 'weight_bg', 'weight_ad', 'filter_vert_hori', 'exclude_vert_hori', 'ignore_tiny', 'mask_padding', 'with_depth', 'minimal_padding']
+    key = {name: FLAGS[name].value for name in key_names}
+    num_train, num_valid = dataset.len_train_valid(n_splits=N_SPLITS, idx_kfold=FLAGS.cv)
+
+    caches = []
+    for name, iterator, num_samples, _flips in [
+            ('train', iter_train, num_train, flips), ('valid', iter_valid, num_valid, list_flips())]:
+        path_cache = os.path.join(FLAGS.feature_cache, "cv{}-{}".format(FLAGS.cv, name))
+        _key = json.loads(json.dumps(dict(key, flips=_flips)))
+        if FeatureCache.is_valid(path_cache, _key):
+            print("Loading feature cache from {}".format(path_cache))
+            caches.append(FeatureCache(path_cache))
+        else:
+            print("Building feature cache to {}".format(path_cache))
+            sess.run(iterator.initializer)
+            caches.append(FeatureCache.build(path_cache, encoder, sess, iterator, num_samples, _flips, _key))
+    cache_train, cache_valid = caches
+
+    with tf.device('/gpu:0'):
+        decoder = build_decoder_pretrained(
+            im_height, im_width, IM_CHAN, cache_train.feature_shapes, encoder=FLAGS.pretrained,
+            spatial_dropout=FLAGS.spatial_dropout, renorm=FLAGS.renorm,
+            last_kernel=FLAGS.last_kernel, last_1x1=FLAGS.last_1x1)
+        copy_weights_by_name(model, decoder)
+        decoder = compile_model(decoder, optimizer=FLAGS.opt, loss=FLAGS.loss,
+                                weight_decay=FLAGS.weight_decay, exclude_bn=FLAGS.exclude_bn)
+        write_summary(decoder, os.path.join(FLAGS.model, MODEL_SUMMARY_FILENAME))
+        decoder.summary()
+
+    monitor = 'val_weighted_mean_score'
+    if FLAGS.top_k > 0:
+        path_checkpoint = os.path.join(FLAGS.model, CHECKPOINT_DIRNAME)
+        checkpointer = TopKCheckpoint(
+            path_checkpoint, monitor=monitor, mode='max', top_k=FLAGS.top_k,
+            weights_format=FLAGS.checkpoint_format, verbose=1)
+    else:
+        path_checkpoint = os.path.join(FLAGS.model, "decoder-" + NAME_MODEL)
+        checkpointer = ModelCheckpoint(path_checkpoint, monitor=monitor, verbose=1,
+                                       save_best_only=FLAGS.save_best_only, save_weights_only=True, mode='max')
+    tensorboarder = MyTensorBoard(FLAGS.log, model=decoder)
+    csvlogger = CSVLogger(os.path.join(FLAGS.model, NAME_HISTORY))
+    callbacks = [checkpointer, tensorboarder, csvlogger] + schedule_callbacks()
+
+    seq_train = FeatureCacheSequence(cache_train, FLAGS.batch_size, shuffle=True)
+    seq_valid = FeatureCacheSequence(cache_valid, FLAGS.batch_size, shuffle=False)
+
+    decoder.fit_generator(
+        seq_train, steps_per_epoch=len(seq_train), epochs=FLAGS.epochs,
+        validation_data=seq_valid, validation_steps=len(seq_valid),
+        shuffle=False, callbacks=callbacks)
+
+    # Export best decoder with the frozen encoder as a full model
+    if FLAGS.top_k > 0:
+        path_checkpoint = list_checkpoints(path_checkpoint, top_k=1)[0]
+    restore_checkpoint(decoder, path_checkpoint)
+    copy_weights_by_name(decoder, model)
+    model.save(os.path.join(FLAGS.model, NAME_MODEL))
+
+
 def debug_img_show(iter_train, iter_valid, sess):
-    import numpy as np
     import matplotlib.pyplot as plt
 
     def show_img_label_mask(images, labels_and_masks, prefix=""):
@@ -192,7 +390,12 @@ def debug_img_show(iter_train, iter_valid, sess):
     show_img_label_mask(images, labels_and_masks, prefix="validing ")
 
 def main(argv=None):
-    dataset = Dataset(FLAGS.input)
+    if FLAGS.seed is not None:
+        np.random.seed(FLAGS.seed)
+        tf.set_random_seed(FLAGS.seed)
+
+    dataset = Dataset(FLAGS.input, backend=FLAGS.backend, path_decoded=FLAGS.decoded,
+                      exclude_vert_hori=FLAGS.exclude_vert_hori)
 
     if tf.gfile.Exists(FLAGS.model):
         tf.gfile.DeleteRecursively(FLAGS.model)
@@ -201,7 +404,10 @@ def main(argv=None):
         tf.gfile.DeleteRecursively(FLAGS.log)
     tf.gfile.MakeDirs(FLAGS.log)
 
-    train(dataset)
+    if FLAGS.feature_cache is not None:
+        train_decoder(dataset)
+    else:
+        train(dataset)
 
 if __name__ == '__main__':
     tf.app.run()
\ No newline at end of file
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent store of hyperparameter trials shared by concurrent sweeps
+
+Trials are keyed by their resolved train/eval commands and git commit. A trial being run is
+claimed in the store, so another sweep proposing the same trial waits for its result.
+Only completed trials are reused, pruned trials keep their partial score under their own status.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+
+STATUS_RUNNING = 'running'
+STATUS_FAILED = 'failed'
+STATUS_COMPLETED = 'completed'
+# score of a pruned trial is partial and depends on the pruner, it is run again when asked
+STATUS_PRUNED = 'pruned'
+# statuses with a score usable as the result of a trial
+STATUS_FINISHED = [STATUS_COMPLETED]
+
+
+def trial_key(train_args, eval_args, commit):
+    return hashlib.sha256("\n".join([commit, train_args, eval_args]).encode('utf-8')).hexdigest()
+
+
+def study_key(name_templ, train_templ, eval_templ, params):
+    return hashlib.sha256("\n".join([name_templ, train_templ, eval_templ] + list(params)).encode('utf-8')).hexdigest()
+
+
+def _to_json(values):
+    return json.dumps([v.item() if hasattr(v, 'item') else v for v in values])
+
+
+class TrialStore(object):
+    def __init__(self, path, poll_interval=10.0, stale_seconds=24 * 3600):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        dirname = os.path.dirname(path)
+        if dirname != "":
+            os.makedirs(dirname, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS trials (
+                key TEXT PRIMARY KEY, study TEXT, commit_sha TEXT, params TEXT, command TEXT,
+                status TEXT, score REAL, owner TEXT, updated REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS trials_study ON trials (study, commit_sha)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # one connection per call, so that the store can be used from threads of trials
+        conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _is_alive(self, row):
+        hostname, pid = row['owner'].rsplit(':', 1)
+        if hostname != socket.gethostname():
+            return time.time() - row['updated'] < self.stale_seconds
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def acquire(self, key, study, commit, param_vals, command):
+        """Return finished row of `key`, or claim the trial for this process and return None
+
+        Waits while another live process runs the same trial.
+        """
+        while True:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT * FROM trials WHERE key = ?", (key,)).fetchone()
+                if row is not None and row['status'] in STATUS_FINISHED:
+                    conn.execute("COMMIT")
+                    return dict(row)
+                if row is None or row['status'] in (STATUS_FAILED, STATUS_PRUNED) or not self._is_alive(row):
+                    conn.execute(
+                        "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, study, commit, _to_json(param_vals), command, STATUS_RUNNING, None,
+                         self.owner, time.time()))
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+            print("waiting for the same trial run by {}".format(row['owner']))
+            time.sleep(self.poll_interval)
+
+    def finish(self, key, status, score=None):
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE trials SET status = ?, score = ?, updated = ? WHERE key = ? AND owner = ?",
+                         (status, score, time.time(), key, self.owner))
+        finally:
+            conn.close()
+
+    def history(self, study, commit=None, statuses=STATUS_FINISHED):
+        """Parameters and scores of trials of `study` in `statuses`, of `commit` if given"""
+        query = "SELECT params, score FROM trials WHERE study = ? AND status IN ({})".format(
+            ", ".join("?" * len(statuses)))
+        args = [study] + list(statuses)
+        if commit is not None:
+            query += " AND commit_sha = ?"
+            args.append(commit)
+        conn = self._connect()
+        try:
+            rows = conn.execute(query + " ORDER BY updated", args).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row['params']) for row in rows], [row['score'] for row in rows]
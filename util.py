@@ -1,10 +1,13 @@
+import os
+import json
 import math
+import hashlib
 import functools
-from tensorflow.python.keras.callbacks import TensorBoard
-import tensorflow.keras.backend as K
 import numpy as np
 
-from metrics import weighted_mean_score, weighted_mean_iou
+from constant import *
+
+INPUT_SIZE_FILENAME = "input_size.json"
 
 
 def RLenc(img, order='F', format=True):
@@ -15,36 +18,28 @@ def RLenc(img, order='F', format=True):
 
     returns run length as an array or string (if format is True)
     """
-    bytes = img.reshape(img.shape[0] * img.shape[1], order=order)
-    runs = []  ## list of run lengths
-    r = 0  ## the current run length
-    pos = 1  ## count starts from 1 per WK
-    for c in bytes:
-        if (c == 0):
-            if r != 0:
-                runs.append((pos, r))
-                pos += r
-                r = 0
-            pos += 1
-        else:
-            r += 1
-
-    # if last run is unsaved (i.e. data ends with 1)
-    if r != 0:
-        runs.append((pos, r))
-        pos += r
-        r = 0
+    pixels = np.concatenate([[False], img.reshape(img.shape[0] * img.shape[1], order=order) != 0, [False]])
+    # 1-based positions where runs start and end
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    starts, ends = changes[::2], changes[1::2]
+    runs = [(int(start), int(end - start)) for start, end in zip(starts, ends)]
 
     if format:
-        z = ''
-
-        for rr in runs:
-            z += '{} {} '.format(rr[0], rr[1])
-        return z[:-1]
+        return ' '.join('{} {}'.format(start, length) for start, length in runs)
     else:
         return runs
 
 
+def files_digest(path_input, ids, dirnames):
+    """sha256 of ids with size and mtime of their files in `dirnames`, to invalidate arrays decoded from them"""
+    h = hashlib.sha256()
+    for dirname in dirnames:
+        for id_ in ids:
+            st = os.stat(os.path.join(path_input, dirname, id_))
+            h.update("{}/{}:{}:{}\n".format(dirname, id_, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
 class StepDecay(object):
     def __init__(self, lr, decay, epochs_decay='10', freeze_once=False):
         self.lr = lr
@@ -96,22 +91,14 @@ class CLRDecay(object):
         return clr
 
 
-class MyTensorBoard(TensorBoard):
-    def __init__(self, log_dir, model):
-        super().__init__(log_dir=log_dir)
-        self.model = model
-
-    def on_epoch_end(self, epoch, logs=None):
-        logs.update({'lr': K.eval(self.model.optimizer.lr)})
-        super().on_epoch_end(epoch, logs)
-
-
 def load_npz(path_pred):
     npzfile = np.load(path_pred)
     return npzfile['arr_0']
 
 
 def get_metrics(threshold=None):
+    # metrics imports TensorFlow, so that NumPy tools importing util start fast
+    from metrics import weighted_mean_score, weighted_mean_iou
     if threshold is None:
         return [weighted_mean_iou, weighted_mean_score]
     else:
@@ -121,6 +108,7 @@ def get_metrics(threshold=None):
 
 
 def get_custom_objects():
+    from metrics import weighted_mean_score, weighted_mean_iou
     return {'weighted_mean_iou': weighted_mean_iou, 'weighted_mean_score': weighted_mean_score}
 
 def write_summary(model, filename):
@@ -132,3 +120,17 @@ def write_summary(model, filename):
 def sigmoid(x):
     return 1.0 / (1.0 + np.exp(-x))
 
+
+def save_input_size(model_dir, height, width):
+    with open(os.path.join(model_dir, INPUT_SIZE_FILENAME), 'w') as f:
+        json.dump({'height': height, 'width': width}, f, indent=4)
+
+
+def load_input_size(model_dir):
+    """Return input (height, width) of model, (IM_HEIGHT, IM_WIDTH) for models saved without it"""
+    path = os.path.join(model_dir, INPUT_SIZE_FILENAME)
+    if not os.path.exists(path):
+        return IM_HEIGHT, IM_WIDTH
+    with open(path) as f:
+        size = json.load(f)
+    return size['height'], size['width']
@@ -1,127 +1,214 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Visualize predictions of validation data
+
+Samples are scored in a process pool while streaming from files, then tiles of
+image / ground truth / prediction are composited by cv2 only for the selected samples,
+e.g. the worst-K or a coverage bucket, optionally arranged in contact sheets.
+"""
+
 import os
+import csv
+import time
+import shutil
+import tempfile
+import multiprocessing
 
-import tensorflow as tf
+import cv2
 import numpy as np
-from tensorflow.keras.models import load_model
-import tensorflow.keras.backend as K
-from tensorflow.python.framework.errors_impl import OutOfRangeError
-from tqdm import tnrange, tqdm_notebook, tqdm
-import matplotlib.pyplot as plt
+from absl import app, flags
+from tqdm import tqdm
+
 from util import load_npz
-from dataset import Dataset
-from metrics import mean_iou, mean_score, mean_score_per_image
+from dataset_index import DatasetIndex
+from scoring import mean_score_batch
 from constant import *
 
-tf.flags.DEFINE_string(
+flags.DEFINE_string(
     'input', '../input/train',
     """path to test data""")
 
-tf.flags.DEFINE_string(
+flags.DEFINE_string(
     'prediction', '../output/prediction',
     """path to prediction directory""")
 
-tf.flags.DEFINE_bool('dice', True, """whether to use dice loss""")
-
-tf.flags.DEFINE_integer(
-    'batch_size', 16, """batch size""")
-
-tf.flags.DEFINE_string(
+flags.DEFINE_string(
     'visualize', '../output/visualize',
     """path to prediction directory""")
 
-tf.flags.DEFINE_integer(
+flags.DEFINE_integer(
     'cv', 0, help="""index of k-fold cross validation. index must be in 0~9""")
 
-FLAGS = tf.flags.FLAGS
-
-
-def create_image(x, y_true, y_pred, id, path_out, title=None):
-    x = np.reshape(x, (ORIG_WIDTH, ORIG_HEIGHT, IM_CHAN)).astype(np.uint8)
-    y_true = np.reshape(y_true, (ORIG_WIDTH, ORIG_HEIGHT)).astype(np.uint8)
-    y_pred = np.reshape(y_pred, (ORIG_WIDTH, ORIG_HEIGHT)).astype(np.uint8)
-
-    fig, axs = plt.subplots(1, 3)
-    plt.subplots_adjust(wspace=0.2, hspace=0.6)
-
-    # raw image
-    ax = axs[0]
-    ax.imshow(x, cmap="Greys")
-    ax.set_yticklabels([])
-    ax.set_xticklabels([])
-
-    # raw image + ground truth
-    ax = axs[1]
-    ax.imshow(x, cmap="Greys")
-    ax.imshow(y_true, alpha=0.3, cmap="Greens")
-    ax.set_yticklabels([])
-    ax.set_xticklabels([])
-
-    # raw image + prediction
-    ax = axs[2]
-    ax.imshow(x, cmap="Greys")
-    ax.imshow(y_pred, alpha=0.3, cmap="Blues")
-    ax.set_yticklabels([])
-    ax.set_xticklabels([])
-
-    if title == None:
-        title = "Green: ground truth. Blue: prediction."
-    plt.suptitle(title)
-    fig.savefig(path_out)
-    plt.close()
-
-
-def load_preds(dir_pred, id_samples):
-    preds = []
-    for id in id_samples:
-        f = os.path.join(dir_pred, id)
-        pred = load_npz(f)
-        preds.append(pred)
-
-    return preds
+flags.DEFINE_float(
+    'threshold', 0.5, """threshold of confidence to predict foreground""")
+
+flags.DEFINE_integer(
+    'workers', 4, """number of processes to score and render samples""")
+
+flags.DEFINE_integer(
+    'worst_k', 0, """render only k samples of the lowest score (0: render all)""")
+
+flags.DEFINE_list(
+    'coverage', None, """render only samples with ground truth coverage in [min,max) ex) --coverage=0.0,0.1""")
+
+flags.DEFINE_integer(
+    'scale', 2, """scale factor of tiles""")
+
+flags.DEFINE_integer(
+    'sheet_columns', 0, """number of columns of contact sheets (0: save tiles separately)""")
+
+flags.DEFINE_integer(
+    'sheet_rows', 8, """number of rows of contact sheets""")
+
+flags.DEFINE_bool(
+    'benchmark', False, """render all samples of the fold to a temporary directory and report time of each stage""")
+
+FLAGS = flags.FLAGS
+
+SCORES_FILENAME = "scores.csv"
+TITLE_HEIGHT = 24
+MARGIN = 4
+# BGR colors of overlay
+COLOR_TRUE = (0, 255, 0)
+COLOR_PRED = (255, 0, 0)
+
+
+def load_sample(path_input, path_prediction, id):
+    """Return gray image, ground truth mask and confidence of a sample"""
+    image = cv2.imread(os.path.join(path_input, 'images', id), cv2.IMREAD_GRAYSCALE)
+    mask = cv2.imread(os.path.join(path_input, 'masks', id), cv2.IMREAD_GRAYSCALE) > 127
+    pred = load_npz(os.path.join(path_prediction, os.path.splitext(id)[0] + '.npz'))
+    return image, mask, np.reshape(pred, (ORIG_HEIGHT, ORIG_WIDTH))
+
+
+def score_sample(args):
+    path_input, path_prediction, id, threshold = args
+    _, mask, pred = load_sample(path_input, path_prediction, id)
+    score = mean_score_batch(mask[np.newaxis], pred[np.newaxis], threshold=threshold)[0]
+    num_pixels = float(ORIG_HEIGHT * ORIG_WIDTH)
+    return id, float(score), np.count_nonzero(mask) / num_pixels, np.count_nonzero(pred > threshold) / num_pixels
+
+
+def overlay(image, mask, color, alpha=0.3):
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    blended = image.astype(np.float32)
+    blended[mask] = blended[mask] * (1 - alpha) + np.array(color, dtype=np.float32) * alpha
+    return blended.astype(np.uint8)
+
+
+def render_tile(args):
+    """Composite image, image + ground truth and image + prediction side by side with a title"""
+    path_input, path_prediction, id, score, threshold, scale = args
+    image, mask, pred = load_sample(path_input, path_prediction, id)
+    panels = [cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), overlay(image, mask, COLOR_TRUE),
+              overlay(image, pred > threshold, COLOR_PRED)]
+    panels = [cv2.resize(p, (ORIG_WIDTH * scale, ORIG_HEIGHT * scale), interpolation=cv2.INTER_NEAREST)
+              for p in panels]
+    height, width = panels[0].shape[:2]
+    tile = np.full((height + TITLE_HEIGHT, width * 3 + MARGIN * 2, 3), 255, dtype=np.uint8)
+    for i, p in enumerate(panels):
+        left = (width + MARGIN) * i
+        tile[TITLE_HEIGHT:, left:left + width] = p
+    cv2.putText(tile, "{} score:{:.2f}".format(os.path.splitext(id)[0], score), (2, TITLE_HEIGHT - 7),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 0), 1, cv2.LINE_AA)
+    return id, tile
+
+
+class ContactSheetWriter(object):
+    """Arrange tiles in a grid and save a sheet each time it is filled"""
+    def __init__(self, path_out, columns, rows):
+        self.path_out = path_out
+        self.columns = columns
+        self.rows = rows
+        self.tiles = []
+        self.num_sheets = 0
+
+    def add(self, tile):
+        self.tiles.append(tile)
+        if len(self.tiles) == self.columns * self.rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.tiles) == 0:
+            return
+        height, width = self.tiles[0].shape[:2]
+        rows = int(np.ceil(len(self.tiles) / self.columns))
+        sheet = np.full((rows * (height + MARGIN), self.columns * (width + MARGIN), 3), 255, dtype=np.uint8)
+        for i, tile in enumerate(self.tiles):
+            top, left = (i // self.columns) * (height + MARGIN), (i % self.columns) * (width + MARGIN)
+            sheet[top:top + height, left:left + width] = tile
+        cv2.imwrite(os.path.join(self.path_out, "sheet-{:03d}.png".format(self.num_sheets)), sheet)
+        self.num_sheets += 1
+        self.tiles = []
+
+
+def select_samples(scores, worst_k=0, coverage=None):
+    """Filter rows of (id, score, coverage_true, coverage_pred) by coverage bucket, then sort by score"""
+    if coverage is not None:
+        cmin, cmax = [float(c) for c in coverage]
+        scores = [s for s in scores if cmin <= s[2] < cmax]
+    scores = sorted(scores, key=lambda s: (s[1], s[0]))
+    if worst_k > 0:
+        scores = scores[:worst_k]
+    return scores
+
+
+def save_scores(path, scores):
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id', 'score', 'coverage_true', 'coverage_pred'])
+        writer.writerows(scores)
+
+
+def visualize(pool, id_valids, path_out, worst_k=0, coverage=None):
+    """Score samples, render selected ones to `path_out`, return time of each stage"""
+    times = {}
+    start = time.time()
+    args = [(FLAGS.input, FLAGS.prediction, id, FLAGS.threshold) for id in id_valids]
+    scores = list(tqdm(pool.imap(score_sample, args, chunksize=16), total=len(args), desc="score"))
+    save_scores(os.path.join(path_out, SCORES_FILENAME), sorted(scores, key=lambda s: (s[1], s[0])))
+    times['score'] = time.time() - start
+
+    start = time.time()
+    selected = select_samples(scores, worst_k, coverage)
+    args = [(FLAGS.input, FLAGS.prediction, id, score, FLAGS.threshold, FLAGS.scale) for id, score, _, _ in selected]
+    sheets = ContactSheetWriter(path_out, FLAGS.sheet_columns, FLAGS.sheet_rows) if FLAGS.sheet_columns > 0 else None
+    for id, tile in tqdm(pool.imap(render_tile, args, chunksize=4), total=len(args), desc="render"):
+        if sheets is not None:
+            sheets.add(tile)
+        else:
+            cv2.imwrite(os.path.join(path_out, id), tile)
+    if sheets is not None:
+        sheets.flush()
+    times['render'] = time.time() - start
+    return times, len(scores), len(selected)
 
 
 def main(argv=None):
-    if tf.gfile.Exists(FLAGS.visualize):
-        tf.gfile.DeleteRecursively(FLAGS.visualize)
-    tf.gfile.MakeDirs(FLAGS.visualize)
-
-    dataset = Dataset(FLAGS.input)
-    iter_valid = dataset.gen_valid(n_splits=N_SPLITS, idx_kfold=FLAGS.cv, adjust='never', with_path=True, repeat=1)
-
-    X_valids = []
-    Y_valids = []
-    path_valids = []
-    with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
-        try:
-            while True:
-                xs, ys, ids = sess.run(iter_valid.get_next())
-                X_valids.append(xs)
-                Y_valids.append(ys)
-                path_valids.extend(ids)
-        except OutOfRangeError:
-            pass
-    X_valids = np.concatenate(X_valids)
-    Y_valids = np.concatenate(Y_valids)
-    id_valids = [os.path.basename(id.decode('utf-8')) for id in path_valids]
-
-    pred_filenames = [os.path.basename(id.replace('png', 'npz')) for id in id_valids]
-    pred_valids = load_preds(FLAGS.prediction, pred_filenames)
-
-    for id, x, y_true, y_pred in tqdm(zip(id_valids, X_valids, Y_valids, pred_valids), total=len(id_valids)):
-        path_out = os.path.join(FLAGS.visualize, id)
-
-        # Make tile
-        score = mean_score_per_image(y_true, y_pred)
-        title = "id:{}, score:{}".format(id, score)
-
-        create_image(
-            np.clip(x * 255, 0, 255), np.clip(y_true * 255, 0, 255), np.clip(y_pred * 255, 0, 255), id, path_out, title=title)
-    print("Finish visualize of validation data")
-
+    dataset = DatasetIndex(FLAGS.input)
+    _, id_valids = dataset.kfold_split(N_SPLITS, FLAGS.cv)
+
+    with multiprocessing.Pool(FLAGS.workers) as pool:
+        if FLAGS.benchmark:
+            path_out = tempfile.mkdtemp(prefix="visualize-")
+            try:
+                times, num_scored, num_rendered = visualize(pool, id_valids, path_out)
+            finally:
+                shutil.rmtree(path_out)
+            print("scored {} samples in {:.2f} sec ({:.1f} samples/sec)".format(
+                num_scored, times['score'], num_scored / max(times['score'], 1e-6)))
+            print("rendered {} samples in {:.2f} sec ({:.1f} samples/sec) with {} workers".format(
+                num_rendered, times['render'], num_rendered / max(times['render'], 1e-6), FLAGS.workers))
+            return
+
+        if os.path.exists(FLAGS.visualize):
+            shutil.rmtree(FLAGS.visualize)
+        os.makedirs(FLAGS.visualize)
+        times, num_scored, num_rendered = visualize(pool, id_valids, FLAGS.visualize, FLAGS.worst_k, FLAGS.coverage)
+    print("Finish visualize of validation data, rendered {} of {} samples".format(num_rendered, num_scored))
 
 
 if __name__ == '__main__':
-    tf.app.run()
\ No newline at end of file
+    app.run(main)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local store of pretrained ImageNet weights, verified by sha256, for nodes without internet access
+
+resnet50.ResNet50 and densenet.DenseNet* read weights from the store given by --weight_store
+(or $WEIGHT_STORE), and download them by get_file as before if no store is given.
+The index of the store records sha256 of each file at import, and files are hashed again when loaded.
+
+    python weight_store.py --store ../weights import resnet50_notop [path/to/file.h5]
+    python weight_store.py --store ../weights verify
+    python weight_store.py --store ../weights list
+
+Without a path, import downloads the file by get_file on a machine with internet access.
+Known files are checked against their published md5 at import, --force accepts any .h5 file,
+e.g. small synthetic weights made by Model.save_weights, as benchmark_weight_store.py does.
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+ENV_NAME = "WEIGHT_STORE"
+INDEX_FILENAME = "index.json"
+
+_BASE_URL = 'https://github.com/fchollet/deep-learning-models/releases/download/'
+
+# name: (filename, url, md5)
+WEIGHTS = OrderedDict([
+    ('resnet50', ('resnet50_weights_tf_dim_ordering_tf_kernels.h5',
+                  _BASE_URL + 'v0.2/resnet50_weights_tf_dim_ordering_tf_kernels.h5',
+                  'a7b3fe01876f51b976af0dea6bc144eb')),
+    ('resnet50_notop', ('resnet50_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                        _BASE_URL + 'v0.2/resnet50_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                        'a268eb855778b3df3c7506639542a6af')),
+    ('densenet121', ('densenet121_weights_tf_dim_ordering_tf_kernels.h5',
+                     _BASE_URL + 'v0.8/densenet121_weights_tf_dim_ordering_tf_kernels.h5',
+                     '0962ca643bae20f9b6771cb844dca3b0')),
+    ('densenet121_notop', ('densenet121_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                           _BASE_URL + 'v0.8/densenet121_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                           '4912a53fbd2a69346e7f2c0b5ec8c6d3')),
+    ('densenet169', ('densenet169_weights_tf_dim_ordering_tf_kernels.h5',
+                     _BASE_URL + 'v0.8/densenet169_weights_tf_dim_ordering_tf_kernels.h5',
+                     'bcf9965cf5064a5f9eb6d7dc69386f43')),
+    ('densenet169_notop', ('densenet169_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                           _BASE_URL + 'v0.8/densenet169_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                           '50662582284e4cf834ce40ab4dfa58c6')),
+    ('densenet201', ('densenet201_weights_tf_dim_ordering_tf_kernels.h5',
+                     _BASE_URL + 'v0.8/densenet201_weights_tf_dim_ordering_tf_kernels.h5',
+                     '7bb75edd58cb43163be7e0005fbe95ef')),
+    ('densenet201_notop', ('densenet201_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                           _BASE_URL + 'v0.8/densenet201_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                           '1c2de60ee40562448dbac34a0737e798')),
+])
+
+
+def file_hash(path, algorithm='sha256', chunk_size=1 << 20):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class WeightStore(object):
+    """Weight files in directory `path` with index of their sha256"""
+    def __init__(self, path):
+        self.path = path
+
+    def _index_path(self):
+        return os.path.join(self.path, INDEX_FILENAME)
+
+    def load_index(self):
+        if not os.path.exists(self._index_path()):
+            return OrderedDict()
+        with open(self._index_path()) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+
+    def _save_index(self, index):
+        path_tmp = self._index_path() + ".tmp"
+        with open(path_tmp, 'w') as f:
+            json.dump(index, f, indent=4)
+        os.replace(path_tmp, self._index_path())
+
+    def names(self):
+        return list(self.load_index().keys())
+
+    def add(self, name, path_src, force=False):
+        """Copy `path_src` into the store as `name`, return its sha256
+
+        `path_src` must have the published md5 of `name` unless `force`.
+        """
+        if name not in WEIGHTS and not force:
+            raise ValueError("weights {} are unknown, use force to import them".format(name))
+        if name in WEIGHTS and not force:
+            md5 = file_hash(path_src, 'md5')
+            if md5 != WEIGHTS[name][2]:
+                raise ValueError("md5 of {} is {}, {} is expected for {}".format(path_src, md5, WEIGHTS[name][2], name))
+        filename = WEIGHTS[name][0] if name in WEIGHTS else name + ".h5"
+
+        os.makedirs(self.path, exist_ok=True)
+        path_dst = os.path.join(self.path, filename)
+        path_tmp = path_dst + ".tmp"
+        shutil.copyfile(path_src, path_tmp)
+        sha256 = file_hash(path_tmp)
+        os.replace(path_tmp, path_dst)
+
+        index = self.load_index()
+        index[name] = {'filename': filename, 'sha256': sha256, 'size': os.path.getsize(path_dst),
+                       'source': os.path.abspath(path_src)}
+        self._save_index(index)
+        return sha256
+
+    def verify(self, name):
+        """Return path of `name` after checking its sha256, raise ValueError if it is missing or modified"""
+        index = self.load_index()
+        if name not in index:
+            raise ValueError("weights {} are not in store {}, import them by weight_store.py".format(name, self.path))
+        entry = index[name]
+        path = os.path.join(self.path, entry['filename'])
+        if not os.path.exists(path):
+            raise ValueError("{} of weights {} is missing".format(path, name))
+        if os.path.getsize(path) != entry['size'] or file_hash(path) != entry['sha256']:
+            raise ValueError("{} of weights {} does not match sha256 {}".format(path, name, entry['sha256']))
+        return path
+
+
+def default_store():
+    """Path of the store given by --weight_store of config.py or $WEIGHT_STORE, None if not given"""
+    from absl import flags
+    FLAGS = flags.FLAGS
+    if 'weight_store' in FLAGS and FLAGS.is_parsed() and FLAGS.weight_store:
+        return FLAGS.weight_store
+    return os.environ.get(ENV_NAME) or None
+
+
+def get_weights_path(name, include_top=True, store=None):
+    """Return local path of weights `name` (e.g. 'resnet50'), with or without top layers
+
+    Weights with top layers serve a model without them if only they are in the store.
+    Weights are downloaded by get_file if no store is given.
+    """
+    store = store if store is not None else default_store()
+    key = name if include_top else name + "_notop"
+    if store is None:
+        from tensorflow.python.keras.utils.data_utils import get_file
+        filename, url, md5 = WEIGHTS[key]
+        return get_file(filename, url, cache_subdir='models', file_hash=md5)
+
+    store = WeightStore(store)
+    if not include_top and key not in store.names() and name in store.names():
+        key = name
+    return store.verify(key)
+
+
+def _weight_key(name):
+    # 'conv1/kernel:0' and 'conv1_1/kernel:0' of a layer built twice are both 'kernel'
+    return name.split('/')[-1].split(':')[0]
+
+
+def load_weights(model, path):
+    """Load weights of layers of `model` from `path` saved by Model.save_weights, return number of layers
+
+    Only groups of layers in `model` are read, so that weights with top layers load into a model without them.
+    Every layer of `model` with weights must be in the file, otherwise ValueError is raised.
+    Weights of a layer are matched by name, weights missing in the file (e.g. of batch renormalization)
+    keep their initial values.
+    """
+    import h5py
+    from tensorflow.python.keras import backend as K
+
+    weight_value_tuples = []
+    num_layers = 0
+    with h5py.File(path, 'r') as f:
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+        saved_layers = set(n.decode('utf8') if isinstance(n, bytes) else n for n in f.attrs['layer_names'])
+        missing = [layer.name for layer in model.layers if len(layer.weights) > 0 and layer.name not in saved_layers]
+        if len(missing) > 0:
+            raise ValueError("{} of {} layers with weights are not in {}: {}".format(
+                len(missing), len([l for l in model.layers if len(l.weights) > 0]), path, ", ".join(missing[:5])))
+        for layer in model.layers:
+            if len(layer.weights) == 0:
+                continue
+            g = f[layer.name]
+            weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in g.attrs['weight_names']]
+            symbolic = OrderedDict((_weight_key(w.name), w) for w in layer.weights)
+            if all(_weight_key(n) in symbolic for n in weight_names):
+                pairs = [(symbolic[_weight_key(n)], n) for n in weight_names]
+            elif len(weight_names) == len(layer.weights):
+                pairs = list(zip(layer.weights, weight_names))
+            else:
+                raise ValueError("layer {} has {} weights, {} are saved in {}".format(
+                    layer.name, len(layer.weights), len(weight_names), path))
+            for w, n in pairs:
+                value = np.asarray(g[n])
+                if tuple(K.int_shape(w)) != value.shape:
+                    raise ValueError("shape of {} of layer {} is {}, {} is saved in {}".format(
+                        w.name, layer.name, K.int_shape(w), value.shape, path))
+                weight_value_tuples.append((w, value))
+            num_layers += 1
+    K.batch_set_value(weight_value_tuples)
+    return num_layers
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    if len(argv) < 2 or argv[1] not in ('import', 'verify', 'list'):
+        raise app.UsageError("command must be one of import, verify and list")
+    store = WeightStore(FLAGS.store)
+    command, args = argv[1], argv[2:]
+
+    if command == 'import':
+        if len(args) not in (1, 2):
+            raise app.UsageError("usage: import <name> [path]")
+        name = args[0]
+        if len(args) == 2:
+            path_src = args[1]
+        else:
+            from tensorflow.python.keras.utils.data_utils import get_file
+            filename, url, md5 = WEIGHTS[name]
+            path_src = get_file(filename, url, cache_subdir='models', file_hash=md5)
+        sha256 = store.add(name, path_src, force=FLAGS.force)
+        print("Imported {} as {} (sha256 {})".format(path_src, name, sha256))
+    elif command == 'verify':
+        errors = 0
+        for name in args or store.names():
+            try:
+                print("{:<20s} OK {}".format(name, store.verify(name)))
+            except ValueError as e:
+                print("{:<20s} NG {}".format(name, e))
+                errors += 1
+        if errors > 0:
+            sys.exit(1)
+    else:
+        index = store.load_index()
+        for name, entry in index.items():
+            print("{:<20s} {:>12d} {} {}".format(name, entry['size'], entry['sha256'], entry['filename']))
+
+
+if __name__ == '__main__':
+    from absl import app, flags
+
+    # flags are defined only for the CLI, so that --weight_store of config.py does not collide
+    flags.DEFINE_string('store', os.environ.get(ENV_NAME, "../weights"), """path to weight store""")
+    flags.DEFINE_bool('force', False, """import weights without checking their published md5""")
+    app.run(main)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+Subprocesses pinned to disjoint CPU cores with limited threads, and their training history
+"""
+
+import os
+import csv
+import subprocess
+
+from constant import NAME_VALID_HISTORY, VALID_MONITOR
+
+THREAD_ENV_NAMES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+
+def split_cores(num_workers, cores_per_worker=0):
+    """Disjoint lists of CPU cores for each worker"""
+    cores = sorted(os.sched_getaffinity(0))
+    if cores_per_worker <= 0:
+        cores_per_worker = max(1, len(cores) // num_workers)
+    if cores_per_worker * num_workers > len(cores):
+        print("Warning: {} workers x {} cores exceed {} available cores, cores are shared".format(
+            num_workers, cores_per_worker, len(cores)))
+    return [[cores[(i * cores_per_worker + j) % len(cores)] for j in range(cores_per_worker)]
+            for i in range(num_workers)]
+
+
+def worker_env(cores, gpu=None):
+    """Environment limiting threads of a worker to its cores"""
+    env = dict(os.environ)
+    for name in THREAD_ENV_NAMES:
+        env[name] = str(len(cores))
+    if gpu is not None:
+        env["CUDA_VISIBLE_DEVICES"] = "" if gpu == "none" else gpu
+    return env
+
+
+def popen_pinned(args, cores, gpu=None, path_stdout=None, shell=False):
+    """Start `args` pinned to `cores`, output is written to `path_stdout`"""
+    stdout = open(path_stdout, 'w') if path_stdout is not None else None
+    proc = subprocess.Popen(args, env=worker_env(cores, gpu), stdout=stdout, stderr=subprocess.STDOUT, shell=shell,
+                            preexec_fn=lambda: os.sched_setaffinity(0, cores))
+    if stdout is not None:
+        stdout.close()
+    return proc
+
+
+def read_history(path_history):
+    """Rows of a history written by CSVLogger, only complete rows while it is being written"""
+    if not os.path.exists(path_history):
+        return []
+    with open(path_history) as f:
+        text = f.read()
+    if not text.endswith("\n"):
+        # the last line is being written
+        text = text[:text.rfind("\n") + 1]
+    return [row for row in csv.DictReader(text.splitlines()) if None not in row.values() and None not in row]
+
+
+def read_scores(path_history, monitor):
+    """(epoch from 1, score) of `monitor` in a history written by CSVLogger
+
+    If training validates asynchronously, the history of evaluator.py beside it is read for its val_mean_score,
+    since the history of CSVLogger has no validation scores.
+    """
+    path_valid = os.path.join(os.path.dirname(path_history), NAME_VALID_HISTORY)
+    if os.path.exists(path_valid):
+        return [(int(row['epoch']), float(row[VALID_MONITOR]))
+                for row in read_history(path_valid) if row.get(VALID_MONITOR, "") != ""]
+    # epoch of CSVLogger starts from 0
+    return [(int(row['epoch']) + 1, float(row[monitor]))
+            for row in read_history(path_history) if row.get(monitor, "") != ""]
+
+
+def monitor_mode(monitor):
+    """'min' for losses and 'max' for scores"""
+    return 'min' if 'loss' in monitor else 'max'
+
+
+def best_score(path_history, monitor, mode=None):
+    """Best value of `monitor` in a history written by CSVLogger, None if not available
+
+    mode is 'max' or 'min', inferred from `monitor` if None.
+    """
+    mode = mode if mode is not None else monitor_mode(monitor)
+    if mode not in ['max', 'min']:
+        raise ValueError("mode {} is not supported".format(mode))
+    scores = [score for _, score in read_scores(path_history, monitor)]
+    if len(scores) == 0:
+        return None
+    return max(scores) if mode == 'max' else min(scores)